@@ -3,6 +3,7 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+from RawImageGuessLib import BackgroundReader, BatchConvert, ContactSheet, Guessing, ImageReader, ImageStatistics, Instrumentation, NrrdExport, NrrdHeader, ParameterIndex, PixelTypes, Prefetcher, VolumeSequenceReader
 
 #
 # RawImageGuess
@@ -48,6 +49,43 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
 
     self.logic = RawImageGuessLogic()
 
+    # Auto-update reads the image on a background thread to keep the application responsive.
+    # The timer collects the result of the latest request and displays it.
+    self.backgroundReader = BackgroundReader.BackgroundReader(self.logic.readImage)
+    self.backgroundReaderTimer = qt.QTimer()
+    self.backgroundReaderTimer.setInterval(20)
+    self.backgroundReaderTimer.connect('timeout()', self.onBackgroundReaderTimeout)
+
+    # If preview is enabled then only a preview is read while parameters are being adjusted
+    # and the full image is read when parameters have not changed for a short time.
+    self.fullUpdateTimer = qt.QTimer()
+    self.fullUpdateTimer.setSingleShot(True)
+    self.fullUpdateTimer.setInterval(500)
+    self.fullUpdateTimer.connect('timeout()', self.requestUpdate)
+    # Images with likely next parameters are read into the result cache while the user looks at the current image
+    self.prefetcher = Prefetcher.Prefetcher(self.logic.reader)
+    self.prefetchEnabled = False
+
+    # Statistics for window/level are refined in small steps when the image has not changed for a short time
+    self.statisticsRefinementTimer = qt.QTimer()
+    self.statisticsRefinementTimer.setSingleShot(True)
+    self.statisticsRefinementTimer.connect('timeout()', self.onStatisticsRefinementTimeout)
+    # Downsampled preview is decimated to contain approximately this many voxels
+    self.previewNumberOfVoxels = 4 * 1024 * 1024
+
+    # Results of guessImageGeometry, listed in guessResultsComboBox
+    self.geometryCandidates = []
+    # Results of detectHeaderSize, listed in headerSizeResultsComboBox
+    self.headerSizeCandidates = []
+    # Contact sheet shown in the Red slice view, clicking on a tile applies its parameters
+    self.contactSheet = None
+    self.contactSheetVolumeNode = None
+    self.contactSheetInteractorObservation = None
+
+    # Parameters that were confirmed for previously opened files, used for filling in parameters of known files
+    self.parameterIndex = ParameterIndex.ParameterIndex(os.path.join(os.path.dirname(qt.QSettings().fileName()),
+      'RawImageGuessParameterIndex.json'))
+
     # Load widget from .ui file (created by Qt Designer)
     uiWidget = slicer.util.loadUI(self.resourcePath('UI/RawImageGuess.ui'))
     self.layout.addWidget(uiWidget)
@@ -67,6 +105,9 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.ui.imageSizeYSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
     self.ui.imageSizeZSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
     self.ui.skipSlicesSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
+    self.ui.rowStrideSpinBox.connect('valueChanged(int)', self.onImageSizeChanged)
+    self.ui.sliceHeaderSizeSpinBox.connect('valueChanged(int)', self.onImageSizeChanged)
+    self.ui.componentLayoutComboBox.connect('currentIndexChanged(int)', self.onImageSizeChanged)
     self.ui.imageSpacingXSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
     self.ui.imageSpacingYSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
     self.ui.imageSpacingZSliderWidget.connect('valueChanged(double)', self.onImageSizeChanged)
@@ -76,6 +117,27 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.ui.updateButton.connect("clicked()", self.onUpdateButtonClicked)
     self.ui.updateButton.connect("checkBoxToggled(bool)", self.onUpdateCheckboxClicked)
     self.ui.generateNrrdHeaderButton.connect("clicked()", self.onGenerateNrrdHeaderButtonClicked)
+    self.ui.exportNrrdButton.connect("clicked()", self.onExportNrrdButtonClicked)
+    self.ui.previewModeComboBox.connect('currentIndexChanged(int)', self.onPreviewModeChanged)
+    self.ui.memoryMappingCheckBox.connect("toggled(bool)", self.onMemoryMappingToggled)
+    self.ui.readCacheSizeSpinBox.connect('valueChanged(int)', self.onReadCacheSizeChanged)
+    self.ui.resultCacheSizeSpinBox.connect('valueChanged(int)', self.onResultCacheSizeChanged)
+    self.ui.profileUpdatesCheckBox.connect("toggled(bool)", self.onProfileUpdatesToggled)
+    self.ui.downsamplingSpinBox.connect('valueChanged(int)', self.onDownsamplingChanged)
+    self.ui.rememberParametersCheckBox.connect("toggled(bool)", self.onRememberParametersToggled)
+    self.ui.compressExportCheckBox.connect("toggled(bool)", self.onCompressExportToggled)
+    self.ui.prefetchCheckBox.connect("toggled(bool)", self.onPrefetchToggled)
+    self.ui.guessGeometryButton.connect("clicked()", self.onGuessGeometryButtonClicked)
+    self.ui.guessResultsComboBox.connect('currentIndexChanged(int)', self.onGuessResultSelected)
+    self.ui.detectHeaderSizeButton.connect("clicked()", self.onDetectHeaderSizeButtonClicked)
+    self.ui.headerSizeResultsComboBox.connect('currentIndexChanged(int)', self.onHeaderSizeResultSelected)
+    self.ui.showContactSheetButton.connect("clicked()", self.onShowContactSheetButtonClicked)
+
+    # Read the full image immediately when a slider is released after dragging
+    for sliderWidget in [self.ui.imageSkipSliderWidget, self.ui.imageSizeXSliderWidget, self.ui.imageSizeYSliderWidget,
+      self.ui.imageSizeZSliderWidget, self.ui.skipSlicesSliderWidget]:
+      for slider in slicer.util.findChildren(sliderWidget, className='ctkDoubleSlider'):
+        slider.connect('sliderReleased()', self.onSliderReleased)
 
     self.ui.imageSkipSubColumnButton.connect("clicked()", lambda: self.onOffsetImageSkipButtonClicked('sub', 'column'))
     self.ui.imageSkipAddColumnButton.connect("clicked()", lambda: self.onOffsetImageSkipButtonClicked('add', 'column'))
@@ -113,7 +175,16 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.loadParametersFromSettings()
 
   def cleanup(self):
-    pass
+    self.removeContactSheetObserver()
+    self.logic.removeProfileObserver(self.onProfileFinished)
+    self.logic.removeImageSequence(removeNodes=False)
+    self.fullUpdateTimer.stop()
+    self.backgroundReaderTimer.stop()
+    self.statisticsRefinementTimer.stop()
+    self.backgroundReader.stop()
+    self.prefetcher.stop()
+    # Last used times of looked up parameters
+    self.parameterIndex.save()
 
   def enter(self):
     pass
@@ -122,33 +193,20 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     # disable auto-update when exiting the module to prevent accidental
     # updates of other volumes (when the current output volume is deleted)
     self.ui.updateButton.checkState = qt.Qt.Unchecked
+    self.backgroundReader.cancel()
 
   def scalarTypeComponentBigEndianLsbFirst(self):
-    scalarTypeStr = self.ui.pixelTypeComboBox.currentText
-    components = 1
-    if scalarTypeStr == "8 bit unsigned":
-      scalarType = vtk.VTK_UNSIGNED_CHAR
-    elif scalarTypeStr == "8 bit signed":
-      scalarType = vtk.VTK_SIGNED_CHAR
-    elif scalarTypeStr == "16 bit unsigned":
-      scalarType = vtk.VTK_UNSIGNED_SHORT
-    elif scalarTypeStr == "16 bit signed":
-      scalarType = vtk.VTK_SHORT
-    elif scalarTypeStr == "float":
-      scalarType = vtk.VTK_FLOAT
-    elif scalarTypeStr == "double":
-      scalarType = vtk.VTK_DOUBLE
-    elif scalarTypeStr == "24 bit RGB":
-      scalarType = vtk.VTK_UNSIGNED_CHAR
-      components = 3
-    elif scalarTypeStr == "1 bit":
-      scalarType = vtk.VTK_BIT
-
+    (scalarType, components) = PixelTypes.scalarTypeAndComponentsFromName(self.ui.pixelTypeComboBox.currentText)
     bigEndian = self.ui.endiannessComboBox.currentText.lower() == "big endian"
     lsbFirst = self.ui.bitOrderComboBox.currentText.lower() == 'lsb-first'
 
     return (scalarType, components, bigEndian, lsbFirst)
 
+  def setScalarTypeComponentBigEndianLsbFirst(self, scalarType, components, bigEndian, lsbFirst):
+    self.ui.pixelTypeComboBox.currentText = PixelTypes.pixelTypeName(scalarType, components)
+    self.ui.endiannessComboBox.currentText = "Big endian" if bigEndian else "Little endian"
+    self.ui.bitOrderComboBox.currentText = "LSB-first" if lsbFirst else "LSB-last"
+
   def updateWidgetRange(self, value, widget, settingName, mode):
     settings = qt.QSettings()
     if mode=='min':
@@ -161,15 +219,18 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
   def onCurrentPathChanged(self, path):
     self.ui.inputFileSelector.addCurrentPathToHistory()
     self.updateButtonStates()
+    self.loadParametersFromIndex()
     if not self.ui.outputVolumeNodeSelector.currentNode():
       return
     if self.ui.updateButton.checkState == qt.Qt.Checked:
-      self.onUpdate()
-      self.showOutputVolume()
+      self.requestUpdate()
 
   def updateButtonStates(self):
     enabled = bool(self.ui.inputFileSelector.currentPath)
     self.ui.updateButton.enabled = enabled
+    self.ui.guessGeometryButton.enabled = enabled
+    self.ui.detectHeaderSizeButton.enabled = enabled
+    self.ui.showContactSheetButton.enabled = enabled
     if enabled:
       self.ui.updateButton.toolTip = "Read file into output volume"
     else:
@@ -183,6 +244,14 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     else:
       self.ui.generateNrrdHeaderButton.toolTip = "Select input file and output volume"
 
+    enabled = bool(self.ui.inputFileSelector.currentPath)
+    self.ui.exportNrrdButton.enabled = enabled
+    if enabled:
+      self.ui.exportNrrdButton.toolTip = ("Write the image into a NRRD file that contains the voxels"
+        " (1 bit images are converted to 8 bit, byte order is converted to the byte order of this computer)")
+    else:
+      self.ui.exportNrrdButton.toolTip = "Select input file"
+
   def showOutputVolume(self):
     selectedVolumeNode = self.ui.outputVolumeNodeSelector.currentNode()
     if selectedVolumeNode:
@@ -193,15 +262,136 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.updateButtonStates()
     self.logic.newImage()
     if self.ui.updateButton.checkState == qt.Qt.Checked:
-      self.onUpdate()
-      self.showOutputVolume()
+      self.requestUpdate()
 
   def onImageSizeChanged(self, value):
     # Keep bit-order controls visible only for 1bpp
     self.updateBitOrderControlsVisibility()
     if self.ui.updateButton.checkState == qt.Qt.Checked:
-      self.onUpdate()
-      self.showOutputVolume()
+      if self.ui.previewModeComboBox.currentText == "Disabled" or self.isFullImageCached():
+        # Full image is read immediately if it is returned from the result cache (for example, if it has been prefetched)
+        self.requestUpdate()
+      else:
+        self.requestUpdate(preview=True)
+        self.fullUpdateTimer.start()
+
+  def onSliderReleased(self):
+    if self.fullUpdateTimer.isActive():
+      self.fullUpdateTimer.stop()
+      self.requestUpdate()
+
+  def onPreviewModeChanged(self, index):
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/previewMode', self.ui.previewModeComboBox.currentText)
+
+  def onMemoryMappingToggled(self, enable):
+    self.logic.reader.memoryMappingEnabled = enable
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/memoryMapping', enable)
+
+  def onReadCacheSizeChanged(self, value):
+    self.logic.reader.blockCache.setMaximumSize(value * 1024 * 1024)
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/readCacheSizeMB', value)
+
+  def onResultCacheSizeChanged(self, value):
+    self.logic.reader.resultCache.setMaximumSize(value * 1024 * 1024)
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/resultCacheSizeMB', value)
+    self.updateResultCacheStatistics()
+
+  def updateResultCacheStatistics(self):
+    statistics = self.logic.reader.resultCache.statistics()
+    self.ui.resultCacheStatisticsLabel.text = "{0} images ({1:.0f} MB), hit rate: {2:.0f}% ({3} of {4} reads)".format(
+      statistics['numberOfEntries'], statistics['size'] / (1024.0 * 1024.0), statistics['hitRate'] * 100,
+      statistics['numberOfHits'], statistics['numberOfHits'] + statistics['numberOfMisses'])
+
+  def onProfileUpdatesToggled(self, enable):
+    self.logic.profilingEnabled = enable
+    if enable:
+      self.logic.addProfileObserver(self.onProfileFinished)
+    else:
+      self.logic.removeProfileObserver(self.onProfileFinished)
+      self.ui.profileSummaryLabel.text = ""
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/profileUpdates', enable)
+
+  def onDownsamplingChanged(self, value):
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/downsampling', value)
+    if self.ui.updateButton.checkState == qt.Qt.Checked:
+      self.requestUpdate()
+
+  def onPrefetchToggled(self, enable):
+    self.prefetchEnabled = enable
+    if not enable:
+      self.prefetcher.cancel()
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/prefetch', enable)
+
+  def onCompressExportToggled(self, enable):
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/compressExport', enable)
+
+  def onRememberParametersToggled(self, enable):
+    settings = qt.QSettings()
+    settings.setValue('RawImageGuess/rememberParameters', enable)
+
+  def loadParametersFromIndex(self):
+    """Fill in parameters that were confirmed for the current file (or a file of the same format and size)"""
+    path = self.ui.inputFileSelector.currentPath
+    if not self.ui.rememberParametersCheckBox.checked or not path or not os.path.isfile(path):
+      return
+    try:
+      (parameters, exactMatch) = self.parameterIndex.lookup(path)
+    except (IOError, OSError) as e:
+      logging.warning("Failed to look up parameters of {0}: {1}".format(path, e))
+      return
+    if parameters is None:
+      return
+    # Update the image only once, after all parameters are set
+    wasAutoUpdate = (self.ui.updateButton.checkState == qt.Qt.Checked)
+    self.ui.updateButton.checkState = qt.Qt.Unchecked
+    self.setScalarTypeComponentBigEndianLsbFirst(parameters['scalarType'], parameters['numberOfComponents'],
+      parameters['bigEndian'], parameters['lsbFirst'])
+    self.ui.imageSkipSliderWidget.value = parameters['headerSize']
+    self.ui.imageSizeXSliderWidget.value = parameters['sizeX']
+    self.ui.imageSizeYSliderWidget.value = parameters['sizeY']
+    self.ui.imageSizeZSliderWidget.value = parameters['sizeZ']
+    self.ui.skipSlicesSliderWidget.value = parameters['skipSlices']
+    # Layout parameters are missing from entries that were stored by earlier versions
+    self.ui.rowStrideSpinBox.value = parameters.get('rowStride', 0)
+    self.ui.sliceHeaderSizeSpinBox.value = parameters.get('sliceHeaderSize', 0)
+    self.ui.componentLayoutComboBox.currentText = "planar" if parameters.get('planar', False) else "interleaved"
+    self.ui.imageSpacingXSliderWidget.value = parameters['spacingX']
+    self.ui.imageSpacingYSliderWidget.value = parameters['spacingY']
+    self.ui.imageSpacingZSliderWidget.value = parameters['spacingZ']
+    self.ui.numberOfVolumesSliderWidget.value = parameters['numberOfVolumes']
+    self.ui.updateButton.blockSignals(True)
+    self.ui.updateButton.checkState = qt.Qt.Checked if wasAutoUpdate else qt.Qt.Unchecked
+    self.ui.updateButton.blockSignals(False)
+    if wasAutoUpdate:
+      self.requestUpdate()
+    logging.info("Parameters of {0} are filled in from {1}".format(path,
+      "previously confirmed parameters of this file" if exactMatch else "a file of the same size and format"))
+
+  def saveParametersToIndex(self):
+    """Remember the current parameters for the current file (called when parameters are confirmed by the user)"""
+    path = self.ui.inputFileSelector.currentPath
+    if not self.ui.rememberParametersCheckBox.checked or not path or not os.path.isfile(path):
+      return
+    parameters = self.imageParameters()
+    (parameters['spacingX'], parameters['spacingY'], parameters['spacingZ']) = self.imageSpacing()
+    parameters['numberOfVolumes'] = toLong(self.ui.numberOfVolumesSliderWidget.value)
+    try:
+      self.parameterIndex.store(path, parameters)
+    except (IOError, OSError) as e:
+      logging.warning("Failed to store parameters of {0}: {1}".format(path, e))
+
+  def onProfileFinished(self, profile):
+    summary = profile.summary()
+    self.ui.profileSummaryLabel.text = summary
+    logging.info(summary)
 
   def updateBitOrderControlsVisibility(self):
     # Show LSB combobox for 1 bit images, show endianness combobox for other types
@@ -220,6 +410,9 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     settings.setValue('RawImageGuess/sizeY', self.ui.imageSizeYSliderWidget.value)
     settings.setValue('RawImageGuess/sizeZ', self.ui.imageSizeZSliderWidget.value)
     settings.setValue('RawImageGuess/skipSlices', self.ui.skipSlicesSliderWidget.value)
+    settings.setValue('RawImageGuess/rowStride', self.ui.rowStrideSpinBox.value)
+    settings.setValue('RawImageGuess/sliceHeaderSize', self.ui.sliceHeaderSizeSpinBox.value)
+    settings.setValue('RawImageGuess/componentLayout', self.ui.componentLayoutComboBox.currentText)
     settings.setValue('RawImageGuess/spacingX', self.ui.imageSpacingXSliderWidget.value)
     settings.setValue('RawImageGuess/spacingY', self.ui.imageSpacingYSliderWidget.value)
     settings.setValue('RawImageGuess/spacingZ', self.ui.imageSpacingZSliderWidget.value)
@@ -236,6 +429,15 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.ui.skipSlicesMax.value = toLong(settings.value('RawImageGuess/skipSlicesMax', 100))
     self.ui.imageSpacingMin.value = float(settings.value('RawImageGuess/spacingMin', 0.0))
     self.ui.imageSpacingMax.value = float(settings.value('RawImageGuess/spacingMax', 5.0))
+    self.ui.previewModeComboBox.currentText = settings.value('RawImageGuess/previewMode', "Current slice")
+    self.ui.memoryMappingCheckBox.checked = (str(settings.value('RawImageGuess/memoryMapping', True)).lower() == 'true')
+    self.ui.readCacheSizeSpinBox.value = toLong(settings.value('RawImageGuess/readCacheSizeMB', 512))
+    self.ui.resultCacheSizeSpinBox.value = toLong(settings.value('RawImageGuess/resultCacheSizeMB', 1024))
+    self.ui.profileUpdatesCheckBox.checked = (str(settings.value('RawImageGuess/profileUpdates', False)).lower() == 'true')
+    self.ui.downsamplingSpinBox.value = toLong(settings.value('RawImageGuess/downsampling', 1))
+    self.ui.rememberParametersCheckBox.checked = (str(settings.value('RawImageGuess/rememberParameters', True)).lower() == 'true')
+    self.ui.compressExportCheckBox.checked = (str(settings.value('RawImageGuess/compressExport', False)).lower() == 'true')
+    self.ui.prefetchCheckBox.checked = (str(settings.value('RawImageGuess/prefetch', False)).lower() == 'true')
 
     self.ui.pixelTypeComboBox.currentText = settings.value('RawImageGuess/pixelType')
     self.ui.endiannessComboBox.currentText = settings.value('RawImageGuess/endianness')
@@ -245,81 +447,297 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
     self.ui.imageSizeYSliderWidget.value = toLong(settings.value('RawImageGuess/sizeY', 200))
     self.ui.imageSizeZSliderWidget.value = toLong(settings.value('RawImageGuess/sizeZ', 1))
     self.ui.skipSlicesSliderWidget.value = toLong(settings.value('RawImageGuess/skipSlices', 0))
+    self.ui.rowStrideSpinBox.value = toLong(settings.value('RawImageGuess/rowStride', 0))
+    self.ui.sliceHeaderSizeSpinBox.value = toLong(settings.value('RawImageGuess/sliceHeaderSize', 0))
+    self.ui.componentLayoutComboBox.currentText = settings.value('RawImageGuess/componentLayout', "interleaved")
     self.ui.imageSpacingXSliderWidget.value = float(settings.value('RawImageGuess/spacingX', 1.0))
     self.ui.imageSpacingYSliderWidget.value = float(settings.value('RawImageGuess/spacingY', 1.0))
     self.ui.imageSpacingZSliderWidget.value = float(settings.value('RawImageGuess/spacingZ', 1.0))
     self.ui.numberOfVolumesSliderWidget.value = toLong(settings.value('RawImageGuess/numberOfVolumes', 1.0))
 
   def onOffsetImageSkipButtonClicked(self, operation, mode):
-    if mode == 'column':
-      offset = 1
-    elif mode == 'row':
-      offset = toLong(self.ui.imageSizeXSliderWidget.value)
-    elif mode == 'slice':
-      offset = toLong(self.ui.imageSizeXSliderWidget.value) * toLong(self.ui.imageSizeYSliderWidget.value)
-    elif mode == 'volume':
-      offset = toLong(self.ui.imageSizeXSliderWidget.value) * toLong(self.ui.imageSizeYSliderWidget.value) * toLong(self.ui.imageSizeZSliderWidget.value)
-
-    (scalarType, numberOfComponents, bigEndian, lsbFirst) = self.scalarTypeComponentBigEndianLsbFirst()
-    if scalarType != vtk.VTK_BIT:
-      offset *=  vtk.vtkDataArray.GetDataTypeSize(scalarType) * numberOfComponents
+    try:
+      offset = self.logic.headerSizeOffset(self.imageParameters(), mode)
+    except ValueError as e:
+      slicer.util.errorDisplay("Failed to offset header size: " + str(e))
+      return
 
     if operation == 'sub':
       self.ui.imageSkipSliderWidget.value -= offset
     else:
       self.ui.imageSkipSliderWidget.value += offset
 
+  def onGuessGeometryButtonClicked(self):
+    if not self.ui.inputFileSelector.currentPath:
+      return
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      self.geometryCandidates = self.logic.guessImageGeometry(
+        self.ui.inputFileSelector.currentPath,
+        headerSize=toLong(self.ui.imageSkipSliderWidget.value),
+        minimumSizeX=toLong(self.ui.imageSizeMin.value),
+        maximumSizeX=toLong(self.ui.imageSizeMax.value))
+      errorMessage = None
+    except Exception as e:
+      self.geometryCandidates = []
+      errorMessage = str(e)
+    qt.QApplication.restoreOverrideCursor()
+    if errorMessage:
+      slicer.util.errorDisplay("Failed to guess image parameters: " + errorMessage)
+
+    wasBlocked = self.ui.guessResultsComboBox.blockSignals(True)
+    self.ui.guessResultsComboBox.clear()
+    for candidate in self.geometryCandidates:
+      pixelType = PixelTypes.pixelTypeName(candidate['scalarType'], candidate['numberOfComponents'])
+      if candidate['scalarType'] != vtk.VTK_BIT and PixelTypes.scalarTypeSize(candidate['scalarType']) > 1:
+        pixelType += ", big endian" if candidate['bigEndian'] else ", little endian"
+      self.ui.guessResultsComboBox.addItem("X dimension: {0} - {1} (score: {2:.2f})".format(
+        candidate['sizeX'], pixelType, candidate['score']))
+    self.ui.guessResultsComboBox.setCurrentIndex(-1)
+    self.ui.guessResultsComboBox.blockSignals(wasBlocked)
+
+    if self.geometryCandidates:
+      self.ui.guessResultsComboBox.setCurrentIndex(0)
+    elif not errorMessage:
+      slicer.util.warningDisplay("No suitable image parameters were found.")
+
+  def onGuessResultSelected(self, index):
+    if index < 0 or index >= len(self.geometryCandidates):
+      return
+    candidate = self.geometryCandidates[index]
+    self.setScalarTypeComponentBigEndianLsbFirst(candidate['scalarType'], candidate['numberOfComponents'],
+      candidate['bigEndian'], candidate['lsbFirst'])
+    self.ui.imageSizeXSliderWidget.value = candidate['sizeX']
+
+  def onDetectHeaderSizeButtonClicked(self):
+    if not self.ui.inputFileSelector.currentPath:
+      return
+    (scalarType, numberOfComponents, bigEndian, lsbFirst) = self.scalarTypeComponentBigEndianLsbFirst()
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      self.headerSizeCandidates = self.logic.detectHeaderSize(
+        self.ui.inputFileSelector.currentPath, scalarType, numberOfComponents, bigEndian,
+        toLong(self.ui.imageSizeXSliderWidget.value), toLong(self.ui.imageSizeYSliderWidget.value),
+        minimumHeaderSize=toLong(self.ui.imageSkipMin.value),
+        maximumHeaderSize=toLong(self.ui.imageSkipMax.value))
+      errorMessage = None
+    except Exception as e:
+      self.headerSizeCandidates = []
+      errorMessage = str(e)
+    qt.QApplication.restoreOverrideCursor()
+    if errorMessage:
+      slicer.util.errorDisplay("Failed to detect header size: " + errorMessage)
+
+    wasBlocked = self.ui.headerSizeResultsComboBox.blockSignals(True)
+    self.ui.headerSizeResultsComboBox.clear()
+    for candidate in self.headerSizeCandidates:
+      self.ui.headerSizeResultsComboBox.addItem("Header size: {0} bytes (score: {1:.2f})".format(
+        candidate['headerSize'], candidate['score']))
+    self.ui.headerSizeResultsComboBox.setCurrentIndex(-1)
+    self.ui.headerSizeResultsComboBox.blockSignals(wasBlocked)
+
+    if self.headerSizeCandidates:
+      # Jump to the best candidate
+      self.ui.headerSizeResultsComboBox.setCurrentIndex(0)
+    elif not errorMessage:
+      slicer.util.warningDisplay("No suitable header size was found.")
+
+  def onHeaderSizeResultSelected(self, index):
+    if index < 0 or index >= len(self.headerSizeCandidates):
+      return
+    self.ui.imageSkipSliderWidget.value = self.headerSizeCandidates[index]['headerSize']
+
+  def onShowContactSheetButtonClicked(self):
+    if not self.ui.inputFileSelector.currentPath:
+      return
+    mode = [mode for mode, name in ContactSheet.contactSheetModes.items() if name == self.ui.contactSheetModeComboBox.currentText][0]
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      contactSheet = self.logic.readContactSheet(self.imageParameters(), mode)
+      errorMessage = None
+    except Exception as e:
+      errorMessage = str(e)
+    qt.QApplication.restoreOverrideCursor()
+    if errorMessage:
+      slicer.util.errorDisplay("Failed to create contact sheet: " + errorMessage)
+      return
+    self.showContactSheet(contactSheet)
+
+  def showContactSheet(self, contactSheet):
+    """Show contact sheet in the Red slice view and apply parameters of a tile when it is clicked"""
+    layoutManager = slicer.app.layoutManager()
+    sliceWidget = layoutManager.sliceWidget('Red') if layoutManager else None
+    if not sliceWidget:
+      return
+    self.contactSheet = contactSheet
+    if not self.contactSheetVolumeNode or not slicer.mrmlScene.IsNodePresent(self.contactSheetVolumeNode):
+      self.contactSheetVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "ContactSheet")
+      # Do not offer the contact sheet as output volume
+      self.contactSheetVolumeNode.SetHideFromEditors(True)
+    self.logic.setContactSheetImage(self.contactSheetVolumeNode, contactSheet)
+    sliceWidget.mrmlSliceNode().SetOrientationToAxial()
+    sliceWidget.mrmlSliceCompositeNode().SetBackgroundVolumeID(self.contactSheetVolumeNode.GetID())
+    sliceWidget.sliceLogic().FitSliceToAll()
+    if not self.contactSheetInteractorObservation:
+      interactor = sliceWidget.sliceView().interactor()
+      tag = interactor.AddObserver(vtk.vtkCommand.LeftButtonPressEvent, self.onContactSheetClicked, 1.0)
+      self.contactSheetInteractorObservation = (interactor, tag)
+
+  def hideContactSheet(self):
+    """Remove contact sheet and show the output volume again"""
+    self.removeContactSheetObserver()
+    if self.contactSheetVolumeNode and slicer.mrmlScene.IsNodePresent(self.contactSheetVolumeNode):
+      slicer.mrmlScene.RemoveNode(self.contactSheetVolumeNode)
+    self.contactSheetVolumeNode = None
+    self.contactSheet = None
+    self.showOutputVolume()
+
+  def removeContactSheetObserver(self):
+    if self.contactSheetInteractorObservation:
+      (interactor, tag) = self.contactSheetInteractorObservation
+      interactor.RemoveObserver(tag)
+      self.contactSheetInteractorObservation = None
+
+  def onContactSheetClicked(self, interactor, event):
+    sliceWidget = slicer.app.layoutManager().sliceWidget('Red')
+    if (not self.contactSheet or not self.contactSheetVolumeNode
+        or sliceWidget.mrmlSliceCompositeNode().GetBackgroundVolumeID() != self.contactSheetVolumeNode.GetID()):
+      # Contact sheet is not shown anymore
+      return
+    # Clicked position -> contact sheet image pixel
+    (x, y) = interactor.GetEventPosition()
+    ras = sliceWidget.mrmlSliceNode().GetXYToRAS().MultiplyPoint((x, y, 0, 1))
+    rasToIjk = vtk.vtkMatrix4x4()
+    self.contactSheetVolumeNode.GetRASToIJKMatrix(rasToIjk)
+    ijk = rasToIjk.MultiplyPoint(ras)
+    candidateIndex = self.contactSheet.candidateIndexAt(int(round(ijk[0])), int(round(ijk[1])))
+    if candidateIndex is None:
+      return
+    candidate = self.contactSheet.candidates[candidateIndex]
+    self.hideContactSheet()
+    self.setScalarTypeComponentBigEndianLsbFirst(candidate['scalarType'], candidate['numberOfComponents'],
+      candidate['bigEndian'], candidate['lsbFirst'])
+    self.ui.imageSizeXSliderWidget.value = candidate['sizeX']
+    self.ui.imageSkipSliderWidget.value = candidate['headerSize']
+
   def onFitToViewsCheckboxClicked(self, enable):
     self.showOutputVolume()
 
   def onUpdateCheckboxClicked(self, enable):
     if enable:
-      self.onUpdate()
-      self.showOutputVolume()
+      self.requestUpdate()
 
   def onUpdateButtonClicked(self):
     if self.ui.updateButton.checkState == qt.Qt.Checked:
       # If update button is untoggled then make it unchecked, too
       self.ui.updateButton.checkState = qt.Qt.Unchecked
     self.onUpdate()
-    self.showOutputVolume()
+    self.saveParametersToIndex()
 
   def onGenerateNrrdHeaderButtonClicked(self):
     if not self.ui.generateNrrdHeaderButton.enabled:
       return
     if not self.ui.inputFileSelector.currentPath:
       return
-    (scalarType, numberOfComponents, bigEndian, lsbFirst) = self.scalarTypeComponentBigEndianLsbFirst()
-    if scalarType == vtk.VTK_BIT:
-      slicer.util.errorDisplay("NRRD file format cannot store 1 bit per pixel images. Read the image and then save it into a new file.")
-      return
     self.saveParametersToSettings()
-    generatedFilename = self.logic.generateImageHeader(
-      self.ui.outputVolumeNodeSelector.currentNode(),
-      self.ui.inputFileSelector.currentPath,
-      scalarType,
-      numberOfComponents,
-      bigEndian,
-      lsbFirst,
-      toLong(self.ui.imageSizeXSliderWidget.value),
-      toLong(self.ui.imageSizeYSliderWidget.value),
-      toLong(self.ui.imageSizeZSliderWidget.value),
-      toLong(self.ui.imageSkipSliderWidget.value),
-      toLong(self.ui.skipSlicesSliderWidget.value),
-      float(self.ui.imageSpacingXSliderWidget.value),
-      float(self.ui.imageSpacingYSliderWidget.value),
-      float(self.ui.imageSpacingZSliderWidget.value),
-      toLong(self.ui.numberOfVolumesSliderWidget.value)
-      )
-    slicer.util.delayDisplay("Image header file created at "+generatedFilename, autoCloseMsec=2000)
+    # Images that NRRD headers cannot describe (1bpp, padded rows, slice headers, planar components) are exported
+    progressDialog = None
+    progressCallback = None
+    if not self.logic.isImageHeaderSupported(**self.imageParameters()):
+      progressDialog = slicer.util.createProgressDialog(labelText="Exporting image (NRRD header cannot describe its layout)", maximum=100)
+      def updateExportProgress(fraction):
+        progressDialog.value = int(fraction * 100)
+        slicer.app.processEvents()
+        return not progressDialog.wasCanceled
+      progressCallback = updateExportProgress
+    try:
+      generatedFilename = self.logic.generateImageHeader(
+        self.ui.outputVolumeNodeSelector.currentNode(),
+        spacingX=float(self.ui.imageSpacingXSliderWidget.value),
+        spacingY=float(self.ui.imageSpacingYSliderWidget.value),
+        spacingZ=float(self.ui.imageSpacingZSliderWidget.value),
+        numberOfVolumes=toLong(self.ui.numberOfVolumesSliderWidget.value),
+        progressCallback=progressCallback,
+        **self.imageParameters()
+        )
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to generate image header: " + str(e))
+      return
+    finally:
+      if progressDialog:
+        progressDialog.close()
+    if not generatedFilename:
+      # Export has been cancelled
+      return
+    self.saveParametersToIndex()
+    if progressCallback:
+      slicer.util.delayDisplay("Image exported to "+generatedFilename, autoCloseMsec=2000)
+    else:
+      slicer.util.delayDisplay("Image header file created at "+generatedFilename, autoCloseMsec=2000)
 
-  def onUpdate(self):
-    if not self.ui.updateButton.enabled:
+  def onExportNrrdButtonClicked(self):
+    imageFilePath = self.ui.inputFileSelector.currentPath
+    if not imageFilePath:
+      return
+    numberOfVolumes = toLong(self.ui.numberOfVolumesSliderWidget.value)
+    defaultOutputFilePath = NrrdHeader.outputFileBaseName(imageFilePath) + (".seq.nrrd" if numberOfVolumes > 1 else ".nrrd")
+    outputFilePath = qt.QFileDialog.getSaveFileName(slicer.util.mainWindow(), "Export NRRD file", defaultOutputFilePath,
+      "NRRD file (*.nrrd);;NRRD header and raw data file (*.nhdr)")
+    if not outputFilePath:
+      return
+    self.saveParametersToSettings()
+    progressDialog = slicer.util.createProgressDialog(labelText="Exporting image to " + outputFilePath, maximum=100)
+    def onProgress(fraction):
+      progressDialog.value = int(fraction * 100)
+      slicer.app.processEvents()
+      return not progressDialog.wasCanceled
+    (spacingX, spacingY, spacingZ) = self.imageSpacing()
+    try:
+      export = self.logic.exportImage(outputFilePath, spacingX=spacingX, spacingY=spacingY, spacingZ=spacingZ,
+        numberOfVolumes=numberOfVolumes, compress=self.ui.compressExportCheckBox.checked, progressCallback=onProgress,
+        **self.imageParameters())
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to export image: " + str(e))
+      return
+    finally:
+      progressDialog.close()
+    if export['cancelled']:
       return
+    self.saveParametersToIndex()
+    megabytesRead = export['bytesRead'] / (1024.0 * 1024.0)
+    message = "Image exported to {0} ({1:.1f} MB read in {2:.1f} s, {3:.1f} MB/s)".format(outputFilePath,
+      megabytesRead, export['time'], megabytesRead / max(export['time'], 1e-6))
+    logging.info(message)
+    slicer.util.delayDisplay(message, autoCloseMsec=2000)
+
+  def imageParameters(self):
+    """Returns parameters for reading the image (keyword arguments of RawImageGuessLogic.readImage)"""
+    (scalarType, numberOfComponents, bigEndian, lsbFirst) = self.scalarTypeComponentBigEndianLsbFirst()
+    return {
+      'imageFilePath': self.ui.inputFileSelector.currentPath,
+      'scalarType': scalarType,
+      'numberOfComponents': numberOfComponents,
+      'bigEndian': bigEndian,
+      'lsbFirst': lsbFirst,
+      'sizeX': toLong(self.ui.imageSizeXSliderWidget.value),
+      'sizeY': toLong(self.ui.imageSizeYSliderWidget.value),
+      'sizeZ': toLong(self.ui.imageSizeZSliderWidget.value),
+      'headerSize': toLong(self.ui.imageSkipSliderWidget.value),
+      'skipSlices': toLong(self.ui.skipSlicesSliderWidget.value),
+      'rowStride': self.ui.rowStrideSpinBox.value,
+      'sliceHeaderSize': self.ui.sliceHeaderSizeSpinBox.value,
+      'planar': self.ui.componentLayoutComboBox.currentText == "planar",
+      }
+
+  def imageSpacing(self):
+    return (float(self.ui.imageSpacingXSliderWidget.value),
+      float(self.ui.imageSpacingYSliderWidget.value),
+      float(self.ui.imageSpacingZSliderWidget.value))
 
+  def prepareOutputVolume(self):
+    """Returns output volume node, creates a new one if needed"""
     # Determine if we need to create a new volume
     createNewVolume = False
-    pixelTypeString = self.ui.pixelTypeComboBox.currentText
     (scalarType, numberOfComponents, bigEndian, lsbFirst) = self.scalarTypeComponentBigEndianLsbFirst()
     if not self.ui.outputVolumeNodeSelector.currentNode():
       createNewVolume = True
@@ -328,26 +746,154 @@ class RawImageGuessWidget(ScriptedLoadableModuleWidget):
         createNewVolume = True
     if createNewVolume:
       self.ui.outputVolumeNodeSelector.addNode("vtkMRMLScalarVolumeNode" if numberOfComponents == 1 else "vtkMRMLVectorVolumeNode")
+    return self.ui.outputVolumeNodeSelector.currentNode()
+
+  def onUpdate(self):
+    if not self.ui.updateButton.enabled:
+      return
+
+    outputVolumeNode = self.prepareOutputVolume()
 
     if not self.ui.inputFileSelector.currentPath:
       return
     self.saveParametersToSettings()
-    self.logic.updateImage(
-      self.ui.outputVolumeNodeSelector.currentNode(),
-      self.ui.inputFileSelector.currentPath,
-      scalarType,
-      numberOfComponents,
-      bigEndian,
-      lsbFirst,
-      toLong(self.ui.imageSizeXSliderWidget.value),
-      toLong(self.ui.imageSizeYSliderWidget.value),
-      toLong(self.ui.imageSizeZSliderWidget.value),
-      toLong(self.ui.imageSkipSliderWidget.value),
-      toLong(self.ui.skipSlicesSliderWidget.value),
-      float(self.ui.imageSpacingXSliderWidget.value),
-      float(self.ui.imageSpacingYSliderWidget.value),
-      float(self.ui.imageSpacingZSliderWidget.value)
-      )
+    # Results of previously requested background reads are outdated now
+    self.backgroundReader.cancel()
+    self.prefetcher.cancel()
+    (spacingX, spacingY, spacingZ) = self.imageSpacing()
+    profile = self.logic.startProfile("Update")
+    with Instrumentation.activeProfile(profile):
+      self.logic.updateImage(outputVolumeNode,
+        spacingX=spacingX, spacingY=spacingY, spacingZ=spacingZ,
+        numberOfVolumes=toLong(self.ui.numberOfVolumesSliderWidget.value),
+        decimation=self.ui.downsamplingSpinBox.value,
+        **self.imageParameters())
+      with Instrumentation.stage('display'):
+        self.showOutputVolume()
+    self.logic.finishProfile(profile)
+    self.updateResultCacheStatistics()
+    self.statisticsRefinementTimer.start(1000)
+    self.prefetchLikelyParameters()
+
+  def requestUpdate(self, preview=False):
+    """Read image on a background thread and show it in the output volume when completed.
+    If parameters change while reading then only the image with the latest parameters is shown.
+    If preview is enabled then only the part of the image that is selected in preview mode is read.
+    """
+    if not preview:
+      self.fullUpdateTimer.stop()
+    self.statisticsRefinementTimer.stop()
+    # Reading predicted images would slow down reading the requested image
+    self.prefetcher.cancel()
+    if not self.ui.updateButton.enabled:
+      return
+
+    outputVolumeNode = self.prepareOutputVolume()
+
+    if not self.ui.inputFileSelector.currentPath:
+      return
+    if toLong(self.ui.numberOfVolumesSliderWidget.value) > 1:
+      # Multi-volume images are loaded as a sequence, which only reads the displayed frame
+      # (and prefetches its neighbors on a background thread)
+      self.onUpdate()
+      return
+    self.logic.removeImageSequence()
+    self.saveParametersToSettings()
+    parameters = self.imageParameters()
+    if self.ui.downsamplingSpinBox.value > 1:
+      parameters['decimation'] = self.ui.downsamplingSpinBox.value
+    if preview:
+      parameters.update(self.previewParameters(parameters))
+    # Stages on the background thread and the display of the result are recorded in the same profile
+    parameters['profile'] = self.logic.startProfile("Preview" if preview else "Update")
+    self.backgroundReader.requestRead(parameters, (outputVolumeNode, self.imageSpacing()))
+    self.backgroundReaderTimer.start()
+
+  def previewParameters(self, parameters):
+    """Returns extent or decimation parameters for reading a quick preview"""
+    sizeX, sizeY, sizeZ = parameters['sizeX'], parameters['sizeY'], parameters['sizeZ']
+    if self.ui.previewModeComboBox.currentText == "Current slice":
+      sliceIndex = self.currentSliceIndex(sizeZ)
+      return {'extent': [0, sizeX-1, 0, sizeY-1, sliceIndex, sliceIndex]}
+    # Downsampled: decimate along all non-singleton axes to get approximately previewNumberOfVoxels voxels
+    imageSizes = [size for size in (sizeX, sizeY, sizeZ) if size > 1]
+    numberOfVoxels = sizeX * sizeY * sizeZ
+    if not imageSizes or numberOfVoxels <= self.previewNumberOfVoxels:
+      return {}
+    import math
+    decimation = int(math.ceil((float(numberOfVoxels) / self.previewNumberOfVoxels) ** (1.0 / len(imageSizes))))
+    return {'decimation': max(decimation, parameters.get('decimation', 1))}
+
+  def currentSliceIndex(self, sizeZ):
+    """Index of the image slice shown in the Red slice view (middle slice if there is no Red slice view)"""
+    spacingZ = self.imageSpacing()[2]
+    layoutManager = slicer.app.layoutManager()
+    sliceWidget = layoutManager.sliceWidget('Red') if layoutManager else None
+    if not sliceWidget or spacingZ <= 0:
+      return sizeZ // 2
+    # Output volume origin is at the first slice, slices are stacked along the Superior axis
+    sliceOffset = sliceWidget.mrmlSliceNode().GetSliceToRAS().GetElement(2, 3)
+    sliceIndex = int(round(sliceOffset / spacingZ))
+    return min(max(sliceIndex, 0), sizeZ - 1)
+
+  def onBackgroundReaderTimeout(self):
+    result = self.backgroundReader.takeResult()
+    if result is None:
+      if not self.backgroundReader.isBusy():
+        self.backgroundReaderTimer.stop()
+      return
+    (parameters, (outputVolumeNode, (spacingX, spacingY, spacingZ)), voxels, exception) = result
+    if exception is not None:
+      logging.error("Failed to read image: {0}".format(exception))
+      return
+    if outputVolumeNode != self.ui.outputVolumeNodeSelector.currentNode():
+      # Output volume has been changed since the read was requested
+      return
+    profile = parameters.get('profile')
+    with Instrumentation.activeProfile(profile):
+      self.logic.setImage(outputVolumeNode, voxels, spacingX, spacingY, spacingZ,
+        parameters.get('extent'), parameters.get('decimation', 1))
+      with Instrumentation.stage('display'):
+        self.showOutputVolume()
+    self.logic.finishProfile(profile)
+    self.updateResultCacheStatistics()
+    if not self.backgroundReader.isBusy():
+      self.statisticsRefinementTimer.start(1000)
+      if not self.fullUpdateTimer.isActive() and 'extent' not in parameters:
+        # Full image is displayed (not a preview)
+        self.prefetchLikelyParameters()
+
+  def isFullImageCached(self):
+    """Returns True if the image with the current parameters is in the result cache"""
+    if not self.ui.inputFileSelector.currentPath or toLong(self.ui.numberOfVolumesSliderWidget.value) > 1:
+      return False
+    parameters = self.imageParameters()
+    if self.ui.downsamplingSpinBox.value > 1:
+      parameters['decimation'] = self.ui.downsamplingSpinBox.value
+    try:
+      return self.logic.reader.resultCache.contains(self.logic.reader.resultKey(**parameters))
+    except OSError:
+      return False
+
+  def prefetchLikelyParameters(self):
+    """Start reading images with likely next parameters on a background thread (if prefetching is enabled)"""
+    if not self.prefetchEnabled or not self.ui.inputFileSelector.currentPath:
+      return
+    if toLong(self.ui.numberOfVolumesSliderWidget.value) > 1:
+      # Frames of multi-volume images are read by the sequence reader
+      return
+    parameters = self.imageParameters()
+    if self.ui.downsamplingSpinBox.value > 1:
+      parameters['decimation'] = self.ui.downsamplingSpinBox.value
+    self.prefetcher.prefetch(self.logic.likelyParameters(parameters))
+
+  def onStatisticsRefinementTimeout(self):
+    if self.backgroundReader.isBusy() or self.fullUpdateTimer.isActive():
+      # Parameters are being changed
+      return
+    if self.logic.refineImageStatistics():
+      # Continue soon, leaving time for processing user input between steps
+      self.statisticsRefinementTimer.start(50)
 
 #
 # RawImageGuessLogic
@@ -364,171 +910,462 @@ class RawImageGuessLogic(ScriptedLoadableModuleLogic):
   """
 
   def __init__(self):
-    self.reader = vtk.vtkImageReader2()
+    # Reading and guessing is implemented in RawImageGuessLib (that does not require Slicer),
+    # this class transfers the results into MRML nodes.
+    self.reader = ImageReader.ImageReader()
+    # If enabled then startProfile returns a profile that records time, bytes read, and allocated memory
+    # of each stage of an update, and observers are notified with the profile when the update is finished
+    self._profilingEnabled = False
+    self.profileObservers = []
+    # Multi-volume image that is shown as a sequence (see updateImageSequence)
+    self.sequenceReader = None
+    self.sequenceBrowserNode = None
+    self.sequenceBrowserObserverTag = None
+    self.sequenceOutputVolumeNode = None
+    self.sequenceSpacing = None
+    self.sequenceDisplayedFrameIndex = None
+    # Window/level of scalar output volumes is set from statistics of a sample of the voxels,
+    # which is much faster than the automatic window/level of Slicer (computed from all voxels)
+    # and ignores non-finite values. Statistics of the last image are refined by refineImageStatistics.
+    self.statisticsEnabled = True
+    self.numberOfStatisticsSamples = 64*1024
+    self.imageStatistics = None
+    self.imageStatisticsVolumeNode = None
+    # Volume node ID -> (window, level) that was set from statistics (it is not changed if the user has changed it)
+    self.statisticsWindowLevels = {}
+
+  @property
+  def profilingEnabled(self):
+    return self._profilingEnabled
+
+  @profilingEnabled.setter
+  def profilingEnabled(self, enable):
+    self._profilingEnabled = enable
+    if not enable:
+      # Memory tracking slows down all allocations in the application, therefore it is only on while profiling
+      Instrumentation.stopMemoryTracking()
+
+  def addProfileObserver(self, callback):
+    """Add a function that is called with the Instrumentation.Profile of each finished update"""
+    if callback not in self.profileObservers:
+      self.profileObservers.append(callback)
+
+  def removeProfileObserver(self, callback):
+    if callback in self.profileObservers:
+      self.profileObservers.remove(callback)
+
+  def startProfile(self, name):
+    """Returns a new profile for an update, or None if profiling is disabled.
+    Activate the profile (using Instrumentation.activeProfile or the profile argument of readImage)
+    while the update is performed and call finishProfile when the update is completed.
+    """
+    if not self.profilingEnabled:
+      return None
+    return Instrumentation.Profile(name, trackMemory=True)
+
+  def finishProfile(self, profile):
+    """Set total time of the update and notify observers"""
+    if profile is None:
+      return
+    profile.finish()
+    for callback in list(self.profileObservers):
+      callback(profile)
 
   def newImage(self):
-    # If a new image is selected then we create an independent reader
-    # (to prevent overwriting previous volumes with updateImage).
-    # We do not create a new reader on each updateImage to improve performence
-    # (avoid reallocation of the image).
-    self.reader = vtk.vtkImageReader2()
+    # updateImage reuses the image data object of the output volume and gives its previous voxel array back
+    # to the buffer pool of the reader, which overwrites it when the next image is read (see setImageArray).
+    # Previously loaded volumes are still not overwritten, because arrays that are used by any volume
+    # in the scene are not given back (see isArrayUsedByVolume), therefore there is nothing to reset.
+    pass
 
   def updateImage(self, outputVolumeNode, imageFilePath,
     scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
-    spacingX, spacingY, spacingZ):
+    spacingX, spacingY, spacingZ, numberOfVolumes=1, extent=None, decimation=1, rowStride=0, sliceHeaderSize=0, planar=False):
     """
-    Reads image into output volume
+    Reads image into output volume.
+    Rows may be padded to rowStride bytes, each slice may start with a header of sliceHeaderSize bytes,
+    and components may be stored in planes (see PixelTypes.sliceSize).
+    Optionally, only a sub-extent ([xMin, xMax, yMin, yMax, zMin, zMax] voxel index range) is read
+    and only every decimation-th voxel is kept (decimation can be specified for all axes or per axis).
+    Skipped voxels are not read from the file and the image geometry is adjusted to keep the voxels at their
+    original physical position.
+    If numberOfVolumes > 1 then the image is loaded as a sequence (see updateImageSequence),
+    extent and decimation are ignored in this case.
     """
+    if numberOfVolumes > 1:
+      self.updateImageSequence(outputVolumeNode, imageFilePath,
+        scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+        spacingX, spacingY, spacingZ, numberOfVolumes, rowStride, sliceHeaderSize, planar)
+      return
+    self.removeImageSequence()
+    voxels = self.readImage(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation,
+      rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
+    self.setImage(outputVolumeNode, voxels, spacingX, spacingY, spacingZ, extent, decimation)
 
-    if scalarType == vtk.VTK_BIT:
-      # Special case: 1bpp input (expanded to 8-bit unsigned char)
-      import os
-      import numpy as np
-
-      # Compute data sizes in bytes for bit-packed rows/slices
-      bytesPerRow = (sizeX + 7) // 8
-      bytesPerSlice = bytesPerRow * sizeY
-      totalHeaderSize = headerSize + skipSlices * bytesPerSlice
-
-      totalFilesize = os.path.getsize(imageFilePath)
-      voxelDataSize = max(0, totalFilesize - totalHeaderSize)
-      maxNumberOfSlices = int(voxelDataSize // bytesPerSlice)
-      finalSizeZ = int(min(sizeZ, maxNumberOfSlices))
-
-      # Read packed bits for the requested volume
-      with open(imageFilePath, 'rb') as f:
-        f.seek(totalHeaderSize)
-        raw = f.read(bytesPerSlice * finalSizeZ)
-      packed = np.frombuffer(raw, dtype=np.uint8)
-      if packed.size == 0:
-        raise ValueError("No voxel data available at specified header offset/size for 1bpp input")
-
-      # Unpack bits: default MSB-first within each byte. If LSB-first requested, use NumPy's bitorder.
-      if lsbFirst:
-        bitsFlat = np.unpackbits(packed, bitorder='little')
-      else:
-        bitsFlat = np.unpackbits(packed, bitorder='big')
-
-      bits = bitsFlat.reshape(finalSizeZ, sizeY, bytesPerRow, 8)
-      rowBits = bits.reshape(finalSizeZ, sizeY, bytesPerRow * 8)[..., :sizeX]
-      arr8 = (rowBits.astype(np.uint8) * 255)
-
-      # Import into the output volume node
-      slicer.util.updateVolumeFromArray(outputVolumeNode, arr8)
-
+  def updateImageSequence(self, outputVolumeNode, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    spacingX, spacingY, spacingZ, numberOfVolumes, rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Loads a multi-volume (4D) image as a sequence. The output volume is the proxy node of the sequence
+    and voxels of a frame are read from the file only when the frame is displayed, therefore only a few frames
+    are kept in memory. Returns the sequence browser node.
+    """
+    # Sequence and browser nodes are reused when image parameters change, so that the selected frame is kept
+    browserNode = self.sequenceBrowserNode
+    if (browserNode and slicer.mrmlScene.IsNodePresent(browserNode) and browserNode.GetMasterSequenceNode()
+        and self.sequenceOutputVolumeNode == outputVolumeNode):
+      sequenceNode = browserNode.GetMasterSequenceNode()
     else:
-      # Default path for byte-aligned pixel types
-      sliceSize = sizeX * sizeY * vtk.vtkDataArray.GetDataTypeSize(scalarType) * numberOfComponents
-      totalHeaderSize = headerSize + skipSlices * sliceSize
-      import os
-      totalFilesize = os.path.getsize(imageFilePath)
-      voxelDataSize = totalFilesize - totalHeaderSize
-      maxNumberOfSlices = int(voxelDataSize/sliceSize)
-      finalSizeZ = min(sizeZ, maxNumberOfSlices)
-
-      self.reader.SetFileName(imageFilePath)
-      self.reader.SetFileDimensionality(3)
-      self.reader.SetDataExtent(0, sizeX-1, 0, sizeY-1, 0, finalSizeZ-1)
-      if bigEndian:
-        self.reader.SetDataByteOrderToBigEndian()
+      self.removeImageSequence()
+      sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", outputVolumeNode.GetName() + " sequence")
+      browserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode", outputVolumeNode.GetName() + " browser")
+      browserNode.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+      self.sequenceBrowserNode = browserNode
+      # The frame is read after the browser has copied the (empty) data node of the frame into the proxy node
+      indexDisplayedEvent = getattr(slicer.vtkMRMLSequenceBrowserNode, 'IndexDisplayedEvent', None)
+      if indexDisplayedEvent is not None:
+        self.sequenceBrowserObserverTag = browserNode.AddObserver(indexDisplayedEvent, self.onSequenceBrowserModified)
       else:
-        self.reader.SetDataByteOrderToLittleEndian()
-      self.reader.SetDataScalarType(scalarType)
-      self.reader.SetNumberOfScalarComponents(numberOfComponents)
-      self.reader.SetHeaderSize(totalHeaderSize)
-      self.reader.SetFileLowerLeft(True) # to match input from NRRD reader
-      self.reader.Update()
-      outputVolumeNode.SetImageDataConnection(self.reader.GetOutputPort())
+        self.sequenceBrowserObserverTag = browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSequenceBrowserModified, -10.0)
+
+    if self.sequenceReader:
+      self.sequenceReader.stop()
+    self.sequenceReader = VolumeSequenceReader.VolumeSequenceReader(self.reader, imageFilePath,
+      scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices, numberOfVolumes,
+      rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
+    self.sequenceOutputVolumeNode = outputVolumeNode
+    self.sequenceSpacing = (spacingX, spacingY, spacingZ)
+    self.sequenceDisplayedFrameIndex = None
+
+    # Data nodes of the sequence do not contain image data, voxels are read when a frame is displayed
+    numberOfFrames = self.sequenceReader.numberOfFrames
+    sequenceNode.RemoveAllDataNodes()
+    sequenceNode.SetIndexName("frame")
+    sequenceNode.SetIndexUnit("")
+    sequenceNode.SetIndexType(slicer.vtkMRMLSequenceNode.NumericIndex)
+    frameNode = slicer.vtkMRMLScalarVolumeNode() if numberOfComponents == 1 else slicer.vtkMRMLVectorVolumeNode()
+    for frameIndex in range(numberOfFrames):
+      sequenceNode.SetDataNodeAtValue(frameNode, str(frameIndex))
+    if browserNode.GetProxyNode(sequenceNode) != outputVolumeNode:
+      browserNode.AddProxyNode(outputVolumeNode, sequenceNode, False)
+    browserNode.SetOverwriteProxyName(sequenceNode, False)
+    browserNode.SetSaveChanges(sequenceNode, False)
+
+    selectedFrameIndex = min(max(browserNode.GetSelectedItemNumber(), 0), numberOfFrames - 1)
+    browserNode.SetSelectedItemNumber(selectedFrameIndex)
+    self.showSequenceFrame(selectedFrameIndex)
+    return browserNode
+
+  def removeImageSequence(self, removeNodes=True):
+    """Stop reading frames of the current multi-volume image and remove its sequence and sequence browser nodes.
+    The output volume keeps the currently displayed frame.
+    """
+    if self.sequenceReader:
+      self.sequenceReader.stop()
+      self.sequenceReader = None
+    browserNode = self.sequenceBrowserNode
+    if browserNode:
+      browserNode.RemoveObserver(self.sequenceBrowserObserverTag)
+      if removeNodes and slicer.mrmlScene.IsNodePresent(browserNode):
+        sequenceNode = browserNode.GetMasterSequenceNode()
+        slicer.mrmlScene.RemoveNode(browserNode)
+        if sequenceNode:
+          slicer.mrmlScene.RemoveNode(sequenceNode)
+    self.sequenceBrowserNode = None
+    self.sequenceBrowserObserverTag = None
+    self.sequenceOutputVolumeNode = None
+    self.sequenceDisplayedFrameIndex = None
+
+  def onSequenceBrowserModified(self, browserNode, event):
+    frameIndex = browserNode.GetSelectedItemNumber()
+    if not self.sequenceReader or frameIndex < 0 or frameIndex >= self.sequenceReader.numberOfFrames:
+      return
+    if frameIndex == self.sequenceDisplayedFrameIndex and self.sequenceOutputVolumeNode.GetImageData():
+      # Browser node is modified for other reasons (such as playback settings)
+      return
+    try:
+      self.showSequenceFrame(frameIndex)
+    except Exception as e:
+      logging.error("Failed to read frame {0}: {1}".format(frameIndex, e))
+
+  def showSequenceFrame(self, frameIndex):
+    """Read a frame of the multi-volume image (if it is not read yet) and show it in the output volume"""
+    voxels = self.sequenceReader.getFrame(frameIndex)
+    (spacingX, spacingY, spacingZ) = self.sequenceSpacing
+    self.setImage(self.sequenceOutputVolumeNode, voxels, spacingX, spacingY, spacingZ)
+    self.sequenceDisplayedFrameIndex = frameIndex
+
+  def readImage(self, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    extent=None, decimation=1, profile=None, rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Reads image voxels into a (sizeZ, sizeY, sizeX, numberOfComponents) NumPy array.
+    See ImageReader.readImage for details. Can be called from a background thread.
+    If a profile is specified then stages of reading are recorded in it.
+    """
+    if profile is None:
+      # Stages are recorded in the profile that is active in the current thread (if any)
+      return self.reader.readImage(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+        sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation,
+        rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
+    with Instrumentation.activeProfile(profile):
+      return self.reader.readImage(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+        sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation,
+        rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
+
+  def setImage(self, outputVolumeNode, voxels, spacingX, spacingY, spacingZ, extent=None, decimation=1):
+    """
+    Sets voxels read by readImage as image data of the output volume.
+    Extent and decimation must be the same as the values used in readImage.
+    """
+    with Instrumentation.stage('vtkImport'):
+      self.setImageArray(outputVolumeNode, voxels)
+
+    (decimationX, decimationY, decimationZ) = ImageReader.decimationFactors(decimation)
+    (originI, originJ, originK) = (0, 0, 0)
+    if extent is not None:
+      (originI, originJ, originK) = (max(0, extent[0]), max(0, extent[2]), max(0, extent[4]))
 
     # We assume file is in LPS and invert first and second axes
     # to get volume in RAS.
     ijkToRas = vtk.vtkMatrix4x4()
-    ijkToRas.SetElement(0,0, -spacingX)
-    ijkToRas.SetElement(1,1, -spacingY)
-    ijkToRas.SetElement(2,2, spacingZ)
-    outputVolumeNode.SetIJKToRASMatrix(ijkToRas)
-    outputVolumeNode.Modified()
+    ijkToRas.SetElement(0,0, -spacingX * decimationX)
+    ijkToRas.SetElement(1,1, -spacingY * decimationY)
+    ijkToRas.SetElement(2,2, spacingZ * decimationZ)
+    # Position of the first voxel that has been read
+    ijkToRas.SetElement(0,3, -spacingX * originI)
+    ijkToRas.SetElement(1,3, -spacingY * originJ)
+    ijkToRas.SetElement(2,3, spacingZ * originK)
+    with Instrumentation.stage('geometry'):
+      outputVolumeNode.SetIJKToRASMatrix(ijkToRas)
+      outputVolumeNode.Modified()
+
+    if self.statisticsEnabled and voxels.shape[3] == 1:
+      with Instrumentation.stage('statistics'):
+        self.imageStatistics = ImageStatistics.SampledStatistics(voxels)
+        self.imageStatistics.addSamples(self.numberOfStatisticsSamples)
+        self.imageStatisticsVolumeNode = outputVolumeNode
+        self.setWindowLevelFromStatistics(outputVolumeNode, self.imageStatistics)
+
+  def setWindowLevelFromStatistics(self, volumeNode, statistics):
+    """Set window/level of the volume to the robust range of voxel values, and turn off automatic window/level,
+    unless the user has changed the window/level since it was last set from statistics"""
+    if statistics.windowRange is None:
+      # No finite voxel values
+      return
+    volumeNode.CreateDefaultDisplayNodes()
+    displayNode = volumeNode.GetDisplayNode()
+    if not displayNode or not displayNode.IsA('vtkMRMLScalarVolumeDisplayNode'):
+      return
+    previousWindowLevel = self.statisticsWindowLevels.get(volumeNode.GetID())
+    if not displayNode.GetAutoWindowLevel() and previousWindowLevel != (displayNode.GetWindow(), displayNode.GetLevel()):
+      return
+    (lower, upper) = statistics.windowRange
+    if upper <= lower:
+      # Constant image
+      (lower, upper) = (lower - 0.5, upper + 0.5)
+    wasModified = displayNode.StartModify()
+    displayNode.SetAutoWindowLevel(False)
+    displayNode.SetWindowLevelMinMax(lower, upper)
+    displayNode.EndModify(wasModified)
+    self.statisticsWindowLevels[volumeNode.GetID()] = (displayNode.GetWindow(), displayNode.GetLevel())
+
+  def refineImageStatistics(self, numberOfSamples=128*1024):
+    """Sample more voxels of the last image that has been set by setImage and update window/level of its volume.
+    Returns True if statistics can be refined further.
+    """
+    statistics = self.imageStatistics
+    volumeNode = self.imageStatisticsVolumeNode
+    if statistics is None or not volumeNode or not slicer.mrmlScene.IsNodePresent(volumeNode):
+      return False
+    imageData = volumeNode.GetImageData()
+    scalars = imageData.GetPointData().GetScalars() if imageData else None
+    if getattr(scalars, '_numpyReference', None) is not statistics.voxels:
+      # Volume shows a different image now (the voxel array may have been reused)
+      self.imageStatistics = None
+      return False
+    if not statistics.addSamples(numberOfSamples):
+      return False
+    self.setWindowLevelFromStatistics(volumeNode, statistics)
+    return statistics.isRefinable()
+
+  def setImageArray(self, outputVolumeNode, voxels):
+    """
+    Sets a (sizeZ, sizeY, sizeX, numberOfComponents) C-contiguous NumPy array as image data of the output volume.
+    Voxel data is not copied, the image data keeps a reference to the array.
+    If the output volume already has image data of the same size and scalar type then only its voxel array
+    is replaced (the image data object is reused). The previous voxel array is given back to the image reader,
+    which reuses its memory for reading the next image, therefore arrays that were obtained from the output volume
+    (for example, using slicer.util.arrayFromVolume) must not be used after the next update.
+    """
+    sizeZ, sizeY, sizeX, numberOfComponents = voxels.shape
+    scalarType = PixelTypes.scalarTypeFromNumpyDtype(voxels.dtype)
+    voxelsFlat = voxels.reshape(-1)
+    imageData = outputVolumeNode.GetImageData()
+    scalars = imageData.GetPointData().GetScalars() if imageData else None
+    previousVoxels = getattr(scalars, '_numpyReference', None) if scalars else None
+    if (previousVoxels is None or imageData.GetDimensions() != (sizeX, sizeY, sizeZ)
+        or scalars.GetDataType() != scalarType or scalars.GetNumberOfComponents() != numberOfComponents):
+      scalars = vtk.vtkDataArray.CreateDataArray(scalarType)
+      scalars.SetNumberOfComponents(numberOfComponents)
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(sizeX, sizeY, sizeZ)
+      imageData.GetPointData().SetScalars(scalars)
+      newImageData = True
+    else:
+      newImageData = False
+    # Last argument (1) tells the array not to deallocate the memory, the array is kept alive by the reference below
+    scalars.SetVoidArray(voxelsFlat, voxelsFlat.size, 1)
+    scalars._numpyReference = voxels
+    if newImageData:
+      outputVolumeNode.SetAndObserveImageData(imageData)
+    else:
+      scalars.Modified()
+      imageData.Modified()
+    if previousVoxels is not None and previousVoxels is not voxels and not self.isArrayUsedByVolume(previousVoxels):
+      self.reader.releaseImage(previousVoxels)
+
+  def isArrayUsedByVolume(self, voxels):
+    """Returns True if the array is the voxel array of a volume in the scene (the same image can be shown
+    in multiple volumes if it is returned from the result cache)"""
+    for volumeNode in slicer.util.getNodesByClass('vtkMRMLVolumeNode'):
+      imageData = volumeNode.GetImageData()
+      scalars = imageData.GetPointData().GetScalars() if imageData else None
+      if scalars and getattr(scalars, '_numpyReference', None) is voxels:
+        return True
+    return False
+
+  def guessImageGeometry(self, imageFilePath, headerSize=0, minimumSizeX=2, maximumSizeX=1200):
+    """
+    Guess image row length (sizeX) and pixel type by analyzing a sample of the file.
+    See Guessing.guessImageGeometry for details.
+    """
+    return Guessing.guessImageGeometry(imageFilePath, headerSize, minimumSizeX, maximumSizeX,
+      blockCache=self.reader.blockCache)
+
+  def detectHeaderSize(self, imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY,
+    minimumHeaderSize=0, maximumHeaderSize=10000):
+    """
+    Find the most plausible header sizes (byte skip) for known pixel type and image size.
+    See Guessing.detectHeaderSize for details.
+    """
+    return Guessing.detectHeaderSize(imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY,
+      minimumHeaderSize, maximumHeaderSize, blockCache=self.reader.blockCache)
+
+  def headerSizeOffset(self, parameters, mode):
+    """Returns the size of a column, row, slice, or volume (mode) of the file in bytes, as it is read by the reader
+    (including padding and slice headers, rows of 1 bit images are padded to whole bytes).
+    parameters are keyword arguments of readImage. Raises ValueError if rows do not fit into the row stride.
+    """
+    scalarType = parameters['scalarType']
+    numberOfComponents = parameters['numberOfComponents']
+    if mode == 'column':
+      return PixelTypes.packedRowSize(scalarType, numberOfComponents, 1, parameters['planar'])
+    if mode == 'row':
+      return PixelTypes.rowStrideInBytes(scalarType, numberOfComponents, parameters['sizeX'],
+        parameters['rowStride'], parameters['planar'])
+    sliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, parameters['sizeX'], parameters['sizeY'],
+      parameters['rowStride'], parameters['sliceHeaderSize'], parameters['planar'])
+    return sliceSize * parameters['sizeZ'] if mode == 'volume' else sliceSize
+
+  def likelyParameters(self, parameters):
+    """Returns image parameters that the user is likely to select next (most likely first):
+    header size offset by one column or row, X dimension changed by one, opposite byte (or bit) order,
+    header size offset by one slice. Header size offsets are the same as those of headerSizeOffset.
+    Returns an empty list if the parameters are invalid.
+    """
+    scalarType = parameters['scalarType']
+    try:
+      (columnSize, rowSize, sliceSize) = [self.headerSizeOffset(parameters, mode) for mode in ['column', 'row', 'slice']]
+    except ValueError:
+      # Rows do not fit into the row stride
+      return []
+    candidates = []
+    for offset in [columnSize, rowSize]:
+      candidates.append({'headerSize': parameters['headerSize'] + offset})
+      candidates.append({'headerSize': parameters['headerSize'] - offset})
+    candidates.append({'sizeX': parameters['sizeX'] + 1})
+    candidates.append({'sizeX': parameters['sizeX'] - 1})
+    if scalarType == vtk.VTK_BIT:
+      candidates.append({'lsbFirst': not parameters['lsbFirst']})
+    elif PixelTypes.scalarTypeSize(scalarType) > 1:
+      candidates.append({'bigEndian': not parameters['bigEndian']})
+    candidates.append({'headerSize': parameters['headerSize'] + sliceSize})
+    candidates.append({'headerSize': parameters['headerSize'] - sliceSize})
+    likelyParameters = []
+    for candidate in candidates:
+      if candidate.get('headerSize', 0) < 0 or candidate.get('sizeX', 1) < 1:
+        continue
+      if parameters['rowStride'] and PixelTypes.packedRowSize(scalarType, parameters['numberOfComponents'],
+          candidate.get('sizeX', parameters['sizeX']), parameters['planar']) > parameters['rowStride']:
+        # Rows would not fit into the row stride
+        continue
+      likelyParameters.append(dict(parameters, **candidate))
+    return likelyParameters
+
+  def readContactSheet(self, parameters, mode, numberOfTiles=25, tileSize=128):
+    """
+    Read thumbnails of the middle slice of the image, decoded with parameters that differ only in the parameter
+    selected by mode ('sizeX', 'pixelType', or 'headerSize'). parameters are keyword arguments of readImage.
+    Returns a ContactSheet. See ContactSheet.ContactSheet for details.
+    """
+    contactSheet = ContactSheet.ContactSheet(ContactSheet.candidateParameters(parameters, mode, numberOfTiles), tileSize)
+    contactSheet.read(blockCache=self.reader.blockCache)
+    return contactSheet
+
+  def setContactSheetImage(self, volumeNode, contactSheet):
+    """Sets contact sheet image as a single-slice image of the volume, shown with the full intensity range"""
+    self.setImageArray(volumeNode, contactSheet.image.reshape((1,) + contactSheet.image.shape + (1,)))
+    # Same orientation as output volumes (first and second axes are inverted)
+    ijkToRas = vtk.vtkMatrix4x4()
+    ijkToRas.SetElement(0,0, -1.0)
+    ijkToRas.SetElement(1,1, -1.0)
+    volumeNode.SetIJKToRASMatrix(ijkToRas)
+    volumeNode.CreateDefaultDisplayNodes()
+    displayNode = volumeNode.GetDisplayNode()
+    displayNode.SetAutoWindowLevel(False)
+    displayNode.SetWindowLevelMinMax(0, 255)
+    displayNode.SetInterpolate(False)
+    volumeNode.Modified()
+
+  def isImageHeaderSupported(self, scalarType, numberOfComponents, sizeX, rowStride=0, sliceHeaderSize=0, planar=False,
+      **otherParameters):
+    """Returns True if a NRRD header can describe the image in the raw file (see generateImageHeader)"""
+    return (scalarType != vtk.VTK_BIT
+      and PixelTypes.isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar))
 
   def generateImageHeader(self, outputVolumeNode, imageFilePath,
       scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
-      spacingX, spacingY, spacingZ, numberOfVolumes=1):
+      spacingX, spacingY, spacingZ, numberOfVolumes=1, rowStride=0, sliceHeaderSize=0, planar=False, progressCallback=None):
     """
-    Reads image into output volume
+    Writes NRRD header file next to the image file. Returns the header file name.
+    If the NRRD header cannot describe the image (1bpp images, padded rows, slice headers, or planar components)
+    then the image is exported into a compact NRRD file next to the image file instead (see exportImage)
+    and the name of the exported file is returned (None if the export is cancelled by progressCallback).
     """
-
-    # Trim sizeZ and numberOfVolumes to maximum available data size (the reader would refuse loading completely
-    # if there is not enough voxel data)
-    if scalarType == vtk.VTK_BIT:
-      raise RuntimeError("NRRD file format does not support 1bpp images. Read the image and then save as NRRD.")
-
-    sliceSize = sizeX * sizeY * vtk.vtkDataArray.GetDataTypeSize(scalarType) * numberOfComponents
-    totalHeaderSize = headerSize + skipSlices * sliceSize
-    import os
-    totalFilesize = os.path.getsize(imageFilePath)
-    voxelDataSize = totalFilesize - totalHeaderSize
-    maxNumberOfSlices = int(voxelDataSize/sliceSize)
-    finalSizeZ = min(sizeZ, maxNumberOfSlices)
-    maxNumberOfVolumes = int(voxelDataSize/sliceSize/finalSizeZ)
-    finalNumberOfVolumes = min(numberOfVolumes, maxNumberOfVolumes)
-
-    import os
-    filename, file_extension = os.path.splitext(imageFilePath)
-    if finalNumberOfVolumes > 1:
-      nhdrFilename = filename + ".seq.nhdr"
-    else:
-      nhdrFilename = filename + ".nhdr"
-
-    with open(nhdrFilename, "w") as headerFile:
-      headerFile.write("NRRD0004\n")
-      headerFile.write("# Complete NRRD file format specification at:\n")
-      headerFile.write("# http://teem.sourceforge.net/nrrd/format.html\n")
-
-      if scalarType == vtk.VTK_UNSIGNED_CHAR:
-        typeStr = "uchar"
-      elif scalarType == vtk.VTK_SIGNED_CHAR:
-        typeStr = "signed char"
-      elif scalarType == vtk.VTK_UNSIGNED_SHORT:
-        typeStr = "ushort"
-      elif scalarType == vtk.VTK_SHORT:
-        typeStr = "short"
-      elif scalarType == vtk.VTK_FLOAT:
-        typeStr = "float"
-      elif scalarType == vtk.VTK_DOUBLE:
-        typeStr = "double"
-      else:
-        raise ValueError('Unknown scalar type')
-      headerFile.write("type: {0}\n".format(typeStr))
-
-      # Determine dimension, sizes, and kinds (dependent of number of components and volumes)
-      dimension = 3
-      sizesStr = "{0} {1} {2}".format(sizeX, sizeY, finalSizeZ)
-      spaceDirectionsStr = "({0}, 0.0, 0.0) (0.0, {1}, 0.0) (0.0, 0.0, {2})".format(spacingX, spacingY, spacingZ)
-      kindsStr = "domain domain domain"
-      if numberOfComponents > 1:
-        dimension += 1
-        sizesStr = "{0} ".format(numberOfComponents) + sizesStr
-        spaceDirectionsStr = "none " + spaceDirectionsStr
-        kindsStr = "vector " + kindsStr
-      if finalNumberOfVolumes > 1:
-        dimension += 1
-        sizesStr = sizesStr + " {0}".format(finalNumberOfVolumes)
-        spaceDirectionsStr = spaceDirectionsStr + " none"
-        kindsStr = kindsStr + " list"
-
-      headerFile.write("dimension: {0}\n".format(dimension))
-      headerFile.write("space: left-posterior-superior\n")
-      headerFile.write("sizes: {0}\n".format(sizesStr))
-      headerFile.write("space directions: {0}\n".format(spaceDirectionsStr))
-      headerFile.write("kinds: {0}\n".format(kindsStr))
-      headerFile.write("endian: {0}\n".format("big" if bigEndian else "little"))
-      headerFile.write("encoding: raw\n")
-      headerFile.write("space origin: (0.0, 0.0, 0.0)\n")
-
-      if totalHeaderSize > 0:
-        headerFile.write("byte skip: {0}\n".format(totalHeaderSize))
-      headerFile.write("data file: {0}\n".format(os.path.basename(imageFilePath)))
-
-    return nhdrFilename
+    if self.isImageHeaderSupported(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar):
+      return NrrdHeader.writeNrrdHeader(imageFilePath, scalarType, numberOfComponents, bigEndian,
+        sizeX, sizeY, sizeZ, headerSize, skipSlices, spacingX, spacingY, spacingZ, numberOfVolumes)
+    outputFilePath = NrrdHeader.outputFileBaseName(imageFilePath) + (".seq.nrrd" if numberOfVolumes > 1 else ".nrrd")
+    export = self.exportImage(outputFilePath, imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, spacingX, spacingY, spacingZ, numberOfVolumes,
+      progressCallback=progressCallback, rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
+    return None if export['cancelled'] else outputFilePath
+
+  def exportImage(self, outputFilePath, imageFilePath,
+      scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+      spacingX, spacingY, spacingZ, numberOfVolumes=1, compress=False, progressCallback=None,
+      rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Writes the image into a NRRD file (or, if outputFilePath ends with .nhdr, into a header and a raw data file),
+    in chunks of slices, without reading the whole image into memory (see NrrdExport.exportNrrd).
+    Returns dict with the number of bytes read and written, the elapsed time, and if the export was cancelled.
+    """
+    return NrrdExport.exportNrrd(imageFilePath, outputFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, spacingX, spacingY, spacingZ, numberOfVolumes,
+      compress=compress, numberOfThreads=self.reader.numberOfThreads, progressCallback=progressCallback,
+      rowStride=rowStride, sliceHeaderSize=sliceHeaderSize, planar=planar)
 
 
 class RawImageGuessTest(ScriptedLoadableModuleTest):
@@ -548,6 +1385,20 @@ class RawImageGuessTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_RawImageGuess1()
+    self.setUp()
+    self.test_RawImageGuessSequence()
+    self.setUp()
+    self.test_RawImageGuessContactSheet()
+    self.setUp()
+    self.test_RawImageGuessParameterIndex()
+    self.setUp()
+    self.test_RawImageGuessExport()
+    self.setUp()
+    self.test_RawImageGuessWindowLevel()
+    self.setUp()
+    self.test_RawImageGuessPrefetch()
+    self.setUp()
+    self.test_RawImageGuessLayout()
 
   def test_RawImageGuess1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -563,37 +1414,381 @@ class RawImageGuessTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("Starting the test")
 
-    # Download an image
-    import SampleData
-    volumeNode = SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')[0]
-    self.assertIsNotNone(volumeNode)
-
-    # Save image without compression
-    volumeNode.AddDefaultStorageNode()
-    storageNode = volumeNode.GetStorageNode()
-    inputFileName = os.path.join(slicer.app.temporaryPath, 'some-uncompressed-file.nrrd')
-    storageNode.SetFileName(inputFileName)
-    storageNode.UseCompressionOff()
-    self.assertTrue(storageNode.WriteData(volumeNode))
+    # Create a raw image file: 16-bit big endian voxels after a 361-byte header
+    import numpy as np
+    (sizeX, sizeY, sizeZ, headerSize) = (64, 48, 10, 361)
+    (k, j, i) = np.mgrid[0:sizeZ, 0:sizeY, 0:sizeX]
+    expectedVoxels = (i * 3 + j * 5 + k * 7).astype(np.uint16)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessTest.raw')
+    with open(inputFileName, 'wb') as inputFile:
+      inputFile.write(b'H' * headerSize)
+      inputFile.write(expectedVoxels.astype('>u2').tobytes())
 
     # Import the raw image
     logic = RawImageGuessLogic()
-    pixelTypeString = "floar"
     outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
     logic.updateImage(outputVolumeNode, inputFileName,
-      "float", "Little endian", 256, 256, 51,
-      361, 0,
-      1.0, 1.0, 2.6)
+      scalarType=vtk.VTK_UNSIGNED_SHORT, numberOfComponents=1, bigEndian=True, lsbFirst=False,
+      sizeX=sizeX, sizeY=sizeY, sizeZ=sizeZ, headerSize=headerSize, skipSlices=0,
+      spacingX=1.0, spacingY=1.0, spacingZ=2.6)
     # Check if voxel values are valid
     dims = outputVolumeNode.GetImageData().GetDimensions()
-    self.assertEqual(dims[0], 256)
-    self.assertEqual(dims[1], 256)
-    self.assertEqual(dims[2], 51)
+    self.assertEqual(dims[0], sizeX)
+    self.assertEqual(dims[1], sizeY)
+    self.assertEqual(dims[2], sizeZ)
     scalarRange = outputVolumeNode.GetImageData().GetScalarRange()
     self.assertAlmostEqual(scalarRange[0], 0.0)
-    self.assertAlmostEqual(scalarRange[1], 0.9950811862945557)
+    self.assertAlmostEqual(scalarRange[1], float(expectedVoxels.max()))
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels))
+
+    # Generate NRRD header and load the image using it
+    headerFileName = logic.generateImageHeader(outputVolumeNode, inputFileName,
+      scalarType=vtk.VTK_UNSIGNED_SHORT, numberOfComponents=1, bigEndian=True, lsbFirst=False,
+      sizeX=sizeX, sizeY=sizeY, sizeZ=sizeZ, headerSize=headerSize, skipSlices=0,
+      spacingX=1.0, spacingY=1.0, spacingZ=2.6)
+    loadedVolumeNode = slicer.util.loadVolume(headerFileName)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(loadedVolumeNode), expectedVoxels))
+
+    # Header size detection should find the header size from the pixel type and image size
+    headerSizeCandidates = logic.detectHeaderSize(inputFileName, vtk.VTK_UNSIGNED_SHORT, 1, True, sizeX, sizeY,
+      minimumHeaderSize=0, maximumHeaderSize=1000)
+    self.assertEqual(headerSizeCandidates[0]['headerSize'], headerSize)
+
+    # Profiling reports the stages of an update to observers
+    import tracemalloc
+    tracingBeforeProfiling = tracemalloc.is_tracing()
+    finishedProfiles = []
+    logic.profilingEnabled = True
+    logic.addProfileObserver(finishedProfiles.append)
+    logic.reader.memoryMappingEnabled = False
+    # Blocks read by header size detection would be served from memory
+    logic.reader.blockCache.clear()
+    profile = logic.startProfile("Update")
+    with Instrumentation.activeProfile(profile):
+      logic.updateImage(outputVolumeNode, inputFileName,
+        scalarType=vtk.VTK_UNSIGNED_SHORT, numberOfComponents=1, bigEndian=True, lsbFirst=False,
+        sizeX=sizeX, sizeY=sizeY, sizeZ=sizeZ - 1, headerSize=headerSize, skipSlices=0,
+        spacingX=1.0, spacingY=1.0, spacingZ=2.6)
+    logic.finishProfile(profile)
+    self.assertEqual(finishedProfiles, [profile])
+    stages = dict((stage['name'], stage) for stage in profile.stages)
+    for stageName in ['stat', 'read', 'decode', 'vtkImport']:
+      self.assertIn(stageName, stages)
+    self.assertGreaterEqual(stages['read']['bytesRead'], sizeX * sizeY * (sizeZ - 1) * 2)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[:sizeZ - 1]))
+    # Disabling profiling stops tracing of memory allocations that was started by profiling
+    logic.removeProfileObserver(finishedProfiles.append)
+    logic.profilingEnabled = False
+    self.assertEqual(tracemalloc.is_tracing(), tracingBeforeProfiling)
+
+    # Cropped and downsampled read keeps voxels at their original position
+    logic.updateImage(outputVolumeNode, inputFileName,
+      scalarType=vtk.VTK_UNSIGNED_SHORT, numberOfComponents=1, bigEndian=True, lsbFirst=False,
+      sizeX=sizeX, sizeY=sizeY, sizeZ=sizeZ, headerSize=headerSize, skipSlices=0,
+      spacingX=1.0, spacingY=1.0, spacingZ=2.6, extent=[10, 49, 4, 40, 2, 9], decimation=(2, 3, 4))
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[2:10:4, 4:41:3, 10:50:2]))
+    self.assertEqual(outputVolumeNode.GetSpacing(), (2.0, 3.0, 2.6 * 4))
+    self.assertEqual(outputVolumeNode.GetOrigin(), (-10.0, -4.0, 2.6 * 2))
+
+    # Changing only the header size reuses the image data object and, if the result is not cached, the voxel array
+    logic.reader.resultCache.setMaximumSize(0)
+    for readHeaderSize in [headerSize, headerSize - 2, headerSize]:
+      logic.updateImage(outputVolumeNode, inputFileName,
+        scalarType=vtk.VTK_UNSIGNED_SHORT, numberOfComponents=1, bigEndian=True, lsbFirst=False,
+        sizeX=sizeX, sizeY=sizeY, sizeZ=sizeZ - 1, headerSize=readHeaderSize, skipSlices=0,
+        spacingX=1.0, spacingY=1.0, spacingZ=2.6)
+      if readHeaderSize != headerSize:
+        imageData = outputVolumeNode.GetImageData()
+    self.assertIs(outputVolumeNode.GetImageData(), imageData)
+    self.assertGreater(logic.reader.bufferPool.numberOfReusedArrays, 0)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[:sizeZ - 1]))
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessSequence(self):
+    """Multi-volume images are loaded as a sequence, frames are read when they are displayed"""
+
+    self.delayDisplay("Starting the sequence test")
+
+    import numpy as np
+    (sizeX, sizeY, sizeZ, numberOfVolumes) = (32, 24, 5, 4)
+    expectedVoxels = np.random.randint(0, 256, size=(numberOfVolumes, sizeZ, sizeY, sizeX)).astype(np.uint8)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessSequenceTest.raw')
+    with open(inputFileName, 'wb') as inputFile:
+      inputFile.write(expectedVoxels.tobytes())
+
+    logic = RawImageGuessLogic()
+    outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    imageParameters = {'scalarType': vtk.VTK_UNSIGNED_CHAR, 'numberOfComponents': 1, 'bigEndian': False, 'lsbFirst': False,
+      'sizeX': sizeX, 'sizeY': sizeY, 'sizeZ': sizeZ, 'headerSize': 0, 'skipSlices': 0,
+      'spacingX': 1.0, 'spacingY': 1.0, 'spacingZ': 1.0}
+    logic.updateImage(outputVolumeNode, inputFileName, numberOfVolumes=numberOfVolumes, **imageParameters)
+    browserNode = logic.sequenceBrowserNode
+    self.assertIsNotNone(browserNode)
+    self.assertEqual(browserNode.GetMasterSequenceNode().GetNumberOfDataNodes(), numberOfVolumes)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[0]))
+
+    # Browsing reads the selected frame
+    browserNode.SetSelectedItemNumber(2)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[2]))
+    self.assertLessEqual(len(logic.sequenceReader.frameCache.entries), logic.sequenceReader.frameCache.maximumNumberOfEntries)
+
+    # Loading a single volume removes the sequence
+    logic.updateImage(outputVolumeNode, inputFileName, **imageParameters)
+    self.assertIsNone(logic.sequenceBrowserNode)
+    self.assertFalse(slicer.mrmlScene.IsNodePresent(browserNode))
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolumeNode), expectedVoxels[0]))
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessContactSheet(self):
+    """Contact sheet shows the middle slice decoded with candidate parameters"""
+
+    self.delayDisplay("Starting the contact sheet test")
+
+    import numpy as np
+    (sizeX, sizeY, sizeZ, headerSize) = (60, 40, 6, 20)
+    (k, j, i) = np.mgrid[0:sizeZ, 0:sizeY, 0:sizeX]
+    # Checkerboard: only the correct X dimension shows exactly two intensities
+    expectedVoxels = ((i // 10 + j // 10) % 2 * 1000 + k).astype(np.uint16)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessContactSheetTest.raw')
+    with open(inputFileName, 'wb') as inputFile:
+      inputFile.write(b'H' * headerSize)
+      inputFile.write(expectedVoxels.tobytes())
+
+    logic = RawImageGuessLogic()
+    parameters = {'imageFilePath': inputFileName, 'scalarType': vtk.VTK_UNSIGNED_SHORT, 'numberOfComponents': 1,
+      'bigEndian': False, 'lsbFirst': False, 'sizeX': sizeX, 'sizeY': sizeY, 'sizeZ': sizeZ,
+      'headerSize': headerSize, 'skipSlices': 0}
+    contactSheet = logic.readContactSheet(parameters, 'sizeX', numberOfTiles=9, tileSize=32)
+    self.assertEqual(len(contactSheet.candidates), 9)
+    self.assertEqual(contactSheet.candidates[4]['sizeX'], sizeX)
+    (column, row) = contactSheet.tileOrigin(4)
+    self.assertEqual(contactSheet.candidateIndexAt(column + 5, row + 5), 4)
+    tile = contactSheet.image[row:row + 32, column:column + 32]
+    self.assertEqual(len(np.unique(tile[tile > 0])), 2)
+
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.setContactSheetImage(volumeNode, contactSheet)
+    self.assertEqual(volumeNode.GetImageData().GetDimensions(), (contactSheet.image.shape[1], contactSheet.image.shape[0], 1))
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessParameterIndex(self):
+    """Confirmed parameters are found for the same file and for files of the same format"""
+
+    self.delayDisplay("Starting the parameter index test")
+
+    import numpy as np
+    inputFileNames = []
+    for index in range(3):
+      inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessParameterIndexTest{0}.raw'.format(index))
+      with open(inputFileName, 'wb') as inputFile:
+        inputFile.write(b'MAGIC' + b'H' * 27)
+        # Last file has a different size
+        inputFile.write(np.full(10000 + index // 2, index, np.uint16).tobytes())
+      inputFileNames.append(inputFileName)
+
+    indexFilePath = os.path.join(slicer.app.temporaryPath, 'RawImageGuessParameterIndexTest.json')
+    if os.path.exists(indexFilePath):
+      os.remove(indexFilePath)
+    parameters = {'scalarType': vtk.VTK_UNSIGNED_SHORT, 'numberOfComponents': 1, 'bigEndian': True, 'lsbFirst': False,
+      'sizeX': 100, 'sizeY': 100, 'sizeZ': 1, 'headerSize': 32, 'skipSlices': 0,
+      'spacingX': 0.5, 'spacingY': 0.5, 'spacingZ': 2.0, 'numberOfVolumes': 1}
+    ParameterIndex.ParameterIndex(indexFilePath).store(inputFileNames[0], dict(parameters, imageFilePath=inputFileNames[0]))
+
+    # Index is read from the file
+    parameterIndex = ParameterIndex.ParameterIndex(indexFilePath)
+    self.assertEqual(parameterIndex.lookup(inputFileNames[0]), (parameters, True))
+    self.assertEqual(parameterIndex.lookup(inputFileNames[1]), (parameters, False))
+    self.assertEqual(parameterIndex.lookup(inputFileNames[2]), (None, False))
+
+    # Least recently used entries are removed (looked up entries are used, too)
+    import time
+    parameterIndex = ParameterIndex.ParameterIndex(indexFilePath, maximumNumberOfEntries=4)
+    parameterIndex.store(inputFileNames[0], parameters)
+    time.sleep(0.01)
+    parameterIndex.store(inputFileNames[2], parameters)
+    time.sleep(0.01)
+    self.assertEqual(parameterIndex.lookup(inputFileNames[0]), (parameters, True))
+    time.sleep(0.01)
+    parameterIndex.store(inputFileNames[1], parameters)
+    self.assertEqual(parameterIndex.lookup(inputFileNames[0]), (parameters, True))
+    parameterIndex.save()
+    self.assertEqual(ParameterIndex.ParameterIndex(indexFilePath).lookup(inputFileNames[0]), (parameters, True))
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessExport(self):
+    """1 bit image is exported into a NRRD file that can be loaded into Slicer"""
+
+    self.delayDisplay("Starting the export test")
+
+    import numpy as np
+    (sizeX, sizeY, sizeZ, headerSize) = (13, 9, 5, 3)
+    expectedVoxels = (np.random.RandomState(0).randint(0, 2, (sizeZ, sizeY, sizeX)) * 255).astype(np.uint8)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessExportTest.raw')
+    with open(inputFileName, 'wb') as inputFile:
+      inputFile.write(b'H' * headerSize)
+      inputFile.write(np.packbits(expectedVoxels > 0, axis=2).tobytes())
+
+    logic = RawImageGuessLogic()
+    outputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessExportTest.nrrd')
+    progress = []
+    export = logic.exportImage(outputFileName, inputFileName, vtk.VTK_BIT, 1, False, False, sizeX, sizeY, sizeZ,
+      headerSize, 0, 1.0, 1.0, 2.0, compress=True, progressCallback=progress.append)
+    self.assertFalse(export['cancelled'])
+    self.assertEqual(progress[-1], 1.0)
+
+    volumeNode = slicer.util.loadVolume(outputFileName)
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(volumeNode), expectedVoxels)
+    self.assertEqual(volumeNode.GetSpacing(), (1.0, 1.0, 2.0))
+
+    # Batch export of 1 bit images can validate the voxels, too
+    batchParameters = {'scalarType': vtk.VTK_BIT, 'numberOfComponents': 1, 'bigEndian': False, 'lsbFirst': False,
+      'sizeX': sizeX, 'sizeY': sizeY, 'sizeZ': sizeZ, 'headerSize': headerSize, 'skipSlices': 0,
+      'spacingX': 1.0, 'spacingY': 1.0, 'spacingZ': 2.0, 'numberOfVolumes': 1}
+    result = BatchConvert.convertFile(inputFileName, batchParameters, outputDirectory=slicer.app.temporaryPath,
+      validate=True, exportFormat="nrrd")
+    self.assertIsNone(result['error'])
+    self.assertEqual((result['validation']['minimum'], result['validation']['maximum']), (0, 255))
+    volumeNode = slicer.util.loadVolume(result['headerFilePath'])
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(volumeNode), expectedVoxels)
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessWindowLevel(self):
+    """Window/level is set from sampled statistics, ignoring non-finite values and outliers"""
+
+    self.delayDisplay("Starting the window/level test")
+
+    import numpy as np
+    (sizeX, sizeY, sizeZ) = (64, 64, 32)
+    voxels = np.random.RandomState(0).normal(100.0, 10.0, (sizeZ, sizeY, sizeX)).astype(np.float32)
+    voxels.reshape(-1)[::101] = np.nan
+    voxels.reshape(-1)[::1009] = np.inf
+    voxels[0, 0, :8] = 1e38
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessWindowLevelTest.raw')
+    voxels.astype('<f4').tofile(inputFileName)
+
+    logic = RawImageGuessLogic()
+    logic.numberOfStatisticsSamples = 4096
+    outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.updateImage(outputVolumeNode, inputFileName, vtk.VTK_FLOAT, 1, False, False, sizeX, sizeY, sizeZ, 0, 0, 1.0, 1.0, 1.0)
+    displayNode = outputVolumeNode.GetDisplayNode()
+    self.assertFalse(displayNode.GetAutoWindowLevel())
+    self.assertGreater(displayNode.GetWindowLevelMin(), 50.0)
+    self.assertLess(displayNode.GetWindowLevelMax(), 150.0)
+    self.assertGreater(logic.imageStatistics.numberOfNonFiniteSamples, 0)
+
+    # Refinement samples more voxels
+    numberOfSamples = logic.imageStatistics.numberOfSamples
+    while logic.refineImageStatistics(numberOfSamples=16384):
+      pass
+    self.assertGreater(logic.imageStatistics.numberOfSamples, numberOfSamples)
+    self.assertLess(displayNode.GetWindowLevelMax(), 150.0)
+
+    # Window/level that is set by the user is kept
+    displayNode.SetWindowLevelMinMax(0.0, 1000.0)
+    logic.updateImage(outputVolumeNode, inputFileName, vtk.VTK_FLOAT, 1, False, False, sizeX, sizeY, sizeZ, 4, 0, 1.0, 1.0, 1.0)
+    self.assertEqual((displayNode.GetWindowLevelMin(), displayNode.GetWindowLevelMax()), (0.0, 1000.0))
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessPrefetch(self):
+    """Images with predicted parameters are read into the result cache in the background"""
+
+    self.delayDisplay("Starting the prefetch test")
+
+    import numpy as np
+    import time
+    (sizeX, sizeY, sizeZ) = (32, 32, 8)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessPrefetchTest.raw')
+    (np.arange(sizeX * sizeY * sizeZ + 1) % 1000).astype('>u2').tofile(inputFileName)
+
+    logic = RawImageGuessLogic()
+    # Memory-mapped images are not prefetched, as they are not read when they are created
+    logic.reader.memoryMappingEnabled = False
+    parameters = {'imageFilePath': inputFileName, 'scalarType': vtk.VTK_UNSIGNED_SHORT, 'numberOfComponents': 1,
+      'bigEndian': True, 'lsbFirst': False, 'sizeX': sizeX, 'sizeY': sizeY, 'sizeZ': sizeZ,
+      'headerSize': 0, 'skipSlices': 0}
+    prefetcher = Prefetcher.Prefetcher(logic.reader)
+    prefetcher.prefetch([dict(parameters, headerSize=2), dict(parameters, bigEndian=False)])
+    startTime = time.time()
+    while prefetcher.numberOfPrefetchedImages < 2 and time.time() - startTime < 10.0:
+      time.sleep(0.01)
+    prefetcher.stop()
+    self.assertEqual(prefetcher.numberOfPrefetchedImages, 2)
+
+    # Prefetched image is returned from the cache
+    numberOfHits = logic.reader.resultCache.statistics()['numberOfHits']
+    outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.updateImage(outputVolumeNode, spacingX=1.0, spacingY=1.0, spacingZ=1.0, **dict(parameters, headerSize=2))
+    self.assertEqual(logic.reader.resultCache.statistics()['numberOfHits'], numberOfHits + 1)
+    self.assertEqual(slicer.util.arrayFromVolume(outputVolumeNode)[0, 0, 0], 1)
+
+    # Header sizes of likely parameters of 1 bit images are offset by whole bytes of columns, rows, and slices,
+    # the same as the header size offset buttons
+    bitParameters = dict(parameters, scalarType=vtk.VTK_BIT, sizeX=13, sizeY=5, headerSize=100,
+      rowStride=0, sliceHeaderSize=0, planar=False)
+    (columnSize, rowSize, sliceSize) = (1, 2, 2 * 5)
+    self.assertEqual([logic.headerSizeOffset(bitParameters, mode) for mode in ['column', 'row', 'slice']],
+      [columnSize, rowSize, sliceSize])
+    headerSizes = [candidate['headerSize'] for candidate in logic.likelyParameters(bitParameters)]
+    self.assertEqual(sorted(set(headerSizes) - set([100])), [100 - sliceSize, 100 - rowSize, 100 - columnSize,
+      100 + columnSize, 100 + rowSize, 100 + sliceSize])
+    # Padded rows and slice headers are included, invalid row stride results in no likely parameters
+    paddedParameters = dict(bitParameters, rowStride=4, sliceHeaderSize=3)
+    self.assertEqual(logic.headerSizeOffset(paddedParameters, 'row'), 4)
+    self.assertIn(100 + 3 + 4 * 5, [candidate['headerSize'] for candidate in logic.likelyParameters(paddedParameters)])
+    self.assertEqual(logic.likelyParameters(dict(bitParameters, rowStride=1)), [])
+
+    self.delayDisplay('Test passed!')
+
+  def test_RawImageGuessLayout(self):
+    """Images with padded rows, slice headers, and planar components are read and exported"""
+
+    self.delayDisplay("Starting the data layout test")
+
+    import numpy as np
+    (sizeX, sizeY, sizeZ, headerSize, rowStride, sliceHeaderSize) = (11, 7, 4, 5, 36, 3)
+    expectedVoxels = np.random.RandomState(0).randint(0, 256, (sizeZ, sizeY, sizeX, 3)).astype(np.uint8)
+    inputFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessLayoutTest.raw')
+    with open(inputFileName, 'wb') as inputFile:
+      inputFile.write(b'H' * headerSize)
+      for sliceVoxels in expectedVoxels:
+        inputFile.write(b'S' * sliceHeaderSize)
+        # Planar: red rows, then green rows, then blue rows, each row padded to rowStride bytes
+        for component in range(3):
+          for row in sliceVoxels[:, :, component]:
+            inputFile.write(row.tobytes() + b'P' * (rowStride - sizeX))
+
+    logic = RawImageGuessLogic()
+    parameters = {'scalarType': vtk.VTK_UNSIGNED_CHAR, 'numberOfComponents': 3, 'bigEndian': False, 'lsbFirst': False,
+      'sizeX': sizeX, 'sizeY': sizeY, 'sizeZ': sizeZ, 'headerSize': headerSize, 'skipSlices': 0,
+      'rowStride': rowStride, 'sliceHeaderSize': sliceHeaderSize, 'planar': True}
+    for memoryMappingEnabled in [True, False]:
+      logic.reader.memoryMappingEnabled = memoryMappingEnabled
+      # Images are not returned from the result cache, so that both reading methods are tested
+      np.testing.assert_array_equal(logic.reader.readImage(inputFileName, useResultCache=False, **parameters), expectedVoxels)
+      # Cropped and decimated
+      np.testing.assert_array_equal(logic.reader.readImage(inputFileName, extent=[1, 9, 2, 6, 1, 3], decimation=2,
+        useResultCache=False, **parameters), expectedVoxels[1:4:2, 2:7:2, 1:10:2])
+
+    # NRRD header cannot describe the layout, therefore the image is exported instead
+    generatedFileName = logic.generateImageHeader(None, inputFileName, spacingX=1.0, spacingY=1.0, spacingZ=1.0, **parameters)
+    self.assertTrue(generatedFileName.endswith(".nrrd"))
+    volumeNode = slicer.util.loadVolume(generatedFileName)
+    np.testing.assert_array_equal(slicer.util.arrayFromVolume(volumeNode), expectedVoxels)
+
+    # Contact sheet tile of the current parameters is the same as that of the packed, interleaved image
+    packedFileName = os.path.join(slicer.app.temporaryPath, 'RawImageGuessLayoutTestPacked.raw')
+    with open(packedFileName, 'wb') as packedFile:
+      packedFile.write(b'H' * headerSize)
+      packedFile.write(expectedVoxels.tobytes())
+    packedParameters = dict(parameters, imageFilePath=packedFileName, rowStride=0, sliceHeaderSize=0, planar=False)
+    packedContactSheet = logic.readContactSheet(packedParameters, 'headerSize', numberOfTiles=1, tileSize=16)
+    contactSheet = logic.readContactSheet(dict(parameters, imageFilePath=inputFileName), 'headerSize', numberOfTiles=1, tileSize=16)
+    np.testing.assert_array_equal(contactSheet.image, packedContactSheet.image)
 
     self.delayDisplay('Test passed!')
@@ -0,0 +1,84 @@
+"""Reading images on a background thread"""
+
+import threading
+
+class BackgroundReader(object):
+  """Reads images on a background thread.
+  Only the most recent request is kept: a new request replaces the pending one
+  and results of requests that became outdated while reading are dropped.
+  The read function must not access the MRML scene, results are collected
+  on the main thread by calling takeResult() (for example, from a timer).
+  """
+
+  def __init__(self, readFunction):
+    self.readFunction = readFunction
+    self.condition = threading.Condition()
+    self.thread = None
+    self.stopRequested = False
+    self.latestRequestId = 0
+    self.pendingRequest = None
+    self.runningRequestId = None
+    self.result = None
+
+  def requestRead(self, parameters, context=None):
+    """Request reading with the keyword arguments in parameters.
+    Context is returned along with the result (it is not passed to the read function).
+    """
+    with self.condition:
+      self.latestRequestId += 1
+      self.pendingRequest = (self.latestRequestId, parameters, context)
+      self.stopRequested = False
+      if not self.thread or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self._run, name="RawImageGuessBackgroundReader")
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+      return self.latestRequestId
+
+  def cancel(self):
+    """Drop pending request and results of any request that is already being read"""
+    with self.condition:
+      self.latestRequestId += 1
+      self.pendingRequest = None
+      self.result = None
+
+  def stop(self):
+    """Cancel all requests and stop the background thread"""
+    with self.condition:
+      self.stopRequested = True
+      self.condition.notify()
+    self.cancel()
+
+  def isBusy(self):
+    with self.condition:
+      return (self.pendingRequest is not None) or (self.runningRequestId is not None) or (self.result is not None)
+
+  def takeResult(self):
+    """Returns (parameters, context, voxels, exception) of the latest finished request
+    or None if there is no new result.
+    """
+    with self.condition:
+      result = self.result
+      self.result = None
+      return result
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.pendingRequest is None and not self.stopRequested:
+          self.condition.wait()
+        if self.stopRequested:
+          return
+        requestId, parameters, context = self.pendingRequest
+        self.pendingRequest = None
+        self.runningRequestId = requestId
+      voxels = None
+      exception = None
+      try:
+        voxels = self.readFunction(**parameters)
+      except Exception as e:
+        exception = e
+      with self.condition:
+        self.runningRequestId = None
+        if requestId == self.latestRequestId:
+          self.result = (parameters, context, voxels, exception)
@@ -0,0 +1,305 @@
+"""
+Generate NRRD headers for many raw image files that have the same image parameters
+(or convert them into NRRD files that contain the voxels, with --export).
+
+Image parameters are specified in a preset (JSON) file, for example:
+
+  {
+    "pixelType": "16 bit unsigned",
+    "endianness": "little endian",
+    "sizeX": 512, "sizeY": 512, "sizeZ": 100,
+    "headerSize": 0, "skipSlices": 0,
+    "spacingX": 0.5, "spacingY": 0.5, "spacingZ": 1.0,
+    "numberOfVolumes": 1
+  }
+
+For "1 bit" images, bit order can be specified by "lsbFirst": true (the default is most significant bit first).
+If rows are padded or slices have headers then "rowStride" (distance between the starts of rows, in bytes)
+and "sliceHeaderSize" (in bytes) can be specified, and "componentLayout": "planar" if components of RGB images
+are stored in separate planes (the default is "interleaved").
+Headers cannot refer to 1 bit images or images with such layouts, they can only be exported.
+
+Input files are specified by file name patterns and/or a manifest (text file, one file path per line).
+Files are processed in parallel, in multiple processes.
+
+Usage with plain Python:
+
+  python RawImageGuessLib/BatchConvert.py --preset preset.json "/data/scans/*.raw"
+  python RawImageGuessLib/BatchConvert.py --preset preset.json --export nrrd --compress --output-directory /data/nrrd "/data/scans/*.raw"
+
+Usage with Slicer:
+
+  Slicer --no-main-window --python-script RawImageGuessLib/BatchConvert.py --preset preset.json "/data/scans/*.raw"
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+if __package__ in (None, ''):
+  # Started as a script, make RawImageGuessLib importable
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RawImageGuessLib import CompressedFile, ImageReader, NrrdExport, NrrdHeader, PixelTypes
+
+def loadPreset(presetFilePath):
+  """Read image parameters from a preset file. Returns dict of exportNrrd arguments (and writeNrrdHeader arguments,
+  except lsbFirst)."""
+  with open(presetFilePath) as presetFile:
+    preset = json.load(presetFile)
+  (scalarType, numberOfComponents) = PixelTypes.scalarTypeAndComponentsFromName(preset.get("pixelType", "8 bit unsigned"))
+  endianness = preset.get("endianness", "little endian").lower()
+  if endianness not in ["little endian", "big endian"]:
+    raise ValueError("Invalid endianness: {0}. Valid values: little endian, big endian".format(endianness))
+  componentLayout = preset.get("componentLayout", "interleaved").lower()
+  if componentLayout not in ["interleaved", "planar"]:
+    raise ValueError("Invalid component layout: {0}. Valid values: interleaved, planar".format(componentLayout))
+  return {
+    'scalarType': scalarType,
+    'numberOfComponents': numberOfComponents,
+    'bigEndian': endianness == "big endian",
+    'lsbFirst': bool(preset.get("lsbFirst", False)),
+    'sizeX': int(preset["sizeX"]),
+    'sizeY': int(preset["sizeY"]),
+    'sizeZ': int(preset.get("sizeZ", 1)),
+    'headerSize': int(preset.get("headerSize", 0)),
+    'skipSlices': int(preset.get("skipSlices", 0)),
+    'spacingX': float(preset.get("spacingX", 1.0)),
+    'spacingY': float(preset.get("spacingY", 1.0)),
+    'spacingZ': float(preset.get("spacingZ", 1.0)),
+    'numberOfVolumes': int(preset.get("numberOfVolumes", 1)),
+    'rowStride': int(preset.get("rowStride", 0)),
+    'sliceHeaderSize': int(preset.get("sliceHeaderSize", 0)),
+    'planar': componentLayout == "planar",
+    }
+
+def inputFilePaths(patterns, manifestFilePath=None):
+  """Get list of input files from file name patterns and manifest file (duplicates are removed)"""
+  filePaths = []
+  for pattern in patterns:
+    matchingFilePaths = sorted(glob.glob(pattern))
+    filePaths.extend(matchingFilePaths if matchingFilePaths else [pattern])
+  if manifestFilePath:
+    manifestDirectory = os.path.dirname(os.path.abspath(manifestFilePath))
+    with open(manifestFilePath) as manifestFile:
+      for line in manifestFile:
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        # Relative paths are relative to the manifest file
+        filePaths.append(os.path.join(manifestDirectory, line))
+  uniqueFilePaths = []
+  addedFilePaths = set()
+  for filePath in filePaths:
+    if os.path.abspath(filePath) not in addedFilePaths:
+      uniqueFilePaths.append(filePath)
+      addedFilePaths.add(os.path.abspath(filePath))
+  return uniqueFilePaths
+
+def validateImage(imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY, sizeZ, totalHeaderSize, numberOfVolumes,
+    rowStride=0, sliceHeaderSize=0, planar=False, lsbFirst=False):
+  """Read all voxels of the image, slice by slice. Returns dict with minimum, maximum, number of
+  non-finite values, and number of bytes read. 1 bit images are validated as 8-bit values of 0 and 255.
+  """
+  import numpy as np
+  if scalarType == PixelTypes.VTK_BIT:
+    dtype = np.dtype(np.uint8)
+  else:
+    dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+  numberOfSlices = sizeZ * numberOfVolumes
+  voxelsPerSlice = sizeY * sizeX * numberOfComponents
+  compressedFile = CompressedFile.fileReader(imageFilePath)
+  if scalarType == PixelTypes.VTK_BIT:
+    # Slices are unpacked to 8-bit values of 0 and 255, as in ImageReader.readBitImageSlices
+    sliceSize = PixelTypes.sliceSize(scalarType, 1, sizeX, sizeY, rowStride, sliceHeaderSize)
+    bytesPerRow = PixelTypes.rowStrideInBytes(scalarType, 1, sizeX, rowStride)
+    lookupTable = ImageReader.bitUnpackingTable(lsbFirst)
+    if compressedFile is not None:
+      slices = (np.frombuffer(compressedFile.read(totalHeaderSize + sliceIndex * sliceSize, sliceSize), dtype=np.uint8)
+        for sliceIndex in range(numberOfSlices))
+    else:
+      mappedSlices = np.memmap(imageFilePath, dtype=np.uint8, mode='r', offset=totalHeaderSize, shape=(numberOfSlices, sliceSize))
+      slices = (mappedSlices[sliceIndex] for sliceIndex in range(numberOfSlices))
+    voxels = (lookupTable[sliceData[sliceHeaderSize:].reshape(sizeY, bytesPerRow)[:, :(sizeX + 7) // 8]].reshape(sizeY, -1)[:, :sizeX]
+      for sliceData in slices)
+    bytesRead = numberOfSlices * sliceSize
+  elif not PixelTypes.isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar):
+    # Voxels of each slice are accessed through a strided view that skips padding and the slice header
+    sliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride, sliceHeaderSize, planar)
+    strides = ImageReader.voxelStrides(dtype.itemsize, numberOfComponents, sizeY,
+      PixelTypes.rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride, planar), planar)
+    if compressedFile is not None:
+      slices = (compressedFile.read(totalHeaderSize + sliceIndex * sliceSize, sliceSize) for sliceIndex in range(numberOfSlices))
+    else:
+      mappedSlices = np.memmap(imageFilePath, dtype=np.uint8, mode='r', offset=totalHeaderSize, shape=(numberOfSlices, sliceSize))
+      slices = (mappedSlices[sliceIndex] for sliceIndex in range(numberOfSlices))
+    voxels = (np.ndarray((sizeY, sizeX, numberOfComponents), dtype=dtype, buffer=sliceData, offset=sliceHeaderSize,
+      strides=strides).reshape(-1) for sliceData in slices)
+    bytesRead = numberOfSlices * sliceSize
+  elif compressedFile is not None:
+    # Slices are decompressed one by one (consecutive reads continue decompression where the previous read ended)
+    sliceSize = voxelsPerSlice * dtype.itemsize
+    voxels = (np.frombuffer(compressedFile.read(totalHeaderSize + sliceIndex * sliceSize, sliceSize), dtype=dtype)
+      for sliceIndex in range(numberOfSlices))
+    bytesRead = numberOfSlices * sliceSize
+  else:
+    voxels = np.memmap(imageFilePath, dtype=dtype, mode='r', offset=totalHeaderSize,
+      shape=(numberOfSlices, voxelsPerSlice))
+    bytesRead = voxels.nbytes
+  minimum = None
+  maximum = None
+  numberOfNonFiniteValues = 0
+  for sliceVoxels in voxels:
+    if dtype.kind == 'f':
+      finite = np.isfinite(sliceVoxels)
+      numberOfNonFiniteValues += int(finite.size - np.count_nonzero(finite))
+      sliceVoxels = sliceVoxels[finite]
+      if sliceVoxels.size == 0:
+        continue
+    sliceMinimum = sliceVoxels.min()
+    sliceMaximum = sliceVoxels.max()
+    minimum = sliceMinimum if minimum is None else min(minimum, sliceMinimum)
+    maximum = sliceMaximum if maximum is None else max(maximum, sliceMaximum)
+  return {
+    'minimum': None if minimum is None else minimum.item(),
+    'maximum': None if maximum is None else maximum.item(),
+    'numberOfNonFiniteValues': numberOfNonFiniteValues,
+    'bytesRead': bytesRead,
+    }
+
+def convertFile(imageFilePath, parameters, outputDirectory=None, validate=False, exportFormat=None, compress=False):
+  """Write NRRD header for an image file (and optionally read all its voxels).
+  If exportFormat is "nrrd" or "nhdr" then the voxels are written into a NRRD file (or a header and data file) instead,
+  optionally gzip compressed.
+  Returns dict with results. Errors are reported in the result instead of raising an exception.
+  """
+  startTime = time.time()
+  result = {'imageFilePath': imageFilePath, 'headerFilePath': None, 'error': None, 'bytesRead': 0, 'bytesWritten': 0}
+  try:
+    if exportFormat:
+      (sizeZ, numberOfVolumes, totalHeaderSize) = NrrdHeader.availableSizeZAndNumberOfVolumes(imageFilePath,
+        parameters['scalarType'], parameters['numberOfComponents'], parameters['sizeX'], parameters['sizeY'], parameters['sizeZ'],
+        parameters['headerSize'], parameters['skipSlices'], parameters['numberOfVolumes'],
+        parameters.get('rowStride', 0), parameters.get('sliceHeaderSize', 0), parameters.get('planar', False))
+      outputFilePath = NrrdHeader.outputFileBaseName(imageFilePath, outputDirectory) + (".seq." if numberOfVolumes > 1 else ".") + exportFormat
+      # Each file is exported by a single thread, as files are processed in parallel
+      export = NrrdExport.exportNrrd(imageFilePath, outputFilePath, compress=compress, numberOfThreads=1, **parameters)
+      result['headerFilePath'] = outputFilePath
+      result['bytesRead'] = export['bytesRead']
+      result['bytesWritten'] = export['bytesWritten']
+    else:
+      headerParameters = dict((name, value) for name, value in parameters.items() if name != 'lsbFirst')
+      result['headerFilePath'] = NrrdHeader.writeNrrdHeader(imageFilePath, outputDirectory=outputDirectory, **headerParameters)
+    if validate:
+      (sizeZ, numberOfVolumes, totalHeaderSize) = NrrdHeader.availableSizeZAndNumberOfVolumes(imageFilePath,
+        parameters['scalarType'], parameters['numberOfComponents'], parameters['sizeX'], parameters['sizeY'], parameters['sizeZ'],
+        parameters['headerSize'], parameters['skipSlices'], parameters['numberOfVolumes'],
+        parameters.get('rowStride', 0), parameters.get('sliceHeaderSize', 0), parameters.get('planar', False))
+      validation = validateImage(imageFilePath, parameters['scalarType'], parameters['numberOfComponents'], parameters['bigEndian'],
+        parameters['sizeX'], parameters['sizeY'], sizeZ, totalHeaderSize, numberOfVolumes,
+        parameters.get('rowStride', 0), parameters.get('sliceHeaderSize', 0), parameters.get('planar', False),
+        parameters.get('lsbFirst', False))
+      result['bytesRead'] += validation.pop('bytesRead')
+      result['validation'] = validation
+  except Exception as e:
+    result['error'] = "{0}: {1}".format(type(e).__name__, e)
+  result['time'] = time.time() - startTime
+  return result
+
+def convertFiles(imageFilePaths, parameters, outputDirectory=None, validate=False, numberOfWorkers=None, resultCallback=None,
+    exportFormat=None, compress=False):
+  """Convert files in parallel, using a process pool (numberOfWorkers=0 processes files in the current process).
+  resultCallback is called with the result of each file (in the calling process), as soon as it is available.
+  Returns list of results, in the order of input files.
+  """
+  if numberOfWorkers is None:
+    numberOfWorkers = os.cpu_count() or 1
+  numberOfWorkers = min(numberOfWorkers, len(imageFilePaths))
+  results = []
+  if numberOfWorkers < 1:
+    for imageFilePath in imageFilePaths:
+      results.append(convertFile(imageFilePath, parameters, outputDirectory, validate, exportFormat, compress))
+      if resultCallback:
+        resultCallback(results[-1])
+    return results
+
+  import concurrent.futures
+  import multiprocessing
+  # Spawn new processes instead of forking, as forking an application that has running threads
+  # (such as Slicer) is not safe
+  with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfWorkers,
+      mp_context=multiprocessing.get_context('spawn')) as executor:
+    # Several files are sent to a worker at once, to reduce communication overhead
+    chunkSize = max(1, min(64, len(imageFilePaths) // (numberOfWorkers * 4)))
+    for result in executor.map(convertFile, imageFilePaths, [parameters] * len(imageFilePaths),
+        [outputDirectory] * len(imageFilePaths), [validate] * len(imageFilePaths),
+        [exportFormat] * len(imageFilePaths), [compress] * len(imageFilePaths), chunksize=chunkSize):
+      results.append(result)
+      if resultCallback:
+        resultCallback(result)
+  return results
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Generate NRRD headers for raw image files that have the same image parameters"
+    " (or convert them into NRRD files).")
+  parser.add_argument("patterns", nargs='*', help="input file names or patterns (such as /data/*.raw)")
+  parser.add_argument("--preset", required=True, help="JSON file containing image parameters")
+  parser.add_argument("--manifest", help="text file containing input file paths (one per line)")
+  parser.add_argument("--output-directory", help="write headers into this directory instead of next to the input files")
+  parser.add_argument("--export", choices=["nrrd", "nhdr"], help="write the voxels into a NRRD file (nrrd) or a header and a raw data file (nhdr)"
+    " instead of generating a header that refers to the input file")
+  parser.add_argument("--compress", action='store_true', help="gzip compress exported voxels")
+  parser.add_argument("--validate", action='store_true', help="read all voxels of each image and report value range")
+  parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs, 0: no worker processes)")
+  parser.add_argument("--verbose", action='store_true', help="report result of each file")
+  args = parser.parse_args(argv)
+
+  parameters = loadPreset(args.preset)
+  imageFilePaths = inputFilePaths(args.patterns, args.manifest)
+  if not imageFilePaths:
+    parser.error("No input files are specified")
+  if args.compress and not args.export:
+    parser.error("--compress requires --export")
+  if args.output_directory and not os.path.exists(args.output_directory):
+    os.makedirs(args.output_directory)
+
+  def reportResult(result):
+    if result['error']:
+      sys.stderr.write("FAILED {0}: {1}\n".format(result['imageFilePath'], result['error']))
+    elif args.verbose:
+      message = "{0} -> {1}".format(result['imageFilePath'], result['headerFilePath'])
+      if 'validation' in result:
+        message += " (range: {0} - {1}, non-finite values: {2})".format(result['validation']['minimum'],
+          result['validation']['maximum'], result['validation']['numberOfNonFiniteValues'])
+      sys.stdout.write(message + "\n")
+
+  startTime = time.time()
+  results = convertFiles(imageFilePaths, parameters, args.output_directory, args.validate, args.workers, reportResult,
+    args.export, args.compress)
+  elapsedTime = max(time.time() - startTime, 1e-6)
+
+  numberOfFailures = len([result for result in results if result['error']])
+  megabytesRead = sum(result['bytesRead'] for result in results) / (1024.0 * 1024.0)
+  sys.stdout.write("Processed {0} files in {1:.2f} s ({2:.1f} files/s), failed: {3}\n".format(
+    len(results), elapsedTime, len(results) / elapsedTime, numberOfFailures))
+  if args.export:
+    megabytesWritten = sum(result['bytesWritten'] for result in results) / (1024.0 * 1024.0)
+    sys.stdout.write("Exported {0:.1f} MB of voxel data ({1:.1f} MB/s), wrote {2:.1f} MB\n".format(
+      megabytesRead, megabytesRead / elapsedTime, megabytesWritten))
+  elif args.validate:
+    sys.stdout.write("Validated {0:.1f} MB of voxel data ({1:.1f} MB/s)\n".format(megabytesRead, megabytesRead / elapsedTime))
+  return 1 if numberOfFailures else 0
+
+def exitApplication(status):
+  try:
+    import slicer
+  except ImportError:
+    sys.exit(status)
+  # Running in Slicer (that does not exit at the end of the script)
+  slicer.util.exit(status)
+
+if __name__ == '__main__':
+  exitApplication(main(sys.argv[1:]))
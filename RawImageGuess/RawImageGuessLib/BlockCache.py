@@ -0,0 +1,169 @@
+"""Cache of recently read parts of files"""
+
+import collections
+import os
+import threading
+
+from RawImageGuessLib import CompressedFile, Instrumentation
+
+def readFileInto(filePath, offset, view):
+  """Read bytes of an uncompressed file starting at offset into a memoryview. Returns the number of bytes read.
+  Positioned reads (pread) are used where available, so that multiple threads can read different parts
+  of the same file in parallel without sharing a file position.
+  """
+  if not hasattr(os, 'preadv'):
+    with open(filePath, 'rb') as f:
+      f.seek(offset)
+      return f.readinto(view)
+  fd = os.open(filePath, os.O_RDONLY)
+  try:
+    bytesRead = 0
+    while bytesRead < len(view):
+      # A single call may return fewer bytes than requested
+      count = os.preadv(fd, [view[bytesRead:]], offset + bytesRead)
+      if count <= 0:
+        break
+      bytesRead += count
+    return bytesRead
+  finally:
+    os.close(fd)
+
+def preadBytes(fd, offset, size):
+  """Read at most size bytes starting at offset from a file descriptor, using positioned reads (pread).
+  Returns bytes (fewer than size bytes if the end of the file is reached).
+  """
+  chunks = []
+  while size > 0:
+    # A single call may return fewer bytes than requested
+    chunk = os.pread(fd, size, offset)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    offset += len(chunk)
+    size -= len(chunk)
+  return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+class BlockCache(object):
+  """Cache of fixed-size blocks of files, with least-recently-used eviction.
+  Parameter tuning reads almost the same byte ranges repeatedly (e.g., after changing the header
+  size by a row or changing endianness), these reads are served from memory and only blocks
+  that have not been read yet are read from the file. Cached blocks of a file are dropped
+  when the size or modification time of the file changes.
+  Compressed files are decompressed transparently (see CompressedFile), offsets refer to the uncompressed data.
+  Can be used from multiple threads.
+  """
+
+  def __init__(self, maximumSize=512*1024*1024, blockSize=1024*1024):
+    self.blockSize = blockSize
+    self.maximumSize = maximumSize
+    self.lock = threading.Lock()
+    # (filePath, blockIndex) -> bytes, least recently used first
+    self.blocks = collections.OrderedDict()
+    self.cachedSize = 0
+    # filePath -> (size, modification time) of the file when its blocks were read
+    self.fileKeys = {}
+
+  def setMaximumSize(self, maximumSize):
+    """Set memory budget (in bytes). Blocks are not cached if it is 0."""
+    with self.lock:
+      self.maximumSize = maximumSize
+      self._evict()
+
+  def clear(self):
+    with self.lock:
+      self.blocks.clear()
+      self.cachedSize = 0
+      self.fileKeys.clear()
+
+  def read(self, filePath, offset, size):
+    """Read at most size bytes starting at offset. Returns bytes."""
+    buffer = bytearray(size)
+    bytesRead = self.readInto(filePath, offset, buffer)
+    return bytes(buffer[:bytesRead])
+
+  def readInto(self, filePath, offset, buffer):
+    """Read bytes starting at offset into a writable, contiguous buffer (bytearray, NumPy array, ...).
+    Returns the number of bytes read (less than the buffer size if the end of the file is reached).
+    """
+    view = memoryview(buffer).cast('B')
+    size = len(view)
+    filePath = os.path.abspath(filePath)
+    fileStat = os.stat(filePath)
+    fileKey = (fileStat.st_size, fileStat.st_mtime_ns)
+    with self.lock:
+      if self.fileKeys.get(filePath) != fileKey:
+        self._removeFile(filePath)
+        self.fileKeys[filePath] = fileKey
+      cachingEnabled = self.maximumSize > 0
+
+    compressedFile = CompressedFile.fileReader(filePath)
+    if compressedFile is None:
+      end = min(offset + size, fileStat.st_size)
+    else:
+      # Size of the uncompressed data may not be known yet, reading stops at the end of the data
+      end = offset + size if compressedFile.size is None else min(offset + size, compressedFile.size)
+    if offset >= end:
+      return 0
+    if not cachingEnabled:
+      if compressedFile is not None:
+        data = compressedFile.read(offset, end - offset)
+        view[:len(data)] = data
+        bytesRead = len(data)
+      else:
+        bytesRead = readFileInto(filePath, offset, view[:end - offset])
+      Instrumentation.addBytesRead(bytesRead)
+      return bytesRead
+
+    position = offset
+    # Missing blocks are read using positioned reads (pread) where available, through a file descriptor
+    # that is opened once per call, so that threads do not share a file position
+    fd = None
+    f = None
+    try:
+      for blockIndex in range(offset // self.blockSize, (end - 1) // self.blockSize + 1):
+        blockKey = (filePath, blockIndex)
+        with self.lock:
+          block = self.blocks.get(blockKey)
+          if block is not None:
+            self.blocks.move_to_end(blockKey)
+        if block is None:
+          # Read outside the lock, so that other threads can access the cache meanwhile
+          if compressedFile is not None:
+            block = compressedFile.read(blockIndex * self.blockSize, self.blockSize)
+          elif hasattr(os, 'pread'):
+            if fd is None:
+              fd = os.open(filePath, os.O_RDONLY)
+            block = preadBytes(fd, blockIndex * self.blockSize, self.blockSize)
+          else:
+            if f is None:
+              f = open(filePath, 'rb')
+            f.seek(blockIndex * self.blockSize)
+            block = f.read(self.blockSize)
+          Instrumentation.addBytesRead(len(block))
+          with self.lock:
+            if self.fileKeys.get(filePath) == fileKey and blockKey not in self.blocks:
+              self.blocks[blockKey] = block
+              self.cachedSize += len(block)
+              self._evict()
+        blockOffset = position - blockIndex * self.blockSize
+        copySize = min(len(block) - blockOffset, end - position)
+        if copySize <= 0:
+          break
+        view[position - offset:position - offset + copySize] = block[blockOffset:blockOffset + copySize]
+        position += copySize
+    finally:
+      if fd is not None:
+        os.close(fd)
+      if f is not None:
+        f.close()
+    return position - offset
+
+  def _removeFile(self, filePath):
+    for blockKey in [blockKey for blockKey in self.blocks if blockKey[0] == filePath]:
+      self.cachedSize -= len(self.blocks.pop(blockKey))
+    self.fileKeys.pop(filePath, None)
+
+  def _evict(self):
+    while self.blocks and self.cachedSize > self.maximumSize:
+      (blockKey, block) = self.blocks.popitem(last=False)
+      self.cachedSize -= len(block)
@@ -0,0 +1,67 @@
+"""Reusing memory of arrays that are not used anymore"""
+
+import collections
+import threading
+
+class BufferPool(object):
+  """Keeps arrays that are not used anymore, so that reading the next image of the same size and pixel type
+  (for example, after changing only the header size or the endianness) can decode voxels into an existing array
+  instead of allocating a new one. Least recently released arrays are freed first if the pool is full.
+  Can be used from multiple threads.
+  """
+
+  def __init__(self, maximumSize=512*1024*1024, maximumNumberOfArrays=4):
+    self.maximumSize = maximumSize
+    self.maximumNumberOfArrays = maximumNumberOfArrays
+    self.lock = threading.Lock()
+    # Free arrays, least recently released first
+    self.freeArrays = collections.deque()
+    self.freeSize = 0
+    self.numberOfReusedArrays = 0
+    self.numberOfAllocatedArrays = 0
+
+  def setMaximumSize(self, maximumSize):
+    """Set memory budget of free arrays (in bytes). Arrays are not kept if it is 0."""
+    with self.lock:
+      self.maximumSize = maximumSize
+      self._evict()
+
+  def clear(self):
+    with self.lock:
+      self.freeArrays.clear()
+      self.freeSize = 0
+
+  def acquire(self, shape, dtype):
+    """Returns a C-contiguous array of the requested shape and dtype (with undefined content).
+    A free array is reused if there is one with the same shape and dtype, otherwise a new array is allocated.
+    """
+    import numpy as np
+    shape = tuple(shape)
+    dtype = np.dtype(dtype)
+    with self.lock:
+      # Most recently released arrays are most likely to be in the CPU cache
+      for index in range(len(self.freeArrays) - 1, -1, -1):
+        array = self.freeArrays[index]
+        if array.shape == shape and array.dtype == dtype:
+          del self.freeArrays[index]
+          self.freeSize -= array.nbytes
+          self.numberOfReusedArrays += 1
+          return array
+      self.numberOfAllocatedArrays += 1
+    return np.empty(shape, dtype=dtype)
+
+  def release(self, array):
+    """Give back an array that is not used anymore. The caller must not access the array after this."""
+    if not array.flags.c_contiguous or not array.flags.owndata:
+      # Views may share memory with arrays that are still in use
+      return
+    with self.lock:
+      if any(freeArray is array for freeArray in self.freeArrays):
+        return
+      self.freeArrays.append(array)
+      self.freeSize += array.nbytes
+      self._evict()
+
+  def _evict(self):
+    while self.freeArrays and (self.freeSize > self.maximumSize or len(self.freeArrays) > self.maximumNumberOfArrays):
+      self.freeSize -= self.freeArrays.popleft().nbytes
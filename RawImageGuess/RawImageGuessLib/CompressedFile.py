@@ -0,0 +1,273 @@
+"""
+Transparent reading of gzip, bzip2, and xz compressed raw image files.
+
+Compressed files are detected from their first bytes. Reading at an offset (of the uncompressed data)
+decompresses from the nearest seek point before the offset:
+
+- Start of each compressed stream (gzip member, bzip2 or xz stream). Files compressed by parallel compressors
+  (bgzip, pigz -i, pbzip2, xz -T with multiple streams) consist of many streams, which can be decompressed
+  independently. These seek points and the uncompressed size are stored in a persistent index file,
+  so they are only computed once for each file.
+- Snapshots of the decompressor state, taken at regular intervals while decompressing gzip files.
+  The Python zlib module can copy a decompressor but cannot save its state into a file, therefore these
+  seek points are kept in memory only (bzip2 and xz decompressors cannot be copied at all). Therefore a file
+  that consists of a single stream has no persistent seek point other than its start: when it is opened again
+  in a new process, reads decompress it from the beginning (only its uncompressed size is known from the index).
+- Position of the previous read, so that reading consecutive parts of the file does not decompress
+  the same data again.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Magic bytes at the beginning of compressed files
+compressionSignatures = [
+  (b'\x1f\x8b', 'gzip'),
+  (b'BZh', 'bzip2'),
+  (b'\xfd7zXZ\x00', 'xz'),
+  ]
+
+# File name extensions of compressed files (removed from the file name of generated headers)
+compressionExtensions = ['.gz', '.bz2', '.xz']
+
+# Directory where seek-point indices are stored (None: RawImageGuessIndex in the temporary directory)
+indexDirectory = None
+
+# Compressed file readers, shared by all image readers, so that seek points are only computed once
+# for each file: absolute file path -> ((size, modification time) of the compressed file, reader or None)
+_fileReaders = {}
+_fileReadersLock = threading.Lock()
+
+def compressionFormat(filePath):
+  """Get compression format ('gzip', 'bzip2', or 'xz') of a file from its first bytes, None if it is not compressed"""
+  with open(filePath, 'rb') as f:
+    start = f.read(6)
+  for signature, compression in compressionSignatures:
+    if start.startswith(signature):
+      return compression
+  return None
+
+def fileReader(filePath):
+  """Get CompressedFileReader of a compressed file, None if the file is not compressed"""
+  filePath = os.path.abspath(filePath)
+  fileStat = os.stat(filePath)
+  fileKey = (fileStat.st_size, fileStat.st_mtime_ns)
+  with _fileReadersLock:
+    entry = _fileReaders.get(filePath)
+    if entry is not None and entry[0] == fileKey:
+      return entry[1]
+  compression = compressionFormat(filePath)
+  reader = CompressedFileReader(filePath, compression, fileKey) if compression else None
+  with _fileReadersLock:
+    _fileReaders[filePath] = (fileKey, reader)
+  return reader
+
+def isCompressed(filePath):
+  return fileReader(filePath) is not None
+
+def dataSize(filePath):
+  """Get size of the uncompressed content of the file in bytes.
+  If the size of a compressed file is not in the index yet then the whole file is decompressed once.
+  """
+  reader = fileReader(filePath)
+  if reader is None:
+    return os.path.getsize(filePath)
+  return reader.dataSize()
+
+class _DecompressorState(object):
+  """Decompressor of a stream and its position in the compressed and uncompressed data"""
+
+  def __init__(self, compression, compressedOffset, uncompressedOffset, decompressor=None, tail=b''):
+    if decompressor is None:
+      if compression == 'gzip':
+        import zlib
+        # Expect gzip header
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      elif compression == 'bzip2':
+        import bz2
+        decompressor = bz2.BZ2Decompressor()
+      else:
+        import lzma
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    self.decompressor = decompressor
+    # Position in the file up to which compressed data has been passed to the decompressor
+    self.compressedOffset = compressedOffset
+    # Compressed data that has been read from the file but not consumed by the decompressor yet (gzip only)
+    self.tail = tail
+    self.uncompressedOffset = uncompressedOffset
+    self.endOfFile = False
+
+class CompressedFileReader(object):
+  """Random access to the uncompressed content of a gzip, bzip2, or xz compressed file.
+  Can be used from multiple threads (reads are serialized).
+  """
+
+  def __init__(self, filePath, compression, fileKey, checkpointInterval=16*1024*1024, maximumNumberOfCheckpoints=256):
+    self.filePath = filePath
+    self.compression = compression
+    self.fileKey = fileKey
+    self.lock = threading.Lock()
+    # Start of each compressed stream as (compressedOffset, uncompressedOffset), in increasing order
+    self.streams = [(0, 0)]
+    # Size of the uncompressed data (None until the whole file has been decompressed)
+    self.size = None
+    # In-memory seek points (gzip only): (uncompressedOffset, compressedOffset, tail, decompressor copy)
+    self.checkpoints = []
+    self.checkpointInterval = checkpointInterval
+    self.maximumNumberOfCheckpoints = maximumNumberOfCheckpoints
+    # Decompressor at the end of the previous read
+    self.currentState = None
+    # Size of compressed data that is passed to the decompressor at once
+    self.chunkSize = 1024*1024
+    self.loadIndex()
+
+  def indexFilePath(self):
+    directory = indexDirectory or os.path.join(tempfile.gettempdir(), 'RawImageGuessIndex')
+    return os.path.join(directory, hashlib.sha1(self.filePath.encode('utf-8')).hexdigest() + '.json')
+
+  def loadIndex(self):
+    """Load seek points and size from the persistent index (if it exists and it was created for this file)"""
+    try:
+      with open(self.indexFilePath()) as indexFile:
+        index = json.load(indexFile)
+    except (IOError, OSError, ValueError):
+      return
+    if (index.get('filePath') != self.filePath or index.get('compression') != self.compression
+        or tuple(index.get('fileKey', ())) != self.fileKey):
+      return
+    self.streams = [tuple(stream) for stream in index['streams']]
+    self.size = index['size']
+
+  def saveIndex(self):
+    indexFilePath = self.indexFilePath()
+    index = {
+      'filePath': self.filePath,
+      'compression': self.compression,
+      'fileKey': list(self.fileKey),
+      'size': self.size,
+      'streams': [list(stream) for stream in self.streams],
+      }
+    try:
+      if not os.path.exists(os.path.dirname(indexFilePath)):
+        os.makedirs(os.path.dirname(indexFilePath))
+      with open(indexFilePath + '.tmp', 'w') as indexFile:
+        json.dump(index, indexFile)
+      os.replace(indexFilePath + '.tmp', indexFilePath)
+    except (IOError, OSError):
+      # The index only makes subsequent reads faster, reading works without it
+      pass
+
+  def dataSize(self):
+    """Get size of the uncompressed data (the whole file is decompressed if the size is not known yet)"""
+    with self.lock:
+      if self.size is None:
+        with open(self.filePath, 'rb') as f:
+          state = self._startState(float('inf'))
+          while self._decompress(state, f, self.chunkSize * 16) is not None:
+            pass
+          self.currentState = state
+      return self.size
+
+  def read(self, offset, size):
+    """Read at most size bytes of uncompressed data starting at offset. Returns bytes."""
+    with self.lock:
+      with open(self.filePath, 'rb') as f:
+        state = self._startState(offset)
+        # Skip data before the offset
+        while state.uncompressedOffset < offset:
+          if self._decompress(state, f, min(offset - state.uncompressedOffset, self.chunkSize * 16)) is None:
+            break
+        parts = []
+        remainingSize = size
+        while remainingSize > 0:
+          data = self._decompress(state, f, remainingSize)
+          if data is None:
+            break
+          parts.append(data)
+          remainingSize -= len(data)
+        self.currentState = state
+      return b''.join(parts)
+
+  def _startState(self, offset):
+    """Get decompressor state at the nearest seek point before offset"""
+    (streamCompressedOffset, streamUncompressedOffset) = [stream for stream in self.streams if stream[1] <= offset][-1]
+    state = None
+    bestOffset = streamUncompressedOffset
+    for (uncompressedOffset, compressedOffset, tail, decompressor) in self.checkpoints:
+      if bestOffset < uncompressedOffset <= offset:
+        # Copy, so that the checkpoint can be used again
+        state = _DecompressorState(self.compression, compressedOffset, uncompressedOffset, decompressor.copy(), tail)
+        bestOffset = uncompressedOffset
+    current = self.currentState
+    if current is not None and not current.endOfFile and bestOffset <= current.uncompressedOffset <= offset:
+      state = current
+    if state is None:
+      state = _DecompressorState(self.compression, streamCompressedOffset, streamUncompressedOffset)
+    return state
+
+  def _decompress(self, state, f, maximumSize):
+    """Decompress at most maximumSize bytes. Returns bytes (may be empty) or None at the end of the file."""
+    decompressor = state.decompressor
+    if state.endOfFile:
+      return None
+    if self.compression == 'gzip':
+      data = state.tail
+      if not data:
+        f.seek(state.compressedOffset)
+        data = f.read(self.chunkSize)
+        state.compressedOffset += len(data)
+        if not data:
+          return self._endOfFile(state)
+      output = decompressor.decompress(data, maximumSize)
+      state.tail = decompressor.unconsumed_tail
+    else:
+      if decompressor.needs_input:
+        f.seek(state.compressedOffset)
+        data = f.read(self.chunkSize)
+        state.compressedOffset += len(data)
+        if not data:
+          return self._endOfFile(state)
+      else:
+        data = b''
+      output = decompressor.decompress(data, maximumSize)
+    previousOffset = state.uncompressedOffset
+    state.uncompressedOffset += len(output)
+
+    if self.compression == 'gzip' and previousOffset // self.checkpointInterval != state.uncompressedOffset // self.checkpointInterval:
+      self._addCheckpoint(state)
+    if decompressor.eof:
+      # Next stream starts after the end of this stream (unused data contains all the data that has been
+      # passed to the decompressor after the end of the stream, including the unconsumed tail)
+      nextStreamOffset = state.compressedOffset - len(decompressor.unused_data)
+      f.seek(nextStreamOffset)
+      nextStreamStart = f.read(6)
+      if not any(nextStreamStart.startswith(signature) for signature, compression in compressionSignatures):
+        # End of file (or padding after the last stream)
+        self._endOfFile(state)
+        return output
+      if (nextStreamOffset, state.uncompressedOffset) not in self.streams:
+        self.streams.append((nextStreamOffset, state.uncompressedOffset))
+        self.streams.sort()
+      nextState = _DecompressorState(self.compression, nextStreamOffset, state.uncompressedOffset)
+      state.__dict__.update(nextState.__dict__)
+    return output
+
+  def _endOfFile(self, state):
+    state.endOfFile = True
+    if self.size is None:
+      self.size = state.uncompressedOffset
+      self.saveIndex()
+    return None
+
+  def _addCheckpoint(self, state):
+    if any(checkpoint[0] == state.uncompressedOffset for checkpoint in self.checkpoints):
+      return
+    self.checkpoints.append((state.uncompressedOffset, state.compressedOffset, state.tail, state.decompressor.copy()))
+    self.checkpoints.sort(key=lambda checkpoint: checkpoint[0])
+    if len(self.checkpoints) > self.maximumNumberOfCheckpoints:
+      # Keep every second checkpoint and take checkpoints less frequently from now on
+      self.checkpoints = self.checkpoints[1::2]
+      self.checkpointInterval *= 2
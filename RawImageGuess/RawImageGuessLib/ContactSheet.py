@@ -0,0 +1,240 @@
+"""
+Contact sheet: thumbnails of the middle slice of an image, decoded with many candidate parameters at once,
+for comparing candidate X dimensions, pixel types, or header sizes side by side.
+"""
+
+from RawImageGuessLib import CompressedFile, Guessing, Instrumentation, PixelTypes
+
+# Parameter that is varied between the tiles of a contact sheet -> name shown in the user interface
+contactSheetModes = {
+  'sizeX': "X dimension",
+  'pixelType': "Pixel type",
+  'headerSize': "Header size",
+  }
+
+def candidateParameters(parameters, mode, numberOfTiles=25):
+  """
+  Get image parameters of the tiles of a contact sheet: copies of parameters (keyword arguments of
+  ImageReader.readImage) where only the parameter selected by mode is varied around its current value.
+  - sizeX: consecutive X dimensions, centered on the current value
+  - pixelType: all pixel types that are tried by Guessing.guessImageGeometry (numberOfTiles is ignored)
+  - headerSize: consecutive header sizes (in bytes), centered on the current value
+  Each candidate has a 'label' item that describes the varied parameter.
+  """
+  candidates = []
+  if mode == 'sizeX':
+    firstSizeX = max(1, parameters['sizeX'] - numberOfTiles // 2)
+    for sizeX in range(firstSizeX, firstSizeX + numberOfTiles):
+      candidate = dict(parameters, sizeX=sizeX)
+      candidate['label'] = "X dimension: {0}".format(sizeX)
+      candidates.append(candidate)
+  elif mode == 'pixelType':
+    for (scalarType, numberOfComponents, bigEndian) in Guessing.guessedPixelTypes:
+      bitOrders = [False, True] if scalarType == PixelTypes.VTK_BIT else [parameters['lsbFirst']]
+      for lsbFirst in bitOrders:
+        candidate = dict(parameters, scalarType=scalarType, numberOfComponents=numberOfComponents,
+          bigEndian=bigEndian, lsbFirst=lsbFirst)
+        label = PixelTypes.pixelTypeName(scalarType, numberOfComponents)
+        if scalarType == PixelTypes.VTK_BIT:
+          label += ", LSB first" if lsbFirst else ", MSB first"
+        elif PixelTypes.scalarTypeSize(scalarType) > 1:
+          label += ", big endian" if bigEndian else ", little endian"
+        candidate['label'] = label
+        candidates.append(candidate)
+  elif mode == 'headerSize':
+    firstHeaderSize = max(0, parameters['headerSize'] - numberOfTiles // 2)
+    for headerSize in range(firstHeaderSize, firstHeaderSize + numberOfTiles):
+      candidate = dict(parameters, headerSize=headerSize)
+      candidate['label'] = "Header size: {0}".format(headerSize)
+      candidates.append(candidate)
+  else:
+    raise ValueError("Unknown contact sheet mode: {0}".format(mode))
+  return candidates
+
+class ContactSheet(object):
+  """Grid of thumbnails of the middle slice of the image, each decoded with different parameters.
+  Tiles are in the order of the candidates, row by row. Each thumbnail is scaled to fit into a
+  tileSize x tileSize square (nearest neighbor sampling, aspect ratio is kept) and its intensity range
+  is normalized separately (1st to 99th percentile), so that misinterpreted pixel types are visible, too.
+  """
+
+  def __init__(self, candidates, tileSize=128, numberOfColumns=None, spacing=4):
+    """candidates is a list of image parameters (see candidateParameters)"""
+    import math
+    self.candidates = candidates
+    self.tileSize = tileSize
+    self.numberOfColumns = numberOfColumns or max(1, int(math.ceil(math.sqrt(len(candidates)))))
+    self.numberOfRows = max(1, int(math.ceil(float(len(candidates)) / self.numberOfColumns)))
+    # Number of background pixels between tiles
+    self.spacing = spacing
+    # Contact sheet image: uint8 NumPy array of (numberOfRows*(tileSize+spacing), numberOfColumns*(tileSize+spacing))
+    self.image = None
+    # Candidates that could not be shown (not enough data in the file), their tiles are left empty
+    self.invalidCandidateIndices = []
+
+  def tileOrigin(self, candidateIndex):
+    """Get (column, row) of the first pixel of the tile of a candidate in the contact sheet image"""
+    tileStep = self.tileSize + self.spacing
+    return ((candidateIndex % self.numberOfColumns) * tileStep, (candidateIndex // self.numberOfColumns) * tileStep)
+
+  def candidateIndexAt(self, column, row):
+    """Get index of the candidate whose tile contains the contact sheet image pixel, None if there is no tile there"""
+    tileStep = self.tileSize + self.spacing
+    if column < 0 or row < 0 or column % tileStep >= self.tileSize or row % tileStep >= self.tileSize:
+      return None
+    tileColumn = int(column // tileStep)
+    tileRow = int(row // tileStep)
+    if tileColumn >= self.numberOfColumns:
+      return None
+    candidateIndex = tileRow * self.numberOfColumns + tileColumn
+    return candidateIndex if candidateIndex < len(self.candidates) else None
+
+  def read(self, blockCache=None):
+    """
+    Read the contact sheet image. The middle slices of all candidates are near the middle of the file,
+    therefore they are read from the file at once, with a single read that covers all of them.
+    Thumbnails of candidates that have the same pixel type are decoded together, using a single gather
+    of the sampled bytes. Padded rows, slice headers, and planar components of the candidates
+    (see PixelTypes.sliceSize) are taken into account. Returns the contact sheet image.
+    """
+    import numpy as np
+
+    imageFilePath = self.candidates[0]['imageFilePath']
+    with Instrumentation.stage('stat'):
+      totalFilesize = CompressedFile.dataSize(imageFilePath)
+
+    # Position of the middle slice of each candidate
+    sliceOffsets = []
+    self.invalidCandidateIndices = []
+    for candidateIndex, candidate in enumerate(self.candidates):
+      try:
+        sliceSize = PixelTypes.sliceSize(candidate['scalarType'], candidate['numberOfComponents'],
+          candidate['sizeX'], candidate['sizeY'], candidate.get('rowStride', 0), candidate.get('sliceHeaderSize', 0),
+          candidate.get('planar', False))
+      except ValueError:
+        # Rows of the candidate do not fit into the row stride
+        sliceSize = None
+      if sliceSize is not None:
+        firstSliceOffset = candidate['headerSize'] + candidate['skipSlices'] * sliceSize
+        numberOfSlices = min(candidate['sizeZ'], (totalFilesize - firstSliceOffset) // sliceSize)
+      if sliceSize is None or numberOfSlices < 1:
+        self.invalidCandidateIndices.append(candidateIndex)
+        sliceOffsets.append(None)
+        continue
+      sliceOffset = firstSliceOffset + numberOfSlices // 2 * sliceSize
+      sliceOffsets.append((sliceOffset, sliceOffset + sliceSize))
+
+    validOffsets = [offsets for offsets in sliceOffsets if offsets is not None]
+    if not validOffsets:
+      raise ValueError("No voxel data available at specified header offset/size")
+    bufferOffset = min(offsets[0] for offsets in validOffsets)
+    bufferEnd = max(offsets[1] for offsets in validOffsets)
+    with Instrumentation.stage('read'):
+      buffer = np.frombuffer(Guessing.readBytes(imageFilePath, bufferOffset, bufferEnd - bufferOffset, blockCache), dtype=np.uint8)
+      Instrumentation.addBytesRead(buffer.size)
+
+    with Instrumentation.stage('decode'):
+      # Voxel values of all thumbnails (NaN where there is no voxel)
+      tiles = np.full((len(self.candidates), self.tileSize, self.tileSize), np.nan)
+      # Group candidates by pixel type, thumbnails in a group are decoded at once
+      groups = {}
+      for candidateIndex, candidate in enumerate(self.candidates):
+        if sliceOffsets[candidateIndex] is None:
+          continue
+        key = (candidate['scalarType'], candidate['numberOfComponents'], candidate['bigEndian'], candidate['lsbFirst'])
+        groups.setdefault(key, []).append(candidateIndex)
+      for (scalarType, numberOfComponents, bigEndian, lsbFirst), candidateIndices in groups.items():
+        with np.errstate(all='ignore'):
+          self._decodeTiles(buffer, bufferOffset, sliceOffsets, candidateIndices,
+            scalarType, numberOfComponents, bigEndian, lsbFirst, tiles)
+
+      self.image = self._composeImage(self._normalizeTiles(tiles))
+    return self.image
+
+  def _samplingIndices(self, candidate):
+    """Get voxel indices (rows, columns) that are sampled for the thumbnail and a mask of tile pixels
+    that are inside the thumbnail
+    """
+    import numpy as np
+    sizeX = candidate['sizeX']
+    sizeY = candidate['sizeY']
+    scale = float(max(sizeX, sizeY)) / self.tileSize
+    thumbnailSizeX = max(1, min(self.tileSize, int(round(sizeX / scale))))
+    thumbnailSizeY = max(1, min(self.tileSize, int(round(sizeY / scale))))
+    tileIndices = np.arange(self.tileSize)
+    columns = np.minimum(((tileIndices + 0.5) * scale).astype(np.int64), sizeX - 1)
+    rows = np.minimum(((tileIndices + 0.5) * scale).astype(np.int64), sizeY - 1)
+    mask = (tileIndices[:, np.newaxis] < thumbnailSizeY) & (tileIndices[np.newaxis, :] < thumbnailSizeX)
+    return (rows, columns, mask)
+
+  def _decodeTiles(self, buffer, bufferOffset, sliceOffsets, candidateIndices,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, tiles):
+    """Decode thumbnails of candidates that have the same pixel type into tiles"""
+    import numpy as np
+    numberOfTiles = len(candidateIndices)
+    masks = np.zeros((numberOfTiles, self.tileSize, self.tileSize), dtype=bool)
+    if scalarType == PixelTypes.VTK_BIT:
+      # Index of the byte and the bit that contains each sampled voxel
+      byteIndices = np.zeros((numberOfTiles, self.tileSize, self.tileSize), dtype=np.int64)
+      bitShifts = np.zeros((numberOfTiles, self.tileSize, self.tileSize), dtype=np.uint8)
+      for tileIndex, candidateIndex in enumerate(candidateIndices):
+        candidate = self.candidates[candidateIndex]
+        (rows, columns, masks[tileIndex]) = self._samplingIndices(candidate)
+        bytesPerRow = PixelTypes.rowStrideInBytes(scalarType, 1, candidate['sizeX'], candidate.get('rowStride', 0))
+        rowStart = (sliceOffsets[candidateIndex][0] - bufferOffset + candidate.get('sliceHeaderSize', 0)
+          + rows * bytesPerRow)
+        byteIndices[tileIndex] = rowStart[:, np.newaxis] + columns[np.newaxis, :] // 8
+        bitShifts[tileIndex] = (columns % 8 if lsbFirst else 7 - columns % 8)[np.newaxis, :]
+      values = (buffer[byteIndices] >> bitShifts) & 1
+    else:
+      dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+      # Index of the first byte of each component of each sampled pixel
+      componentIndices = np.zeros((numberOfTiles, self.tileSize, self.tileSize, numberOfComponents), dtype=np.int64)
+      for tileIndex, candidateIndex in enumerate(candidateIndices):
+        candidate = self.candidates[candidateIndex]
+        (rows, columns, masks[tileIndex]) = self._samplingIndices(candidate)
+        planar = candidate.get('planar', False)
+        bytesPerRow = PixelTypes.rowStrideInBytes(scalarType, numberOfComponents, candidate['sizeX'],
+          candidate.get('rowStride', 0), planar)
+        if planar:
+          # Components are stored in planes of sizeY rows
+          pixelStep = dtype.itemsize
+          componentStep = bytesPerRow * candidate['sizeY']
+        else:
+          pixelStep = dtype.itemsize * numberOfComponents
+          componentStep = dtype.itemsize
+        rowStart = (sliceOffsets[candidateIndex][0] - bufferOffset + candidate.get('sliceHeaderSize', 0)
+          + rows * bytesPerRow)
+        componentIndices[tileIndex] = (rowStart[:, np.newaxis, np.newaxis] + columns[np.newaxis, :, np.newaxis] * pixelStep
+          + np.arange(numberOfComponents) * componentStep)
+      # Gather all bytes of the sampled pixels and reinterpret them as voxel values
+      componentBytes = buffer[componentIndices[..., np.newaxis] + np.arange(dtype.itemsize)]
+      values = np.ascontiguousarray(componentBytes).view(dtype).reshape(componentIndices.shape)
+      values = values.mean(axis=-1) if numberOfComponents > 1 else values[..., 0]
+    values = values.astype(np.float64)
+    values[~masks] = np.nan
+    values[~np.isfinite(values)] = np.nan
+    tiles[candidateIndices] = values
+
+  def _normalizeTiles(self, tiles):
+    """Map the 1st to 99th percentile of each tile to 1..255 (0 is background)"""
+    import warnings
+    import numpy as np
+    with warnings.catch_warnings():
+      # Tiles of invalid candidates contain no values
+      warnings.simplefilter('ignore', RuntimeWarning)
+      low = np.nanpercentile(tiles, 1, axis=(1, 2))[:, np.newaxis, np.newaxis]
+      high = np.nanpercentile(tiles, 99, axis=(1, 2))[:, np.newaxis, np.newaxis]
+      normalized = 1.0 + 254.0 * np.clip((tiles - low) / np.maximum(high - low, 1e-12), 0.0, 1.0)
+    normalized[~np.isfinite(normalized)] = 0
+    return normalized.astype(np.uint8)
+
+  def _composeImage(self, tiles):
+    """Arrange tiles into a grid, with spacing between the tiles"""
+    import numpy as np
+    tileStep = self.tileSize + self.spacing
+    numberOfGridTiles = self.numberOfRows * self.numberOfColumns
+    grid = np.zeros((numberOfGridTiles, tileStep, tileStep), dtype=np.uint8)
+    grid[:len(tiles), :self.tileSize, :self.tileSize] = tiles
+    grid = grid.reshape(self.numberOfRows, self.numberOfColumns, tileStep, tileStep)
+    return np.ascontiguousarray(grid.transpose(0, 2, 1, 3).reshape(self.numberOfRows * tileStep, self.numberOfColumns * tileStep))
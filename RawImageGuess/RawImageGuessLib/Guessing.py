@@ -0,0 +1,292 @@
+"""Guessing image parameters (pixel type, image size, header size) by analyzing the content of raw image files"""
+
+from RawImageGuessLib import CompressedFile, PixelTypes
+
+# Pixel types that are tried in guessImageGeometry: (scalarType, numberOfComponents, bigEndian)
+guessedPixelTypes = [
+  (PixelTypes.VTK_UNSIGNED_CHAR, 1, False),
+  (PixelTypes.VTK_SIGNED_CHAR, 1, False),
+  (PixelTypes.VTK_UNSIGNED_SHORT, 1, False),
+  (PixelTypes.VTK_UNSIGNED_SHORT, 1, True),
+  (PixelTypes.VTK_SHORT, 1, False),
+  (PixelTypes.VTK_SHORT, 1, True),
+  (PixelTypes.VTK_FLOAT, 1, False),
+  (PixelTypes.VTK_FLOAT, 1, True),
+  (PixelTypes.VTK_DOUBLE, 1, False),
+  (PixelTypes.VTK_DOUBLE, 1, True),
+  (PixelTypes.VTK_UNSIGNED_CHAR, 3, False),
+  (PixelTypes.VTK_BIT, 1, False),
+  ]
+
+def readBytes(filePath, offset, size, blockCache=None):
+  """Read at most size bytes starting at offset (through the block cache, if specified)"""
+  if blockCache is not None:
+    return blockCache.read(filePath, offset, size)
+  compressedFile = CompressedFile.fileReader(filePath)
+  if compressedFile is not None:
+    return compressedFile.read(offset, size)
+  with open(filePath, 'rb') as f:
+    f.seek(offset)
+    return f.read(size)
+
+def normalizedAutocorrelation(values, maximumLag):
+  """Compute autocorrelation coefficients of a 1D signal for lags 0..maximumLag (using FFT).
+  Values must have zero mean and unit variance.
+  """
+  import numpy as np
+  numberOfValues = values.size
+  fftSize = 1
+  while fftSize < numberOfValues + maximumLag + 1:
+    fftSize *= 2
+  spectrum = np.fft.rfft(values, fftSize)
+  correlation = np.fft.irfft(spectrum.real**2 + spectrum.imag**2, fftSize)[:maximumLag+1]
+  # Normalize by the number of overlapping values at each lag
+  correlation /= (numberOfValues - np.arange(maximumLag+1))
+  return correlation
+
+def robustStandardizedValues(values):
+  """Convert values to zero mean, unit variance float array of their quantile ranks.
+  Using ranks makes the result robust to outliers and misinterpreted (garbage) voxel values.
+  Non-finite values are replaced by the median. Returns None if the values are constant.
+  """
+  import numpy as np
+  finite = np.isfinite(values) if values.dtype.kind == 'f' else None
+  finiteValues = values[finite] if finite is not None else values
+  if finiteValues.size == 0:
+    return None
+  # Quantiles are estimated from a subsample for speed
+  subsample = finiteValues[::max(1, finiteValues.size // 65536)]
+  quantiles = np.unique(np.percentile(subsample, np.linspace(0, 100, 257)))
+  if quantiles.size < 2:
+    return None
+  ranks = np.searchsorted(quantiles, values).astype(np.float64)
+  if finite is not None:
+    ranks[~finite] = np.median(ranks[finite])
+  ranks -= ranks.mean()
+  standardDeviation = ranks.std()
+  if standardDeviation <= 0:
+    return None
+  ranks /= standardDeviation
+  return ranks
+
+def seamScores(profile):
+  """Compute how much larger each value of a profile (average difference between neighbor voxels)
+  is than a typical value. Returns array of scores between 0 (typical) and 1 (clear seam, at the maximum).
+  """
+  import numpy as np
+  median = np.median(profile)
+  spread = 1.4826 * np.median(np.abs(profile - median))
+  peakHeight = profile.max() - median
+  if peakHeight <= 0:
+    return np.zeros(profile.size)
+  # Confidence is low if the highest peak is within the typical variation of the profile
+  confidence = min(1.0, peakHeight / max(10.0 * spread, 1e-6))
+  return np.clip((profile - median) / peakHeight, 0.0, 1.0) * confidence
+
+def guessImageGeometry(imageFilePath, headerSize=0, minimumSizeX=2, maximumSizeX=1200,
+  sampleSize=256*1024, maximumNumberOfResults=10, pixelTypes=None, blockCache=None):
+  """
+  Guess image row length (sizeX) and pixel type by analyzing a sample of the file.
+  For each pixel type, row-to-row correlation is computed for all candidate row lengths at once
+  (using FFT-based autocorrelation of the voxel values): if row length is correct then neighbor rows
+  are similar, which shows up as a peak in the autocorrelation.
+  Pixel types are specified as a list of (scalarType, numberOfComponents, bigEndian), by default guessedPixelTypes.
+  Returns list of candidates, ordered by decreasing score. Each candidate is a dict with
+  scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, and score.
+  """
+  import numpy as np
+
+  # Read a sample from the middle of the voxel data, at a position that is aligned
+  # with all pixel sizes (relative to the header)
+  totalFilesize = CompressedFile.dataSize(imageFilePath)
+  voxelDataSize = totalFilesize - headerSize
+  if voxelDataSize <= 0:
+    raise ValueError("No voxel data available at specified header offset/size")
+  sampleSize = min(sampleSize, voxelDataSize)
+  sampleOffset = headerSize + (voxelDataSize - sampleSize) // 2 // 24 * 24
+  sample = np.frombuffer(readBytes(imageFilePath, sampleOffset, sampleSize, blockCache), dtype=np.uint8)
+
+  candidates = []
+  for (scalarType, numberOfComponents, bigEndian) in (pixelTypes or guessedPixelTypes):
+    with np.errstate(all='ignore'):
+      # Misinterpreted pixel types may contain NaN and infinite values
+      candidates.extend(_rowLengthCandidates(sample, scalarType, numberOfComponents, bigEndian, minimumSizeX, maximumSizeX))
+
+  candidates.sort(key=lambda candidate: -candidate['score'])
+  return candidates[:maximumNumberOfResults]
+
+def _rowLengthCandidates(sample, scalarType, numberOfComponents, bigEndian, minimumSizeX, maximumSizeX):
+  """Returns the best few row lengths (sizeX) for a pixel type"""
+  import numpy as np
+  if scalarType == PixelTypes.VTK_BIT:
+    # Bit order does not influence correlation of neighbor rows.
+    # Rows are padded to full bytes, therefore only multiples of 8 can be detected.
+    values = np.unpackbits(sample[:sample.size // 8])
+  else:
+    dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+    pixelSize = dtype.itemsize * numberOfComponents
+    values = np.frombuffer(sample[:sample.size // pixelSize * pixelSize].tobytes(), dtype=dtype)
+    if numberOfComponents > 1:
+      values = values.reshape(-1, numberOfComponents).mean(axis=1)
+  values = robustStandardizedValues(values)
+  if values is None or values.size < 4 * maximumSizeX:
+    # Constant values or not enough data for computing correlation between rows
+    return []
+
+  # Baseline correlation of a row length is the average correlation at lags
+  # that are a bit shorter or longer (between outerOffset/2 and outerOffset).
+  sizesX = np.arange(max(8, minimumSizeX), maximumSizeX + 1)
+  if scalarType == PixelTypes.VTK_BIT:
+    sizesX = sizesX[sizesX % 8 == 0]
+  if sizesX.size == 0:
+    return []
+  outerOffset = np.maximum(4, sizesX // 8)
+  innerOffset = outerOffset // 2
+  correlation = normalizedAutocorrelation(values, int(sizesX[-1] + outerOffset[-1]))
+  cumulativeCorrelation = np.concatenate([[0.0], np.cumsum(correlation)])
+  def correlationSum(firstLag, lastLag):
+    return cumulativeCorrelation[lastLag + 1] - cumulativeCorrelation[firstLag]
+  baseline = (correlationSum(sizesX + innerOffset, sizesX + outerOffset)
+    + correlationSum(sizesX - outerOffset, sizesX - innerOffset)) / (2 * (outerOffset - innerOffset + 1))
+
+  # Score of a row length: how much of the correlation that is lost by shifting
+  # the neighbor row is restored at this lag (peak height, relative to the baseline),
+  # weighted by the correlation of neighbor voxels (misinterpreted pixel type results in noisy voxels).
+  peak = (correlation[sizesX] - baseline) / np.maximum(1.0 - baseline, 1e-6)
+  scores = peak * max(0.0, correlation[1])
+
+  # Keep the best few row lengths of each pixel type. Multiples of the row length also give high scores
+  # (correlation with every second, third, ... row), therefore the shortest row length is preferred
+  # if its score is almost as high.
+  # Peaks at multiples are wider, therefore the multiple may be off by a few voxels.
+  def score(sizeX):
+    index = np.searchsorted(sizesX, sizeX)
+    return scores[index] if index < sizesX.size and sizesX[index] == sizeX else 0.0
+  def isNearMultiple(sizeX, baseSizeX):
+    multiplier = int(round(float(sizeX) / baseSizeX))
+    return multiplier >= 1 and abs(sizeX - multiplier * baseSizeX) <= multiplier
+  selectedSizesX = []
+  for index in np.argsort(-scores)[:30]:
+    if scores[index] <= 0:
+      break
+    sizeX = int(sizesX[index])
+    for divisor in range(min(8, sizeX // int(sizesX[0])), 1, -1):
+      baseSizesX = [baseSizeX for baseSizeX in range(sizeX // divisor - 1, sizeX // divisor + 2) if isNearMultiple(sizeX, baseSizeX)]
+      baseScores = [score(baseSizeX) for baseSizeX in baseSizesX]
+      if baseScores and max(baseScores) >= 0.9 * scores[index]:
+        sizeX = baseSizesX[int(np.argmax(baseScores))]
+        break
+    if any(abs(sizeX - selected) <= 2 or isNearMultiple(sizeX, selected) for selected in selectedSizesX):
+      continue
+    selectedSizesX.append(sizeX)
+    if len(selectedSizesX) >= 3:
+      break
+  candidates = []
+  for sizeX in selectedSizesX:
+    candidates.append({
+      'scalarType': scalarType,
+      'numberOfComponents': numberOfComponents,
+      'bigEndian': bigEndian,
+      'lsbFirst': False,
+      'sizeX': sizeX,
+      'score': float(score(sizeX)),
+      })
+  return candidates
+
+def detectHeaderSize(imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY,
+  minimumHeaderSize=0, maximumHeaderSize=10000, sampleSize=4*1024*1024, maximumNumberOfResults=5, blockCache=None):
+  """
+  Find the most plausible header sizes (byte skip) for known pixel type and image size.
+  All header sizes in the specified range are evaluated at once, from a single read of the file:
+  - alignment: voxels are only similar to their neighbors if the offset is aligned with the pixel boundaries
+  - column seam: image content jumps at the true beginning of rows
+  - row seam: image content jumps at the true beginning of slices
+  - file size: voxel data typically ends at the end of the file (after a whole number of slices)
+  Returns list of candidates, ordered by decreasing score. Each candidate is a dict with headerSize and score.
+  """
+  import numpy as np
+
+  if scalarType == PixelTypes.VTK_BIT:
+    # Rows are padded to full bytes, each byte contains 8 voxels
+    pixelSize = 1
+    voxelsPerPixelSize = 8
+    bytesPerRow = (sizeX + 7) // 8
+    voxelsPerRow = bytesPerRow * 8
+  else:
+    dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+    pixelSize = dtype.itemsize * numberOfComponents
+    voxelsPerPixelSize = 1
+    bytesPerRow = sizeX * pixelSize
+    voxelsPerRow = sizeX
+  bytesPerSlice = bytesPerRow * sizeY
+  voxelsPerSlice = voxelsPerRow * sizeY
+
+  totalFilesize = CompressedFile.dataSize(imageFilePath)
+  minimumHeaderSize = max(0, minimumHeaderSize)
+  maximumHeaderSize = min(maximumHeaderSize, totalFilesize - 4 * bytesPerRow)
+  if maximumHeaderSize < minimumHeaderSize:
+    raise ValueError("File is too small for the specified image size and header size range")
+
+  # Read header size range and a sample of the voxel data after it.
+  # Statistics are only computed from the voxel data, after the longest possible header.
+  # Reading more than 2 slices allows detecting the beginning of slices.
+  dataSize = min(max(sampleSize, 2 * bytesPerSlice + 2 * bytesPerRow), 4 * sampleSize, totalFilesize - maximumHeaderSize)
+  buffer = np.frombuffer(readBytes(imageFilePath, minimumHeaderSize,
+    maximumHeaderSize - minimumHeaderSize + dataSize, blockCache), dtype=np.uint8)
+  dataStartVoxel = (maximumHeaderSize - minimumHeaderSize) // pixelSize * voxelsPerPixelSize
+
+  # Compute statistics for each possible position of the first byte of a pixel (phase)
+  alignmentScores = np.zeros(pixelSize)
+  columnSeamScores = np.zeros((pixelSize, voxelsPerRow))
+  rowSeamScores = np.zeros((pixelSize, voxelsPerSlice))
+  for phase in range(pixelSize):
+    if scalarType == PixelTypes.VTK_BIT:
+      values = robustStandardizedValues(np.unpackbits(buffer))
+    else:
+      phaseBuffer = buffer[phase:]
+      phaseBuffer = phaseBuffer[:phaseBuffer.size // pixelSize * pixelSize]
+      with np.errstate(all='ignore'):
+        values = np.frombuffer(phaseBuffer.tobytes(), dtype=dtype)
+        if numberOfComponents > 1:
+          values = values.reshape(-1, numberOfComponents).mean(axis=1)
+        values = robustStandardizedValues(values)
+    if values is None or values.size - dataStartVoxel < 2 * voxelsPerRow:
+      continue
+    data = values[dataStartVoxel:]
+    alignmentScores[phase] = max(0.0, (np.mean(data[1:] * data[:-1])
+      + np.mean(data[voxelsPerRow:] * data[:-voxelsPerRow])) / 2)
+    # Average differences at each voxel position within a row (horizontal neighbors)
+    # and within a slice (vertical neighbors). Positions are relative to the first voxel of the buffer.
+    positions = np.arange(dataStartVoxel, values.size - 1) % voxelsPerRow
+    columnSeamScores[phase] = seamScores(
+      np.bincount(positions, weights=np.abs(np.diff(data)), minlength=voxelsPerRow)
+      / np.maximum(np.bincount(positions, minlength=voxelsPerRow), 1))
+    if data.size >= 2 * voxelsPerSlice + voxelsPerRow:
+      positions = np.arange(dataStartVoxel, values.size - voxelsPerRow) % voxelsPerSlice
+      profile = (np.bincount(positions, weights=np.abs(data[voxelsPerRow:] - data[:-voxelsPerRow]), minlength=voxelsPerSlice)
+        / np.maximum(np.bincount(positions, minlength=voxelsPerSlice), 1))
+      # Vertical neighbors that are in different slices if the slice starts at position i: i-voxelsPerRow..i-1
+      cumulativeProfile = np.concatenate([[0.0], np.cumsum(np.concatenate([profile[-voxelsPerRow:], profile]))])
+      rowSeamScores[phase] = seamScores(
+        (cumulativeProfile[voxelsPerRow:voxelsPerRow+voxelsPerSlice] - cumulativeProfile[:voxelsPerSlice]) / voxelsPerRow)
+  if alignmentScores.max() > 0:
+    alignmentScores /= alignmentScores.max()
+
+  # Evaluate all header sizes. If the header size is correct then the image starts at voxel index
+  # firstVoxel of the buffer, so the column seam is between voxels firstVoxel-1 and firstVoxel.
+  headerSizes = np.arange(minimumHeaderSize, maximumHeaderSize + 1)
+  phases = (headerSizes - minimumHeaderSize) % pixelSize
+  firstVoxels = (headerSizes - minimumHeaderSize) // pixelSize * voxelsPerPixelSize
+  columnSeam = columnSeamScores[phases, (firstVoxels - 1) % voxelsPerRow]
+  rowSeam = rowSeamScores[phases, firstVoxels % voxelsPerSlice]
+  remainingSizes = totalFilesize - headerSizes
+  fileSizeMatch = np.where(remainingSizes % bytesPerSlice == 0, 1.0,
+    np.where(remainingSizes % bytesPerRow == 0, 0.5, 0.0))
+  scores = alignmentScores[phases] * (1.0 + columnSeam + rowSeam + fileSizeMatch) / 4.0
+
+  candidates = []
+  for index in np.argsort(-scores, kind='stable')[:maximumNumberOfResults]:
+    if scores[index] <= 0:
+      break
+    candidates.append({'headerSize': int(headerSizes[index]), 'score': float(scores[index])})
+  return candidates
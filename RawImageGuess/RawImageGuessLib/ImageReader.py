@@ -0,0 +1,503 @@
+"""Reading raw image files into NumPy arrays"""
+
+import os
+import threading
+import weakref
+
+from RawImageGuessLib import CompressedFile, Instrumentation, PixelTypes
+from RawImageGuessLib.BlockCache import BlockCache
+from RawImageGuessLib.BufferPool import BufferPool
+from RawImageGuessLib.ResultCache import ResultCache
+
+def nativeContiguousArray(voxels):
+  """Returns the array if it is C-contiguous, aligned, and in native byte order,
+  otherwise a copy that fulfills these requirements"""
+  import numpy as np
+  if voxels.dtype.isnative and voxels.flags.c_contiguous and voxels.flags.aligned:
+    return voxels
+  return np.ascontiguousarray(voxels, dtype=voxels.dtype.newbyteorder('='))
+
+def decimationFactors(decimation):
+  """Get (decimationX, decimationY, decimationZ) from a single value or a per-axis list"""
+  if isinstance(decimation, (list, tuple)):
+    return tuple(max(1, int(factor)) for factor in decimation)
+  return (max(1, int(decimation)),) * 3
+
+def extentSlices(extent, decimation, sizeX, sizeY, sizeZ):
+  """Get index ranges (Python slice objects for X, Y, Z axes) of an extent, clamped to the image size.
+  Start and stop of the returned ranges are always set.
+  """
+  if extent is None:
+    extent = [0, sizeX-1, 0, sizeY-1, 0, sizeZ-1]
+  ranges = []
+  for axis, (size, factor) in enumerate(zip((sizeX, sizeY, sizeZ), decimationFactors(decimation))):
+    start = max(0, min(extent[axis*2], size - 1))
+    stop = min(max(start, extent[axis*2+1] + 1), size)
+    ranges.append(slice(start, stop, factor))
+  if any(indexRange.start >= indexRange.stop for indexRange in ranges):
+    raise ValueError("Requested extent does not contain any voxels")
+  return tuple(ranges)
+
+def voxelStrides(scalarSize, numberOfComponents, sizeY, rowStride, planar):
+  """Get (row, column, component) strides in bytes of a slice of voxels with rows of rowStride bytes.
+  Components are either interleaved (RGBRGB...) or planar (each component is stored in sizeY rows, one after the other).
+  """
+  if planar:
+    return (rowStride, scalarSize, rowStride * sizeY)
+  return (rowStride, scalarSize * numberOfComponents, scalarSize)
+
+def isMemoryMapped(array):
+  """Returns True if the NumPy array is a view of a memory-mapped file"""
+  import mmap
+  import numpy as np
+  while array is not None:
+    if isinstance(array, (np.memmap, mmap.mmap)):
+      return True
+    array = getattr(array, 'base', None)
+  return False
+
+def bitUnpackingTable(lsbFirst):
+  """Get lookup table that maps a byte value to its 8 bits, as voxel values of 0 or 255"""
+  import numpy as np
+  bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1, bitorder='little' if lsbFirst else 'big')
+  return bits * np.uint8(255)
+
+class ImageReader(object):
+  """Reads images (or parts of images) from raw image files into NumPy arrays.
+  Can be used from multiple threads.
+  """
+
+  def __init__(self):
+    # Byte-aligned pixel types are read through a memory mapping of the input file.
+    # The file is mapped once (per path, size, and modification time) and changing
+    # parameters only creates a new view of the mapping.
+    self.memoryMappingEnabled = True
+    self.mappedFile = None
+    self.mappedFileKey = None
+    # readImage may be called from a background thread
+    self.mappedFileLock = threading.Lock()
+    # All other reads (1bpp images, guessing, compressed files, and byte-aligned images if memory mapping is disabled,
+    # which may be preferable for files on network storage) go through a block cache,
+    # which keeps recently read parts of files in memory.
+    self.blockCache = BlockCache()
+    # Recently read images, for quickly switching between parameter sets
+    self.resultCache = ResultCache()
+    self.resultCache.evictionCallback = self._onResultEvicted
+    # Output arrays are allocated from a buffer pool. Images that are not used anymore are given back
+    # by releaseImage and their memory is reused for reading the next image of the same size and pixel type.
+    self.bufferPool = BufferPool()
+    # Arrays returned by readImage that may be released: id -> array
+    self.reusableArrays = weakref.WeakValueDictionary()
+    # Ids of reusable arrays that have been released while they were still in the result cache
+    # (they are given to the buffer pool when they are removed from the result cache)
+    self.releasedCachedArrayIds = set()
+    self.reusableArraysLock = threading.Lock()
+    # Number of threads used for reading and decoding images (None = number of CPUs)
+    self.numberOfThreads = None
+    # Byte-aligned images are read and decoded by multiple threads, in chunks of slices of about this size
+    self.chunkSize = 16*1024*1024
+
+  def readImage(self, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    extent=None, decimation=1, useResultCache=True, rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Reads image voxels into a (sizeZ, sizeY, sizeX, numberOfComponents) NumPy array
+    (1bpp images are expanded to 8-bit unsigned char).
+    Rows may be padded to rowStride bytes, each slice may start with a header of sliceHeaderSize bytes,
+    and components may be stored in planes (see PixelTypes.sliceSize).
+    Optionally, only a sub-extent ([xMin, xMax, yMin, yMax, zMin, zMax] voxel index range) is read
+    and only every decimation-th voxel is kept (decimation can be specified for all axes or per axis).
+    Recently read images are returned from the result cache (unless useResultCache is disabled,
+    for example because the caller keeps the images in its own cache).
+    The MRML scene is not accessed, therefore this method can be called from a background thread.
+    Stages of reading are recorded in the profile that is active in the calling thread (see Instrumentation).
+    """
+    with Instrumentation.stage('stat'):
+      key = self.resultKey(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+        sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation, rowStride, sliceHeaderSize, planar)
+    if useResultCache:
+      with Instrumentation.stage('result cache'):
+        with self.reusableArraysLock:
+          voxels = self.resultCache.get(key)
+          if voxels is not None:
+            # The array is used again, so it must not be reused when it is removed from the cache
+            self.releasedCachedArrayIds.discard(id(voxels))
+      if voxels is not None:
+        return voxels
+    voxels = self._readImage(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation, rowStride, sliceHeaderSize, planar)
+    if useResultCache:
+      # Arrays read with useResultCache disabled are kept by the caller, therefore they are not reusable.
+      self._addResult(key, voxels)
+    return voxels
+
+  def prefetchImage(self, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    extent=None, decimation=1, rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Read the image into the result cache (if it is not there yet), so that a later readImage call with the same
+    parameters returns immediately. Does not count as a hit or miss of the result cache.
+    Returns True if the image has been read and stored (memory-mapped images are not stored, as they are
+    created without reading the file).
+    """
+    key = self.resultKey(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation, rowStride, sliceHeaderSize, planar)
+    if self.resultCache.contains(key):
+      return False
+    voxels = self._readImage(imageFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst,
+      sizeX, sizeY, sizeZ, headerSize, skipSlices, extent, decimation, rowStride, sliceHeaderSize, planar)
+    return self._addResult(key, voxels)
+
+  def _addResult(self, key, voxels):
+    """Store a read image in the result cache. Returns True if it has been stored."""
+    if isMemoryMapped(voxels):
+      # Memory-mapped arrays are not cached, as creating them does not require reading the file
+      return False
+    with self.reusableArraysLock:
+      self.reusableArrays[id(voxels)] = voxels
+    return self.resultCache.add(key, voxels)
+
+  def resultKey(self, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    extent=None, decimation=1, rowStride=0, sliceHeaderSize=0, planar=False):
+    """Returns the key of an image in the result cache (file path, size, and modification time, and image parameters)"""
+    fileStat = os.stat(imageFilePath)
+    return (os.path.abspath(imageFilePath), fileStat.st_size, fileStat.st_mtime_ns,
+      scalarType, numberOfComponents, bool(bigEndian), bool(lsbFirst), sizeX, sizeY, sizeZ, headerSize, skipSlices,
+      tuple(extent) if extent is not None else None, decimationFactors(decimation),
+      rowStride, sliceHeaderSize, bool(planar) and numberOfComponents > 1)
+
+  def releaseImage(self, voxels):
+    """
+    Give back an array that has been returned by readImage and is not used anymore (for example, because
+    the output volume shows a new image). Its memory is reused for reading the next image of the same size and
+    pixel type, therefore the caller must not access the array (or views of it) after this.
+    Arrays that are in the result cache are reused when they are removed from the cache.
+    Memory-mapped arrays and arrays that were read with useResultCache disabled are ignored.
+    """
+    with self.reusableArraysLock:
+      if self.reusableArrays.get(id(voxels)) is not voxels:
+        return
+      if self.resultCache.containsArray(voxels):
+        self.releasedCachedArrayIds.add(id(voxels))
+        return
+      del self.reusableArrays[id(voxels)]
+    self.bufferPool.release(voxels)
+
+  def _onResultEvicted(self, key, voxels):
+    with self.reusableArraysLock:
+      if id(voxels) not in self.releasedCachedArrayIds or self.reusableArrays.get(id(voxels)) is not voxels:
+        return
+      self.releasedCachedArrayIds.discard(id(voxels))
+      del self.reusableArrays[id(voxels)]
+    self.bufferPool.release(voxels)
+
+  def _readImage(self, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    extent, decimation, rowStride=0, sliceHeaderSize=0, planar=False):
+    """Reads image voxels, without using the result cache"""
+    if scalarType == PixelTypes.VTK_BIT:
+      # Special case: 1bpp input (expanded to 8-bit unsigned char)
+
+      # Compute data sizes in bytes for bit-packed rows/slices
+      bytesPerRow = PixelTypes.rowStrideInBytes(scalarType, 1, sizeX, rowStride)
+      bytesPerSlice = PixelTypes.sliceSize(scalarType, 1, sizeX, sizeY, rowStride, sliceHeaderSize)
+      totalHeaderSize = headerSize + skipSlices * bytesPerSlice
+
+      with Instrumentation.stage('stat'):
+        totalFilesize = CompressedFile.dataSize(imageFilePath)
+      voxelDataSize = max(0, totalFilesize - totalHeaderSize)
+      maxNumberOfSlices = int(voxelDataSize // bytesPerSlice)
+      finalSizeZ = int(min(sizeZ, maxNumberOfSlices))
+      if finalSizeZ < 1:
+        raise ValueError("No voxel data available at specified header offset/size for 1bpp input")
+      (xRange, yRange, zRange) = extentSlices(extent, decimation, sizeX, sizeY, finalSizeZ)
+
+      return self.readBitImageSlices(imageFilePath, totalHeaderSize + sliceHeaderSize, bytesPerRow, bytesPerSlice,
+        xRange, yRange, zRange, lsbFirst)
+
+    else:
+      # Default path for byte-aligned pixel types
+      packed = PixelTypes.isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar)
+      sliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride, sliceHeaderSize, planar)
+      totalHeaderSize = headerSize + skipSlices * sliceSize
+      with Instrumentation.stage('stat'):
+        totalFilesize = CompressedFile.dataSize(imageFilePath)
+      voxelDataSize = totalFilesize - totalHeaderSize
+      maxNumberOfSlices = int(voxelDataSize/sliceSize)
+      finalSizeZ = min(sizeZ, maxNumberOfSlices)
+
+      if finalSizeZ < 1:
+        raise ValueError("No voxel data available at specified header offset/size")
+      (xRange, yRange, zRange) = extentSlices(extent, decimation, sizeX, sizeY, finalSizeZ)
+
+      # Compressed files cannot be memory-mapped, they are decompressed through the block cache
+      if self.memoryMappingEnabled and not CompressedFile.isCompressed(imageFilePath):
+        with Instrumentation.stage('map'):
+          voxels = self.mappedVoxels(imageFilePath, scalarType, numberOfComponents, bigEndian,
+            sizeX, sizeY, finalSizeZ, totalHeaderSize, rowStride, sliceHeaderSize, planar)
+        # Pages of the file are read from the disk when they are first accessed,
+        # which is when they are copied (if byte swapping or decimation is needed) or displayed
+        with Instrumentation.stage('decode'):
+          voxels = voxels[zRange, yRange, xRange]
+          if voxels.dtype.isnative and voxels.flags.c_contiguous and voxels.flags.aligned:
+            return voxels
+        # Byte order and layout are converted while copying (pages of the file are read by multiple threads in parallel)
+        output = self.bufferPool.acquire(voxels.shape, voxels.dtype.newbyteorder('='))
+        def copySlices(sliceRange):
+          with Instrumentation.stage('decode'):
+            output[sliceRange.start:sliceRange.stop] = voxels[sliceRange.start:sliceRange.stop]
+        self.processSliceChunks(output.shape[0], output[0].nbytes, copySlices)
+        return output
+
+      dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+      if not packed:
+        return self.readStridedImage(imageFilePath, dtype, numberOfComponents, sizeX, sizeY,
+          totalHeaderSize + sliceHeaderSize, sliceSize, PixelTypes.rowStrideInBytes(scalarType, numberOfComponents,
+          sizeX, rowStride, planar), planar, xRange, yRange, zRange)
+      if zRange.step > 1 or yRange.start > 0 or yRange.stop < sizeY:
+        return self.readImageRows(imageFilePath, dtype, numberOfComponents, sizeX, totalHeaderSize, sliceSize,
+          xRange, yRange, zRange)
+
+      # Only read the requested slices
+      numberOfSlices = zRange.stop - zRange.start
+      allColumns = (xRange.start == 0 and xRange.stop == sizeX and xRange.step == 1)
+      # If all columns are needed then the file is read directly into the output array
+      voxels = self.bufferPool.acquire((numberOfSlices, sizeY, sizeX, numberOfComponents), dtype.newbyteorder('='))
+      self.readSlicesInto(imageFilePath, totalHeaderSize + zRange.start * sliceSize, dtype, voxels)
+      if allColumns:
+        return voxels
+      with Instrumentation.stage('decode'):
+        output = self.bufferPool.acquire(voxels[:, :, xRange].shape, voxels.dtype)
+        output[...] = voxels[:, :, xRange]
+        self.bufferPool.release(voxels)
+        return output
+
+  def processSliceChunks(self, numberOfSlices, sliceSize, function):
+    """
+    Call function with ranges of slice indices (chunks of about chunkSize bytes) that together cover
+    all slices. Chunks are processed by multiple threads in parallel (file reading and NumPy copying
+    release the GIL), stages are recorded in the profile of the calling thread.
+    """
+    import concurrent.futures
+    slicesPerChunk = max(1, self.chunkSize // max(1, sliceSize))
+    chunks = [range(start, min(start + slicesPerChunk, numberOfSlices)) for start in range(0, numberOfSlices, slicesPerChunk)]
+    numberOfThreads = max(1, min(self.numberOfThreads or os.cpu_count() or 1, len(chunks)))
+    if numberOfThreads == 1:
+      for chunk in chunks:
+        function(chunk)
+      return
+    profile = Instrumentation.currentProfile()
+    def processChunk(chunk):
+      with Instrumentation.activeProfile(profile):
+        function(chunk)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+      for future in [executor.submit(processChunk, chunk) for chunk in chunks]:
+        future.result()
+
+  def readSlicesInto(self, imageFilePath, offset, dtype, voxels):
+    """
+    Read consecutive slices of a byte-aligned image starting at offset into a native byte order
+    (numberOfSlices, sizeY, sizeX, numberOfComponents) array. dtype is the voxel type in the file.
+    Chunks of slices are read by multiple threads in parallel, using positioned reads directly into the output.
+    If the byte order of the file is not native and multiple threads are used then each thread reads its chunk
+    in blocks into a small buffer and bytes are swapped while copying into the output, because NumPy only
+    releases the GIL during copying (in-place byte swapping would run on one thread at a time).
+    """
+    import numpy as np
+    numberOfSlices = voxels.shape[0]
+    sliceSize = voxels[0].nbytes
+    numberOfThreads = min(self.numberOfThreads or os.cpu_count() or 1, -(-numberOfSlices * sliceSize // self.chunkSize))
+    if numberOfThreads <= 1 or dtype.isnative:
+      def readSlices(sliceRange):
+        with Instrumentation.stage('read'):
+          self.blockCache.readInto(imageFilePath, offset + sliceRange.start * sliceSize,
+            voxels[sliceRange.start:sliceRange.stop].view(dtype))
+        if not dtype.isnative:
+          with Instrumentation.stage('decode'):
+            # Swap bytes in the array that has just been read instead of making a copy
+            voxels[sliceRange.start:sliceRange.stop].view(dtype).byteswap(inplace=True)
+      if numberOfThreads <= 1:
+        readSlices(range(0, numberOfSlices))
+      else:
+        self.processSliceChunks(numberOfSlices, sliceSize, readSlices)
+      return
+
+    blockValues = max(1, self.blockCache.blockSize // dtype.itemsize)
+    threadBuffers = threading.local()
+    def readAndSwapSlices(sliceRange):
+      if not hasattr(threadBuffers, 'buffer'):
+        threadBuffers.buffer = np.empty(blockValues, dtype=dtype)
+      buffer = threadBuffers.buffer
+      output = voxels[sliceRange.start:sliceRange.stop].reshape(-1)
+      chunkOffset = offset + sliceRange.start * sliceSize
+      for start in range(0, output.size, blockValues):
+        count = min(blockValues, output.size - start)
+        with Instrumentation.stage('read'):
+          self.blockCache.readInto(imageFilePath, chunkOffset + start * dtype.itemsize, buffer[:count])
+        with Instrumentation.stage('decode'):
+          output[start:start + count] = buffer[:count]
+    self.processSliceChunks(numberOfSlices, sliceSize, readAndSwapSlices)
+
+  def readImageRows(self, imageFilePath, dtype, numberOfComponents, sizeX, offset, sliceSize, xRange, yRange, zRange):
+    """
+    Read the requested rows of the requested slices of a byte-aligned image into a
+    (sizeZ, sizeY, sizeX, numberOfComponents) array, one slice at a time.
+    Slices that are skipped due to decimation or cropping are not read at all and from each slice only the range
+    of rows that contain requested voxels is read (or each requested row separately, if the skipped rows
+    are larger than a block of the read cache). Therefore, the memory usage and amount of data read from the file
+    are proportional to the size of the output, which allows inspecting images that are larger than the memory.
+    """
+    zIndices = range(zRange.start, zRange.stop, zRange.step)
+    rowIndices = range(yRange.start, yRange.stop, yRange.step)
+    numberOfColumns = len(range(xRange.start, xRange.stop, xRange.step))
+    voxels = self.bufferPool.acquire((len(zIndices), len(rowIndices), numberOfColumns, numberOfComponents), dtype.newbyteorder('='))
+    rowSize = sizeX * numberOfComponents * dtype.itemsize
+    readRowsSeparately = (yRange.step > 1 and rowSize * (yRange.step - 1) >= self.blockCache.blockSize)
+    if readRowsSeparately:
+      rows = self.bufferPool.acquire((1, sizeX, numberOfComponents), dtype)
+    else:
+      rows = self.bufferPool.acquire((yRange.stop - yRange.start, sizeX, numberOfComponents), dtype)
+    for outputSliceIndex, sliceIndex in enumerate(zIndices):
+      sliceOffset = offset + sliceIndex * sliceSize
+      if readRowsSeparately:
+        for outputRowIndex, rowIndex in enumerate(rowIndices):
+          with Instrumentation.stage('read'):
+            self.blockCache.readInto(imageFilePath, sliceOffset + rowIndex * rowSize, rows)
+          with Instrumentation.stage('decode'):
+            # Byte order is converted while copying
+            voxels[outputSliceIndex, outputRowIndex] = rows[0, xRange]
+      else:
+        with Instrumentation.stage('read'):
+          self.blockCache.readInto(imageFilePath, sliceOffset + yRange.start * rowSize, rows)
+        with Instrumentation.stage('decode'):
+          voxels[outputSliceIndex] = rows[::yRange.step, xRange]
+    self.bufferPool.release(rows)
+    return voxels
+
+  def readStridedImage(self, imageFilePath, dtype, numberOfComponents, sizeX, sizeY, offset, sliceSize, rowStride, planar,
+      xRange, yRange, zRange):
+    """
+    Read the requested voxels of a byte-aligned image that has padded rows, slice headers, or planar components
+    into a (sizeZ, sizeY, sizeX, numberOfComponents) array. offset is the position of the voxel data of the first slice.
+    From each requested slice the bytes that contain the requested rows (of all component planes) are read
+    into a buffer, which is then decoded by copying a strided view of the buffer into the output
+    (layout and byte order are converted in one copy). Slices are processed by multiple threads in parallel.
+    """
+    import numpy as np
+    zIndices = range(zRange.start, zRange.stop, zRange.step)
+    numberOfRows = len(range(yRange.start, yRange.stop, yRange.step))
+    numberOfColumns = len(range(xRange.start, xRange.stop, xRange.step))
+    voxels = self.bufferPool.acquire((len(zIndices), numberOfRows, numberOfColumns, numberOfComponents), dtype.newbyteorder('='))
+    numberOfPlanes = numberOfComponents if planar else 1
+    strides = voxelStrides(dtype.itemsize, numberOfComponents, sizeY, rowStride, planar)
+    # Bytes from the first requested row of the first plane to the end of the last requested row of the last plane
+    firstByte = yRange.start * rowStride
+    lastByte = ((numberOfPlanes - 1) * sizeY + yRange.stop - 1) * rowStride + strides[1] * sizeX
+    threadBuffers = threading.local()
+    def readSlices(outputSliceRange):
+      if not hasattr(threadBuffers, 'buffer'):
+        threadBuffers.buffer = np.empty(lastByte - firstByte, dtype=np.uint8)
+      buffer = threadBuffers.buffer
+      for outputSliceIndex in outputSliceRange:
+        with Instrumentation.stage('read'):
+          if self.blockCache.readInto(imageFilePath, offset + zIndices[outputSliceIndex] * sliceSize + firstByte,
+              buffer) < buffer.size:
+            raise ValueError("No voxel data available at specified header offset/size")
+        with Instrumentation.stage('decode'):
+          sliceVoxels = np.ndarray((yRange.stop - yRange.start, sizeX, numberOfComponents), dtype=dtype,
+            buffer=buffer, strides=strides)
+          voxels[outputSliceIndex] = sliceVoxels[::yRange.step, xRange]
+    self.processSliceChunks(len(zIndices), max(1, lastByte - firstByte), readSlices)
+    return voxels
+
+  def readBitImageSlices(self, imageFilePath, offset, bytesPerRow, bytesPerSlice, xRange, yRange, zRange, lsbFirst):
+    """
+    Unpack slices of a 1bpp image into a preallocated 8-bit (sizeZ, sizeY, sizeX, 1) array.
+    Each slice is read and unpacked separately (using a lookup table that maps each byte to 8 voxels),
+    therefore only one packed and one unpacked slice is stored temporarily per thread.
+    Only the requested slices and the range of rows that contain requested voxels are read.
+    Slices are processed by multiple threads in parallel (file reading and NumPy indexing release the GIL).
+    """
+    import numpy as np
+    import concurrent.futures
+
+    lookupTable = bitUnpackingTable(lsbFirst)
+    zIndices = range(zRange.start, zRange.stop, zRange.step)
+    rowIndices = range(yRange.start, yRange.stop, yRange.step)
+    voxels = self.bufferPool.acquire((len(zIndices), len(rowIndices), len(range(xRange.start, xRange.stop, xRange.step)), 1), np.uint8)
+
+    # Only unpack the bytes that contain the requested columns
+    firstByte = xRange.start // 8
+    lastByte = (xRange.stop - 1) // 8
+    numberOfBytes = lastByte - firstByte + 1
+    columns = slice(xRange.start - firstByte * 8, xRange.stop - firstByte * 8, xRange.step)
+    # Unpacked bytes can be written directly into the output if all of their voxels are needed
+    unpackDirectly = (xRange.step == 1 and xRange.start % 8 == 0 and xRange.stop - xRange.start == numberOfBytes * 8)
+
+    # Worker threads record their stages in the profile of the calling thread
+    profile = Instrumentation.currentProfile()
+
+    def unpackSlices(outputSliceIndices):
+      with Instrumentation.activeProfile(profile):
+        packedSlice = np.empty((yRange.stop - yRange.start) * bytesPerRow, dtype=np.uint8)
+        for outputSliceIndex in outputSliceIndices:
+          sliceOffset = offset + zIndices[outputSliceIndex] * bytesPerSlice + yRange.start * bytesPerRow
+          with Instrumentation.stage('read'):
+            if self.blockCache.readInto(imageFilePath, sliceOffset, packedSlice) < packedSlice.size:
+              raise ValueError("No voxel data available at specified header offset/size for 1bpp input")
+          with Instrumentation.stage('unpack'):
+            packedRows = packedSlice.reshape(-1, bytesPerRow)[::yRange.step, firstByte:lastByte+1]
+            if unpackDirectly:
+              np.take(lookupTable, packedRows, axis=0,
+                out=voxels[outputSliceIndex].reshape(len(rowIndices), numberOfBytes, 8))
+            else:
+              unpackedRows = lookupTable[packedRows].reshape(len(rowIndices), numberOfBytes * 8)
+              voxels[outputSliceIndex, :, :, 0] = unpackedRows[:, columns]
+
+    # Each thread processes a contiguous range of slices
+    numberOfThreads = max(1, min(self.numberOfThreads or os.cpu_count() or 1, len(zIndices)))
+    sliceRangeBounds = [len(zIndices) * threadIndex // numberOfThreads for threadIndex in range(numberOfThreads + 1)]
+    sliceRanges = [range(sliceRangeBounds[threadIndex], sliceRangeBounds[threadIndex + 1]) for threadIndex in range(numberOfThreads)]
+    if numberOfThreads == 1:
+      unpackSlices(sliceRanges[0])
+    else:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+        for future in [executor.submit(unpackSlices, sliceRange) for sliceRange in sliceRanges]:
+          future.result()
+    return voxels
+
+  def mapFile(self, imageFilePath):
+    """
+    Returns the content of the file as a memory-mapped uint8 NumPy array.
+    The mapping is reused until the path, size, or modification time of the file changes.
+    """
+    import numpy as np
+    fileStat = os.stat(imageFilePath)
+    mappedFileKey = (os.path.abspath(imageFilePath), fileStat.st_size, fileStat.st_mtime_ns)
+    with self.mappedFileLock:
+      if mappedFileKey != self.mappedFileKey:
+        self.mappedFile = None
+        self.mappedFileKey = None
+        # Copy-on-write mapping: pages are shared with the file system cache,
+        # and the file is never modified, even if the output volume is edited.
+        self.mappedFile = np.memmap(imageFilePath, dtype=np.uint8, mode='c')
+        self.mappedFileKey = mappedFileKey
+      return self.mappedFile
+
+  def mappedVoxels(self, imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY, sizeZ, offset,
+      rowStride=0, sliceHeaderSize=0, planar=False):
+    """
+    Returns the requested extent of the file as a (sizeZ, sizeY, sizeX, numberOfComponents) NumPy array.
+    The array is a view of the memory-mapped file, in the byte order of the file
+    (use nativeContiguousArray to get an array that can be used as image data).
+    Padded rows, slice headers, and planar components are skipped by the strides of the view, without copying.
+    """
+    import numpy as np
+    mappedFile = self.mapFile(imageFilePath)
+    dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian)
+    sliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride, sliceHeaderSize, planar)
+    strides = voxelStrides(dtype.itemsize, numberOfComponents, sizeY,
+      PixelTypes.rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride, planar), planar)
+    return np.ndarray((sizeZ, sizeY, sizeX, numberOfComponents), dtype=dtype, buffer=mappedFile,
+      offset=offset + sliceHeaderSize, strides=(sliceSize,) + strides)
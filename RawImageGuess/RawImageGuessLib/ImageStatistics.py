@@ -0,0 +1,101 @@
+"""Statistics of voxel values, computed from a sample of the voxels"""
+
+def _vanDerCorput(index):
+  """Get the index-th element of the base-2 van der Corput sequence (0, 0.5, 0.25, 0.75, 0.125, ...)"""
+  value = 0.0
+  denominator = 1.0
+  while index:
+    denominator *= 2.0
+    value += (index & 1) / denominator
+    index >>= 1
+  return value
+
+class SampledStatistics(object):
+  """Value range, robust (percentile-clipped) display range, and histogram of voxel values, estimated from
+  evenly spread runs of consecutive voxels of the image (runs reduce the number of accessed memory pages, which
+  matters if the image is memory-mapped and pages are read from the file when they are first accessed).
+  Statistics of an image with wrong parameters (for example, random bytes decoded as floating-point values)
+  are computed as fast as statistics of a valid image, as only the sampled voxels are accessed and
+  non-finite values (NaN, infinity) are skipped.
+  Statistics can be refined by calling addSamples again, which samples voxels between the previously sampled ones,
+  until all voxels (or maximumNumberOfSamples voxels) are sampled.
+  """
+
+  def __init__(self, voxels, lowerPercentile=0.5, upperPercentile=99.5, numberOfBins=256, maximumNumberOfSamples=1024*1024,
+      runLength=64):
+    self.voxels = voxels
+    self.runLength = runLength
+    self.lowerPercentile = lowerPercentile
+    self.upperPercentile = upperPercentile
+    self.numberOfBins = numberOfBins
+    self.maximumNumberOfSamples = maximumNumberOfSamples
+    # Finite sampled values, one array per addSamples call
+    self.sampledValues = []
+    self.numberOfPasses = 0
+    self.numberOfSamples = 0
+    self.numberOfNonFiniteSamples = 0
+    # All voxels have been sampled
+    self.complete = False
+    # (minimum, maximum) of sampled finite values, None if there are none
+    self.scalarRange = None
+    # (lower, upper) percentile of sampled finite values, None if there are none
+    self.windowRange = None
+    # Number of sampled values in each of numberOfBins equal bins between lower and upper percentile
+    # (values outside the window range are counted in the first and last bins)
+    self.histogram = None
+
+  def isRefinable(self):
+    """Returns True if addSamples would sample more voxels"""
+    return not self.complete and self.numberOfSamples < self.maximumNumberOfSamples
+
+  def addSamples(self, numberOfSamples):
+    """Sample (approximately) numberOfSamples more voxels and update statistics. Returns True if voxels were sampled."""
+    import numpy as np
+    if not self.isRefinable():
+      return False
+    # Voxels of all components are sampled
+    values = self.voxels.reshape(-1)
+    if values.size <= numberOfSamples and self.numberOfPasses == 0:
+      samples = values
+      self.complete = True
+    else:
+      # Each pass samples runs at the same fractional stride, shifted by a van der Corput offset,
+      # so that each pass fills gaps between the previously sampled runs.
+      # The stride is not an integer, so sampled runs are not aligned with image rows.
+      numberOfSamples = min(numberOfSamples, self.maximumNumberOfSamples - self.numberOfSamples)
+      numberOfRuns = max(1, numberOfSamples // self.runLength)
+      stride = float(values.size) / numberOfRuns
+      offset = _vanDerCorput(self.numberOfPasses) * stride
+      runStarts = (np.arange(numberOfRuns) * stride + offset).astype(np.int64)
+      indices = (runStarts[:, np.newaxis] + np.arange(self.runLength)).reshape(-1)
+      samples = values[np.minimum(indices, values.size - 1)]
+    self.numberOfPasses += 1
+    self.numberOfSamples += samples.size
+    if self.numberOfSamples >= values.size:
+      self.complete = True
+    if samples.dtype.kind == 'f':
+      finite = np.isfinite(samples)
+      self.numberOfNonFiniteSamples += int(samples.size - np.count_nonzero(finite))
+      samples = samples[finite]
+    if samples.size > 0:
+      # Copy, as the image array may be reused when it is not displayed anymore
+      self.sampledValues.append(np.array(samples, dtype=np.float64))
+    self._update()
+    return True
+
+  def _update(self):
+    import numpy as np
+    if not self.sampledValues:
+      return
+    if len(self.sampledValues) > 1:
+      self.sampledValues = [np.concatenate(self.sampledValues)]
+    values = self.sampledValues[0]
+    self.scalarRange = (float(values.min()), float(values.max()))
+    (lower, upper) = np.percentile(values, [self.lowerPercentile, self.upperPercentile])
+    self.windowRange = (float(lower), float(upper))
+    if upper > lower:
+      self.histogram = np.histogram(np.clip(values, lower, upper), bins=self.numberOfBins, range=(lower, upper))[0]
+    else:
+      histogram = np.zeros(self.numberOfBins, dtype=np.int64)
+      histogram[0] = values.size
+      self.histogram = histogram
@@ -0,0 +1,145 @@
+"""
+Optional measurement of wall time, bytes read, and allocated memory of each stage of an image update.
+
+A profile is activated for the current thread using activeProfile(). Code that implements a stage
+of reading or displaying an image is enclosed in a stage() block and reports the number of bytes it has
+read from files by calling addBytesRead(). If no profile is active (profiling is disabled)
+then these functions do nothing.
+
+Memory tracking uses tracemalloc, which slows down all memory allocations of the process while it is on.
+It is started by the first profile that tracks memory and must be stopped by calling stopMemoryTracking()
+when profiling is disabled.
+"""
+
+import contextlib
+import threading
+import time
+
+_threadState = threading.local()
+
+# True if tracemalloc was started by startMemoryTracking (and therefore it should be stopped by stopMemoryTracking)
+_memoryTrackingStarted = False
+
+class Profile(object):
+  """Wall time, bytes read, and allocated memory of stages of an image update.
+  Allocated memory is the increase of memory allocated by Python and NumPy during the stage
+  (measured using tracemalloc, only if trackMemory is enabled, as it slows down memory allocations).
+  Memory allocated by other threads during the same time is included, too.
+  """
+
+  def __init__(self, name, trackMemory=False):
+    self.name = name
+    self.trackMemory = trackMemory
+    # List of dicts with name, time (in seconds), bytesRead, allocatedBytes (None if memory is not tracked),
+    # and count (number of times the stage was executed), in order of first execution
+    self.stages = []
+    self.startTime = time.perf_counter()
+    self.totalTime = None
+    self.lock = threading.Lock()
+    if trackMemory:
+      startMemoryTracking()
+
+  def addStage(self, name, stageTime, bytesRead=0, allocatedBytes=None):
+    """Add measurements of a stage. Stages that are executed multiple times (such as reading of each slice,
+    possibly in multiple threads) are added up, therefore time of parallel stages may exceed the total time.
+    """
+    with self.lock:
+      for stage in self.stages:
+        if stage['name'] == name:
+          stage['time'] += stageTime
+          stage['bytesRead'] += bytesRead
+          if allocatedBytes is not None:
+            stage['allocatedBytes'] = (stage['allocatedBytes'] or 0) + allocatedBytes
+          stage['count'] += 1
+          return
+      self.stages.append({'name': name, 'time': stageTime, 'bytesRead': bytesRead, 'allocatedBytes': allocatedBytes, 'count': 1})
+
+  def finish(self):
+    """Set total time of the update (time since the profile was created)"""
+    self.totalTime = time.perf_counter() - self.startTime
+
+  def summary(self):
+    """Get profile as a single line of text, for example:
+    Update: 35.2 ms - stat: 0.1 ms, read: 20.3 ms (8.0 MB read), decode: 10.5 ms (8.0 MB allocated), ...
+    """
+    stageSummaries = []
+    for stage in self.stages:
+      details = []
+      if stage['bytesRead']:
+        details.append(formatSize(stage['bytesRead']) + " read")
+      if stage['allocatedBytes']:
+        details.append(formatSize(stage['allocatedBytes']) + " allocated")
+      stageSummaries.append("{0}: {1:.1f} ms{2}".format(stage['name'], stage['time'] * 1000.0,
+        " ({0})".format(", ".join(details)) if details else ""))
+    totalTime = self.totalTime if self.totalTime is not None else time.perf_counter() - self.startTime
+    return "{0}: {1:.1f} ms - {2}".format(self.name, totalTime * 1000.0, ", ".join(stageSummaries))
+
+def startMemoryTracking():
+  """Start tracing of memory allocations (if it is not on already)"""
+  global _memoryTrackingStarted
+  import tracemalloc
+  if not tracemalloc.is_tracing():
+    tracemalloc.start()
+    _memoryTrackingStarted = True
+
+def stopMemoryTracking():
+  """Stop tracing of memory allocations if it was started by startMemoryTracking.
+  Tracing that was started by other code (for example, using the PYTHONTRACEMALLOC environment variable) is kept.
+  """
+  global _memoryTrackingStarted
+  if not _memoryTrackingStarted:
+    return
+  import tracemalloc
+  tracemalloc.stop()
+  _memoryTrackingStarted = False
+
+def formatSize(numberOfBytes):
+  """Get human-readable size (in kB below 1 MB)"""
+  if numberOfBytes < 1024 * 1024:
+    return "{0:.1f} kB".format(numberOfBytes / 1024.0)
+  return "{0:.1f} MB".format(numberOfBytes / (1024.0 * 1024.0))
+
+@contextlib.contextmanager
+def activeProfile(profile):
+  """Record stages that are executed in the current thread in the profile (None disables recording)"""
+  previousProfile = getattr(_threadState, 'profile', None)
+  previousBytesRead = getattr(_threadState, 'bytesRead', None)
+  _threadState.profile = profile
+  _threadState.bytesRead = None
+  try:
+    yield profile
+  finally:
+    _threadState.profile = previousProfile
+    _threadState.bytesRead = previousBytesRead
+
+def currentProfile():
+  """Get the profile that is active in the current thread (None if profiling is disabled)"""
+  return getattr(_threadState, 'profile', None)
+
+def addBytesRead(numberOfBytes):
+  """Add number of bytes read from files to the current stage"""
+  if getattr(_threadState, 'bytesRead', None) is not None:
+    _threadState.bytesRead += numberOfBytes
+
+@contextlib.contextmanager
+def stage(name):
+  """Measure a stage of the update and add it to the active profile of the current thread"""
+  profile = currentProfile()
+  if profile is None:
+    yield
+    return
+  previousBytesRead = _threadState.bytesRead
+  _threadState.bytesRead = 0
+  if profile.trackMemory:
+    import tracemalloc
+    allocatedBytesAtStart = tracemalloc.get_traced_memory()[0]
+  startTime = time.perf_counter()
+  try:
+    yield
+  finally:
+    stageTime = time.perf_counter() - startTime
+    allocatedBytes = max(0, tracemalloc.get_traced_memory()[0] - allocatedBytesAtStart) if profile.trackMemory else None
+    bytesRead = _threadState.bytesRead
+    profile.addStage(name, stageTime, bytesRead, allocatedBytes)
+    # Bytes read in nested stages are included in the enclosing stage as well
+    _threadState.bytesRead = (previousBytesRead + bytesRead) if previousBytesRead is not None else None
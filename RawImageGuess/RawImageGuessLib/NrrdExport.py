@@ -0,0 +1,149 @@
+"""Converting raw image files into NRRD files, in chunks of slices"""
+
+import concurrent.futures
+import gzip
+import io
+import os
+import sys
+import time
+
+from RawImageGuessLib import Instrumentation, NrrdHeader, PixelTypes
+from RawImageGuessLib.ImageReader import ImageReader
+
+def dataFilePathForHeader(outputFilePath, compress):
+  """Get path of the data file that is written next to a detached header (scan.nhdr -> scan.raw or scan.raw.gz)"""
+  return os.path.splitext(outputFilePath)[0] + (".raw.gz" if compress else ".raw")
+
+def exportedHeaderText(scalarType, numberOfComponents, sizeX, sizeY, sizeZ, spacingX, spacingY, spacingZ, numberOfVolumes,
+    compress, dataFileName=None):
+  """Get header of an exported image (data file name is only specified for detached headers)"""
+  headerFile = io.StringIO()
+  NrrdHeader.writeHeaderFields(headerFile, scalarType, numberOfComponents, sys.byteorder == 'big', sizeX, sizeY, sizeZ,
+    spacingX, spacingY, spacingZ, numberOfVolumes, "gzip" if compress else "raw")
+  if dataFileName:
+    headerFile.write("data file: {0}\n".format(dataFileName))
+  return headerFile.getvalue()
+
+def exportNrrd(imageFilePath, outputFilePath, scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ,
+    headerSize, skipSlices, spacingX, spacingY, spacingZ, numberOfVolumes=1, compress=False, compressionLevel=1,
+    chunkSize=64*1024*1024, numberOfThreads=None, progressCallback=None, rowStride=0, sliceHeaderSize=0, planar=False):
+  """
+  Write the image into a NRRD file that does not depend on the raw image file.
+  If outputFilePath ends with .nhdr then voxels are written into a data file next to it (see dataFilePathForHeader),
+  otherwise the header and voxels are written into a single (.nrrd) file.
+  Voxels are read in chunks of about chunkSize bytes (1bpp images are unpacked to 8-bit values of 0 and 255) and written
+  in native byte order, optionally gzip compressed. Memory usage does not depend on the size of the image: only
+  two chunks are stored at a time, the next chunk is read while the previous one is compressed and written.
+  Padded rows, slice headers, and planar components (see PixelTypes.sliceSize) are removed: the exported image
+  is packed, with interleaved components.
+  sizeZ and numberOfVolumes are trimmed to the available voxel data.
+  progressCallback is called with the fraction of read voxels after each chunk. If it returns False then
+  the export is cancelled and the written files are removed.
+  Returns dict with outputFilePath, dataFilePath, bytesRead, bytesWritten, time, and cancelled.
+  """
+  import numpy as np
+  startTime = time.time()
+
+  (finalSizeZ, finalNumberOfVolumes, totalHeaderSize) = NrrdHeader.availableSizeZAndNumberOfVolumes(imageFilePath,
+    scalarType, numberOfComponents, sizeX, sizeY, sizeZ, headerSize, skipSlices, numberOfVolumes,
+    rowStride, sliceHeaderSize, planar)
+  numberOfSlices = finalSizeZ * finalNumberOfVolumes
+  inputSliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride, sliceHeaderSize, planar)
+  # Packed byte-aligned slices are read directly into the chunk buffers, other images are decoded into arrays of the buffer pool
+  pooledChunks = (scalarType == PixelTypes.VTK_BIT
+    or not PixelTypes.isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar))
+  outputScalarType = PixelTypes.VTK_UNSIGNED_CHAR if scalarType == PixelTypes.VTK_BIT else scalarType
+  outputSliceSize = PixelTypes.sliceSize(outputScalarType, numberOfComponents, sizeX, sizeY)
+  slicesPerChunk = max(1, chunkSize // outputSliceSize)
+
+  detached = os.path.splitext(outputFilePath)[1].lower() == ".nhdr"
+  dataFilePath = dataFilePathForHeader(outputFilePath, compress) if detached else outputFilePath
+  for writtenFilePath in set([outputFilePath, dataFilePath]):
+    if os.path.exists(writtenFilePath) and os.path.samefile(writtenFilePath, imageFilePath):
+      raise ValueError("Exported file would overwrite the input file: {0}".format(writtenFilePath))
+
+  # Reads are not cached, as each part of the file is read only once
+  imageReader = ImageReader()
+  imageReader.blockCache.setMaximumSize(0)
+  imageReader.numberOfThreads = numberOfThreads
+
+  def readChunk(start, stop, buffer):
+    """Returns native byte order voxels of slices start..stop-1"""
+    if scalarType == PixelTypes.VTK_BIT:
+      bytesPerRow = PixelTypes.rowStrideInBytes(scalarType, 1, sizeX, rowStride)
+      return imageReader.readBitImageSlices(imageFilePath, totalHeaderSize + sliceHeaderSize, bytesPerRow, inputSliceSize,
+        slice(0, sizeX, 1), slice(0, sizeY, 1), slice(start, stop, 1), lsbFirst)
+    if pooledChunks:
+      return imageReader.readStridedImage(imageFilePath, PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian),
+        numberOfComponents, sizeX, sizeY, totalHeaderSize + sliceHeaderSize, inputSliceSize,
+        PixelTypes.rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride, planar), planar,
+        slice(0, sizeX, 1), slice(0, sizeY, 1), slice(start, stop, 1))
+    voxels = buffer[:stop - start]
+    imageReader.readSlicesInto(imageFilePath, totalHeaderSize + start * inputSliceSize,
+      PixelTypes.numpyDtypeFromScalarType(scalarType, bigEndian), voxels)
+    return voxels
+
+  headerText = exportedHeaderText(outputScalarType, numberOfComponents, sizeX, sizeY, finalSizeZ,
+    spacingX, spacingY, spacingZ, finalNumberOfVolumes, compress,
+    os.path.basename(dataFilePath) if detached else None)
+
+  profile = Instrumentation.currentProfile()
+  def writeChunk(dataFile, voxels):
+    with Instrumentation.activeProfile(profile):
+      with Instrumentation.stage('write'):
+        # Compression releases the GIL, so it runs in parallel with reading the next chunk
+        dataFile.write(voxels.reshape(-1).view(np.uint8))
+      if pooledChunks:
+        imageReader.bufferPool.release(voxels)
+
+  cancelled = False
+  try:
+    if detached:
+      with open(outputFilePath, "w") as headerFile:
+        headerFile.write(headerText)
+    with open(dataFilePath, "wb") as outputFile:
+      if not detached:
+        # Header is separated from the data by an empty line
+        outputFile.write((headerText + "\n").encode('latin-1'))
+      dataFile = gzip.GzipFile(fileobj=outputFile, mode='wb', compresslevel=compressionLevel, mtime=0) if compress else outputFile
+      try:
+        # Chunks are read into two alternating buffers (or decoded into arrays of the buffer pool)
+        buffers = []
+        if not pooledChunks:
+          dtype = PixelTypes.numpyDtypeFromScalarType(scalarType, False).newbyteorder('=')
+          buffers = [np.empty((min(slicesPerChunk, numberOfSlices), sizeY, sizeX, numberOfComponents), dtype=dtype) for index in range(2)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+          pendingWrite = None
+          for chunkIndex, start in enumerate(range(0, numberOfSlices, slicesPerChunk)):
+            stop = min(start + slicesPerChunk, numberOfSlices)
+            voxels = readChunk(start, stop, buffers[chunkIndex % 2] if buffers else None)
+            if pendingWrite is not None:
+              pendingWrite.result()
+            pendingWrite = writer.submit(writeChunk, dataFile, voxels)
+            if progressCallback is not None and progressCallback(float(stop) / numberOfSlices) is False:
+              cancelled = True
+              break
+          if pendingWrite is not None:
+            pendingWrite.result()
+      finally:
+        if compress:
+          dataFile.close()
+  except Exception:
+    for writtenFilePath in set([outputFilePath, dataFilePath]):
+      if os.path.exists(writtenFilePath):
+        os.remove(writtenFilePath)
+    raise
+  if cancelled:
+    for writtenFilePath in set([outputFilePath, dataFilePath]):
+      os.remove(writtenFilePath)
+  elif progressCallback is not None:
+    progressCallback(1.0)
+
+  return {
+    'outputFilePath': outputFilePath,
+    'dataFilePath': dataFilePath,
+    'bytesRead': numberOfSlices * inputSliceSize,
+    'bytesWritten': 0 if cancelled else sum(os.path.getsize(writtenFilePath) for writtenFilePath in set([outputFilePath, dataFilePath])),
+    'time': time.time() - startTime,
+    'cancelled': cancelled,
+    }
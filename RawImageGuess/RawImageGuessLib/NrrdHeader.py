@@ -0,0 +1,117 @@
+"""Writing NRRD headers (.nhdr files) that refer to raw image files"""
+
+import os
+
+from RawImageGuessLib import CompressedFile, PixelTypes
+
+def availableSizeZAndNumberOfVolumes(imageFilePath, scalarType, numberOfComponents, sizeX, sizeY, sizeZ,
+    headerSize, skipSlices, numberOfVolumes=1, rowStride=0, sliceHeaderSize=0, planar=False):
+  """Get (sizeZ, numberOfVolumes) trimmed to the voxel data that is available in the file,
+  and the total header size (header size and skipped slices, the offset of the first slice)
+  """
+  sliceSize = PixelTypes.sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride, sliceHeaderSize, planar)
+  totalHeaderSize = headerSize + skipSlices * sliceSize
+  totalFilesize = CompressedFile.dataSize(imageFilePath)
+  voxelDataSize = totalFilesize - totalHeaderSize
+  maxNumberOfSlices = int(voxelDataSize/sliceSize)
+  finalSizeZ = min(sizeZ, maxNumberOfSlices)
+  if finalSizeZ < 1:
+    raise ValueError("No voxel data available at specified header offset/size")
+  maxNumberOfVolumes = int(voxelDataSize/sliceSize/finalSizeZ)
+  finalNumberOfVolumes = min(numberOfVolumes, maxNumberOfVolumes)
+  return (finalSizeZ, finalNumberOfVolumes, totalHeaderSize)
+
+def outputFileBaseName(imageFilePath, outputDirectory=None):
+  """Get path of output files of an image file, without extension (scan.raw.gz -> scan).
+  Output files are next to the image file, or in outputDirectory if it is specified.
+  """
+  filename, file_extension = os.path.splitext(imageFilePath)
+  if CompressedFile.isCompressed(imageFilePath) and file_extension.lower() in CompressedFile.compressionExtensions:
+    # Remove extension of the uncompressed file as well
+    filename, file_extension = os.path.splitext(filename)
+  if outputDirectory:
+    filename = os.path.join(outputDirectory, os.path.basename(filename))
+  return filename
+
+def writeHeaderFields(headerFile, scalarType, numberOfComponents, bigEndian, sizeX, sizeY, sizeZ,
+    spacingX, spacingY, spacingZ, numberOfVolumes, encoding):
+  """Write the magic line and the fields that describe the voxel data (except byte skip and data file)"""
+  headerFile.write("NRRD0004\n")
+  headerFile.write("# Complete NRRD file format specification at:\n")
+  headerFile.write("# http://teem.sourceforge.net/nrrd/format.html\n")
+
+  if scalarType not in PixelTypes.nrrdTypeNames:
+    raise ValueError('Unknown scalar type')
+  headerFile.write("type: {0}\n".format(PixelTypes.nrrdTypeNames[scalarType]))
+
+  # Determine dimension, sizes, and kinds (dependent of number of components and volumes)
+  dimension = 3
+  sizesStr = "{0} {1} {2}".format(sizeX, sizeY, sizeZ)
+  spaceDirectionsStr = "({0}, 0.0, 0.0) (0.0, {1}, 0.0) (0.0, 0.0, {2})".format(spacingX, spacingY, spacingZ)
+  kindsStr = "domain domain domain"
+  if numberOfComponents > 1:
+    dimension += 1
+    sizesStr = "{0} ".format(numberOfComponents) + sizesStr
+    spaceDirectionsStr = "none " + spaceDirectionsStr
+    kindsStr = "vector " + kindsStr
+  if numberOfVolumes > 1:
+    dimension += 1
+    sizesStr = sizesStr + " {0}".format(numberOfVolumes)
+    spaceDirectionsStr = spaceDirectionsStr + " none"
+    kindsStr = kindsStr + " list"
+
+  headerFile.write("dimension: {0}\n".format(dimension))
+  headerFile.write("space: left-posterior-superior\n")
+  headerFile.write("sizes: {0}\n".format(sizesStr))
+  headerFile.write("space directions: {0}\n".format(spaceDirectionsStr))
+  headerFile.write("kinds: {0}\n".format(kindsStr))
+  headerFile.write("endian: {0}\n".format("big" if bigEndian else "little"))
+  headerFile.write("encoding: {0}\n".format(encoding))
+  headerFile.write("space origin: (0.0, 0.0, 0.0)\n")
+
+def writeNrrdHeader(imageFilePath, scalarType, numberOfComponents, bigEndian, sizeX, sizeY, sizeZ, headerSize, skipSlices,
+    spacingX, spacingY, spacingZ, numberOfVolumes=1, outputDirectory=None, rowStride=0, sliceHeaderSize=0, planar=False):
+  """
+  Write NRRD header file for a raw image file. The header is written next to the image file
+  (or into outputDirectory, if specified). sizeZ and numberOfVolumes are trimmed to the available voxel data.
+  Returns the header file name.
+  """
+
+  # Trim sizeZ and numberOfVolumes to maximum available data size (the reader would refuse loading completely
+  # if there is not enough voxel data)
+  if scalarType == PixelTypes.VTK_BIT:
+    raise RuntimeError("NRRD file format does not support 1bpp images. Export the image (see NrrdExport) instead.")
+  if not PixelTypes.isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride, sliceHeaderSize, planar):
+    # NRRD data files can only be skipped at the beginning. Planar components could be described by axis order,
+    # but most readers (including ITK) require the vector axis to be the first axis.
+    raise RuntimeError("NRRD file format does not support padded rows, slice headers, or planar components."
+      " Export the image (see NrrdExport) instead.")
+
+  (finalSizeZ, finalNumberOfVolumes, totalHeaderSize) = availableSizeZAndNumberOfVolumes(imageFilePath,
+    scalarType, numberOfComponents, sizeX, sizeY, sizeZ, headerSize, skipSlices, numberOfVolumes)
+
+  # NRRD readers decompress gzip and bzip2 compressed data files (byte skip is applied to the decompressed data)
+  compression = CompressedFile.compressionFormat(imageFilePath)
+  if compression not in [None, 'gzip', 'bzip2']:
+    raise ValueError("NRRD file format does not support {0} compressed data files. Decompress the file first.".format(compression))
+
+  filename = outputFileBaseName(imageFilePath, outputDirectory)
+  if finalNumberOfVolumes > 1:
+    nhdrFilename = filename + ".seq.nhdr"
+  else:
+    nhdrFilename = filename + ".nhdr"
+
+  with open(nhdrFilename, "w") as headerFile:
+    writeHeaderFields(headerFile, scalarType, numberOfComponents, bigEndian, sizeX, sizeY, finalSizeZ,
+      spacingX, spacingY, spacingZ, finalNumberOfVolumes, compression or "raw")
+    if totalHeaderSize > 0:
+      headerFile.write("byte skip: {0}\n".format(totalHeaderSize))
+    # Data file path is relative to the header file
+    try:
+      dataFilePath = os.path.relpath(os.path.abspath(imageFilePath), os.path.dirname(os.path.abspath(nhdrFilename)))
+    except ValueError:
+      # Image and header files are on different drives
+      dataFilePath = os.path.abspath(imageFilePath)
+    headerFile.write("data file: {0}\n".format(dataFilePath.replace(os.sep, '/')))
+
+  return nhdrFilename
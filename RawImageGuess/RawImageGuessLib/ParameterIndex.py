@@ -0,0 +1,115 @@
+"""
+Persistent index of image parameters that have been confirmed for files, so that parameters are filled in
+automatically when the same file or another file of the same format is opened.
+
+Files are identified by their size, their first bytes (magic bytes of the vendor format, if any), and a hash
+of their beginning and end. Only a few kilobytes are read, regardless of the size of the file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Names of the stored parameters (keyword arguments of RawImageGuessLogic.updateImage, except the file path)
+parameterNames = ['scalarType', 'numberOfComponents', 'bigEndian', 'lsbFirst', 'sizeX', 'sizeY', 'sizeZ',
+  'headerSize', 'skipSlices', 'spacingX', 'spacingY', 'spacingZ', 'numberOfVolumes', 'rowStride', 'sliceHeaderSize', 'planar']
+
+def fileKeys(filePath, magicSize=16, hashedSize=2048):
+  """
+  Get (contentKey, formatKey) of a file:
+  - contentKey identifies the file: size, first magicSize bytes, and hash of the first and last hashedSize bytes
+  - formatKey identifies files of the same format and image size: size and first magicSize bytes
+  At most 2*hashedSize bytes are read.
+  """
+  fileSize = os.path.getsize(filePath)
+  with open(filePath, 'rb') as f:
+    start = f.read(hashedSize)
+    if fileSize > 2 * hashedSize:
+      f.seek(fileSize - hashedSize)
+      end = f.read(hashedSize)
+    else:
+      end = b''
+  formatKey = "{0}:{1}".format(fileSize, start[:magicSize].hex())
+  contentKey = "{0}:{1}".format(formatKey, hashlib.sha1(start + end).hexdigest())
+  return (contentKey, formatKey)
+
+class ParameterIndex(object):
+  """Image parameters of files, stored in a JSON file. Least recently used entries are removed if the index is full.
+  Can be used from multiple threads.
+  """
+
+  def __init__(self, indexFilePath, maximumNumberOfEntries=1000):
+    self.indexFilePath = indexFilePath
+    self.maximumNumberOfEntries = maximumNumberOfEntries
+    self.lock = threading.Lock()
+    # key -> dict of parameters and lastUsed (time). Loaded when first used.
+    self.entries = None
+    # True if entries have been changed since they were saved (lookups update lastUsed of the found entries)
+    self.modified = False
+
+  def lookup(self, filePath):
+    """
+    Get the parameters that were stored for the file or, if there are none, for another file
+    of the same format and size. Returns (parameters, exactMatch) or (None, False) if the file is not known.
+    The found entry becomes the most recently used one.
+    """
+    (contentKey, formatKey) = fileKeys(filePath)
+    with self.lock:
+      self._load()
+      for key, exactMatch in [(contentKey, True), (formatKey, False)]:
+        entry = self.entries.get(key)
+        if entry is not None:
+          # Saved with the next stored parameters (or by save)
+          entry['lastUsed'] = time.time()
+          self.modified = True
+          return (dict((name, entry[name]) for name in parameterNames if name in entry), exactMatch)
+    return (None, False)
+
+  def store(self, filePath, parameters):
+    """Store parameters (dict with items of parameterNames, other items are ignored) for the file
+    and for files of the same format and size"""
+    (contentKey, formatKey) = fileKeys(filePath)
+    entry = dict((name, parameters[name]) for name in parameterNames if name in parameters)
+    entry['lastUsed'] = time.time()
+    with self.lock:
+      self._load()
+      self.entries[contentKey] = entry
+      self.entries[formatKey] = entry
+      if len(self.entries) > self.maximumNumberOfEntries:
+        keys = sorted(self.entries, key=lambda key: self.entries[key].get('lastUsed', 0))
+        for key in keys[:len(self.entries) - self.maximumNumberOfEntries]:
+          del self.entries[key]
+      self._save()
+
+  def save(self):
+    """Write the index file if entries have been changed since it was saved (for example, by lookups)"""
+    with self.lock:
+      if self.entries is not None and self.modified:
+        self._save()
+
+  def _load(self):
+    if self.entries is not None:
+      return
+    self.entries = {}
+    try:
+      with open(self.indexFilePath) as indexFile:
+        index = json.load(indexFile)
+      self.entries = index.get('entries', {})
+    except (IOError, OSError, ValueError):
+      # Missing or invalid index: start with an empty index
+      pass
+
+  def _save(self):
+    try:
+      directory = os.path.dirname(self.indexFilePath)
+      if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+      with open(self.indexFilePath + '.tmp', 'w') as indexFile:
+        json.dump({'entries': self.entries}, indexFile)
+      os.replace(self.indexFilePath + '.tmp', self.indexFilePath)
+      self.modified = False
+    except (IOError, OSError):
+      # The index only saves time when files are opened, the module works without it
+      pass
@@ -0,0 +1,121 @@
+"""Pixel types of raw images: VTK scalar types, names shown in the user interface, and NRRD type names.
+VTK is not required, scalar type constants have the same values as in VTK.
+"""
+
+VTK_BIT = 1
+VTK_UNSIGNED_CHAR = 3
+VTK_SHORT = 4
+VTK_UNSIGNED_SHORT = 5
+VTK_FLOAT = 10
+VTK_DOUBLE = 11
+VTK_SIGNED_CHAR = 15
+
+# Pixel type name (as shown in pixel type selector) -> (scalarType, numberOfComponents)
+pixelTypes = {
+  "8 bit unsigned": (VTK_UNSIGNED_CHAR, 1),
+  "8 bit signed": (VTK_SIGNED_CHAR, 1),
+  "16 bit unsigned": (VTK_UNSIGNED_SHORT, 1),
+  "16 bit signed": (VTK_SHORT, 1),
+  "float": (VTK_FLOAT, 1),
+  "double": (VTK_DOUBLE, 1),
+  "24 bit RGB": (VTK_UNSIGNED_CHAR, 3),
+  "1 bit": (VTK_BIT, 1),
+  }
+
+# Size of a scalar value in bytes (1bpp images are not byte-aligned)
+scalarTypeSizes = {
+  VTK_UNSIGNED_CHAR: 1,
+  VTK_SIGNED_CHAR: 1,
+  VTK_UNSIGNED_SHORT: 2,
+  VTK_SHORT: 2,
+  VTK_FLOAT: 4,
+  VTK_DOUBLE: 8,
+  }
+
+# NumPy type strings (without byte order) of byte-aligned scalar types
+numpyTypeStrForScalarType = {
+  VTK_UNSIGNED_CHAR: "u1",
+  VTK_SIGNED_CHAR: "i1",
+  VTK_UNSIGNED_SHORT: "u2",
+  VTK_SHORT: "i2",
+  VTK_FLOAT: "f4",
+  VTK_DOUBLE: "f8",
+  }
+
+nrrdTypeNames = {
+  VTK_UNSIGNED_CHAR: "uchar",
+  VTK_SIGNED_CHAR: "signed char",
+  VTK_UNSIGNED_SHORT: "ushort",
+  VTK_SHORT: "short",
+  VTK_FLOAT: "float",
+  VTK_DOUBLE: "double",
+  }
+
+def scalarTypeAndComponentsFromName(pixelTypeName):
+  """Get (scalarType, numberOfComponents) from pixel type name"""
+  if pixelTypeName not in pixelTypes:
+    raise ValueError("Unknown pixel type: {0}. Valid pixel types: {1}".format(pixelTypeName, ", ".join(pixelTypes)))
+  return pixelTypes[pixelTypeName]
+
+def pixelTypeName(scalarType, numberOfComponents):
+  """Get pixel type name (as shown in pixel type selector) from scalar type and number of components"""
+  # Prefer exact match, otherwise use the single-component pixel type
+  for components in [numberOfComponents, 1]:
+    for name, (pixelScalarType, pixelNumberOfComponents) in pixelTypes.items():
+      if pixelScalarType == scalarType and pixelNumberOfComponents == components:
+        return name
+  raise ValueError('Unknown scalar type')
+
+def scalarTypeSize(scalarType):
+  """Get size of a scalar value in bytes"""
+  if scalarType not in scalarTypeSizes:
+    raise ValueError('Unknown scalar type')
+  return scalarTypeSizes[scalarType]
+
+def packedRowSize(scalarType, numberOfComponents, sizeX, planar=False):
+  """Get size of an image row in bytes, without padding (rows of 1bpp images are padded to whole bytes).
+  If components are planar then a row contains values of one component.
+  """
+  if scalarType == VTK_BIT:
+    return (sizeX + 7) // 8
+  return sizeX * scalarTypeSize(scalarType) * (1 if planar else numberOfComponents)
+
+def isPackedLayout(scalarType, numberOfComponents, sizeX, rowStride=0, sliceHeaderSize=0, planar=False):
+  """Returns True if voxels are stored without padding and components are interleaved (the default layout)"""
+  if sliceHeaderSize:
+    return False
+  if planar and numberOfComponents > 1:
+    return False
+  return rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride) == packedRowSize(scalarType, numberOfComponents, sizeX)
+
+def rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride=0, planar=False):
+  """Get distance between the starts of consecutive rows in bytes (rowStride, or the packed row size if it is 0)"""
+  packedSize = packedRowSize(scalarType, numberOfComponents, sizeX, planar)
+  if not rowStride:
+    return packedSize
+  if rowStride < packedSize:
+    raise ValueError("Row stride ({0} bytes) is smaller than the size of a row ({1} bytes)".format(rowStride, packedSize))
+  return rowStride
+
+def sliceSize(scalarType, numberOfComponents, sizeX, sizeY, rowStride=0, sliceHeaderSize=0, planar=False):
+  """Get size of an image slice in bytes (rows of 1bpp images are padded to whole bytes).
+  Optionally, rows are padded to rowStride bytes, each slice starts with a header of sliceHeaderSize bytes,
+  and components are stored in planes (all rows of the first component, then all rows of the second, etc.).
+  """
+  numberOfPlanes = numberOfComponents if planar else 1
+  return sliceHeaderSize + rowStrideInBytes(scalarType, numberOfComponents, sizeX, rowStride, planar) * sizeY * numberOfPlanes
+
+def numpyDtypeFromScalarType(scalarType, bigEndian):
+  """Get NumPy data type (with byte order) corresponding to a VTK scalar type"""
+  import numpy as np
+  if scalarType not in numpyTypeStrForScalarType:
+    raise ValueError('Unknown scalar type')
+  return np.dtype((">" if bigEndian else "<") + numpyTypeStrForScalarType[scalarType])
+
+def scalarTypeFromNumpyDtype(dtype):
+  """Get VTK scalar type corresponding to a NumPy data type (byte order is ignored)"""
+  typeStr = dtype.kind + str(dtype.itemsize)
+  for scalarType in numpyTypeStrForScalarType:
+    if numpyTypeStrForScalarType[scalarType] == typeStr:
+      return scalarType
+  raise ValueError('Unsupported data type: {0}'.format(dtype))
@@ -0,0 +1,85 @@
+"""Reading images with likely next parameters before they are requested"""
+
+import threading
+
+from RawImageGuessLib import ImageReader, PixelTypes
+
+def estimatedImageSize(scalarType, numberOfComponents, sizeX, sizeY, sizeZ, decimation=1, **otherParameters):
+  """Get size of the array that readImage returns (in bytes), assuming that the file contains all slices"""
+  (decimationX, decimationY, decimationZ) = ImageReader.decimationFactors(decimation)
+  scalarSize = 1 if scalarType == PixelTypes.VTK_BIT else PixelTypes.scalarTypeSize(scalarType)
+  return (-(-sizeX // decimationX) * -(-sizeY // decimationY) * -(-sizeZ // decimationZ)
+    * numberOfComponents * scalarSize)
+
+class Prefetcher(object):
+  """Reads images into the result cache of an image reader on a background thread, so that when the user
+  changes parameters to one of the predicted values (for example, by clicking a header size offset button)
+  the image is returned from the cache immediately.
+  Only the most recent list of predictions is kept: a new list replaces the pending one.
+  Predictions that do not fit into the memory budget are skipped. The budget is limited to half of the
+  result cache size and a few entries less than the result cache can store, so that prefetched images
+  do not evict the displayed image.
+  """
+
+  def __init__(self, imageReader, maximumSize=512*1024*1024):
+    self.imageReader = imageReader
+    self.maximumSize = maximumSize
+    self.condition = threading.Condition()
+    self.thread = None
+    self.stopRequested = False
+    # Keyword arguments of readImage, most likely first
+    self.pendingParameters = []
+    self.numberOfPrefetchedImages = 0
+
+  def prefetch(self, parametersList):
+    """Read images with the keyword arguments (of ImageReader.readImage) in parametersList, most likely first.
+    Images that are already in the result cache are not read again (see ImageReader.prefetchImage).
+    """
+    resultCache = self.imageReader.resultCache
+    budget = min(self.maximumSize, resultCache.maximumSize // 2)
+    maximumNumberOfImages = max(0, resultCache.maximumNumberOfEntries - 2)
+    selectedParameters = []
+    for parameters in parametersList:
+      if len(selectedParameters) >= maximumNumberOfImages:
+        break
+      size = estimatedImageSize(**parameters)
+      if size > budget:
+        continue
+      budget -= size
+      selectedParameters.append(parameters)
+    with self.condition:
+      self.pendingParameters = selectedParameters
+      self.stopRequested = False
+      if selectedParameters and (not self.thread or not self.thread.is_alive()):
+        self.thread = threading.Thread(target=self._run, name="RawImageGuessPrefetcher")
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+
+  def cancel(self):
+    """Drop pending predictions (an image that is being read is still added to the cache)"""
+    with self.condition:
+      self.pendingParameters = []
+
+  def stop(self):
+    """Cancel all predictions and stop the background thread"""
+    with self.condition:
+      self.stopRequested = True
+      self.pendingParameters = []
+      self.condition.notify()
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while not self.pendingParameters and not self.stopRequested:
+          self.condition.wait()
+        if self.stopRequested:
+          return
+        parameters = self.pendingParameters.pop(0)
+      try:
+        if self.imageReader.prefetchImage(**parameters):
+          with self.condition:
+            self.numberOfPrefetchedImages += 1
+      except Exception:
+        # Predicted parameters may be invalid (for example, no voxel data at the predicted header size)
+        pass
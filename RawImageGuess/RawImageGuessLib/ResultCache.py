@@ -0,0 +1,103 @@
+"""Cache of recently read images"""
+
+import collections
+import threading
+
+class ResultCache(object):
+  """Cache of recently read images (NumPy arrays), with least-recently-used eviction.
+  Switching back to a recently used set of image parameters returns the stored array
+  instead of reading the image again.
+  Note that cached arrays are shared with the output volume (voxels are not copied).
+  Can be used from multiple threads.
+  """
+
+  def __init__(self, maximumSize=1024*1024*1024, maximumNumberOfEntries=8):
+    self.maximumSize = maximumSize
+    self.maximumNumberOfEntries = maximumNumberOfEntries
+    self.lock = threading.Lock()
+    # key -> array, least recently used first
+    self.entries = collections.OrderedDict()
+    self.cachedSize = 0
+    self.numberOfHits = 0
+    self.numberOfMisses = 0
+    # Function that is called with (key, array) of each entry that is removed from the cache
+    # (called without holding the lock of the cache)
+    self.evictionCallback = None
+
+  def setMaximumSize(self, maximumSize):
+    """Set memory budget (in bytes). Results are not cached if it is 0."""
+    with self.lock:
+      self.maximumSize = maximumSize
+      evictedEntries = self._evict()
+    self._notifyEvicted(evictedEntries)
+
+  def clear(self):
+    with self.lock:
+      evictedEntries = list(self.entries.items())
+      self.entries.clear()
+      self.cachedSize = 0
+    self._notifyEvicted(evictedEntries)
+
+  def get(self, key):
+    """Returns the array stored for the key or None if it is not in the cache"""
+    with self.lock:
+      voxels = self.entries.get(key)
+      if voxels is None:
+        self.numberOfMisses += 1
+        return None
+      self.numberOfHits += 1
+      self.entries.move_to_end(key)
+      return voxels
+
+  def contains(self, key):
+    """Returns True if an array is stored for the key (does not count as a hit and does not change eviction order)"""
+    with self.lock:
+      return key in self.entries
+
+  def containsArray(self, voxels):
+    """Returns True if the array (not just an equal array) is stored in the cache"""
+    with self.lock:
+      return any(cachedVoxels is voxels for cachedVoxels in self.entries.values())
+
+  def add(self, key, voxels):
+    """Store the array for the key. Returns True if the array has been stored (it is not larger than the cache)."""
+    evictedEntries = []
+    with self.lock:
+      if key in self.entries:
+        replacedVoxels = self.entries.pop(key)
+        self.cachedSize -= replacedVoxels.nbytes
+        if replacedVoxels is not voxels:
+          evictedEntries.append((key, replacedVoxels))
+      added = voxels.nbytes <= self.maximumSize
+      if added:
+        self.entries[key] = voxels
+        self.cachedSize += voxels.nbytes
+        evictedEntries.extend(self._evict())
+    self._notifyEvicted(evictedEntries)
+    return added
+
+  def statistics(self):
+    """Returns dict with number of entries, size, number of hits and misses, and hit rate"""
+    with self.lock:
+      numberOfRequests = self.numberOfHits + self.numberOfMisses
+      return {
+        'numberOfEntries': len(self.entries),
+        'size': self.cachedSize,
+        'numberOfHits': self.numberOfHits,
+        'numberOfMisses': self.numberOfMisses,
+        'hitRate': float(self.numberOfHits) / numberOfRequests if numberOfRequests else 0.0,
+        }
+
+  def _evict(self):
+    """Remove least recently used entries until the cache is within its limits. Returns the removed entries."""
+    evictedEntries = []
+    while self.entries and (self.cachedSize > self.maximumSize or len(self.entries) > self.maximumNumberOfEntries):
+      (key, voxels) = self.entries.popitem(last=False)
+      self.cachedSize -= voxels.nbytes
+      evictedEntries.append((key, voxels))
+    return evictedEntries
+
+  def _notifyEvicted(self, evictedEntries):
+    if self.evictionCallback:
+      for (key, voxels) in evictedEntries:
+        self.evictionCallback(key, voxels)
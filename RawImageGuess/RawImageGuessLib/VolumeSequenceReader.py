@@ -0,0 +1,113 @@
+"""Reading frames of multi-volume (4D) raw image files on demand"""
+
+import sys
+import threading
+
+from RawImageGuessLib import NrrdHeader
+from RawImageGuessLib.ResultCache import ResultCache
+
+class VolumeSequenceReader(object):
+  """Reads frames (volumes) of a multi-volume raw image file on demand.
+  Volumes are stored one after the other in the file, each frame is read like a single volume
+  by skipping the slices of the preceding volumes. Only a few recently used frames are kept in memory
+  and frames around the most recently requested frame are read in advance on a background thread,
+  so that browsing to a neighbor frame does not have to wait for reading.
+  Can be used from multiple threads.
+  """
+
+  def __init__(self, reader, imageFilePath,
+    scalarType, numberOfComponents, bigEndian, lsbFirst, sizeX, sizeY, sizeZ, headerSize, skipSlices, numberOfVolumes,
+    maximumNumberOfCachedFrames=5, prefetchRadius=2, rowStride=0, sliceHeaderSize=0, planar=False):
+    """reader is an ImageReader. sizeZ and numberOfVolumes are trimmed to the voxel data available in the file."""
+    (sizeZ, numberOfVolumes, totalHeaderSize) = NrrdHeader.availableSizeZAndNumberOfVolumes(imageFilePath,
+      scalarType, numberOfComponents, sizeX, sizeY, sizeZ, headerSize, skipSlices, numberOfVolumes,
+      rowStride, sliceHeaderSize, planar)
+    self.reader = reader
+    self.numberOfFrames = numberOfVolumes
+    self.imageParameters = {
+      'imageFilePath': imageFilePath,
+      'scalarType': scalarType,
+      'numberOfComponents': numberOfComponents,
+      'bigEndian': bigEndian,
+      'lsbFirst': lsbFirst,
+      'sizeX': sizeX,
+      'sizeY': sizeY,
+      'sizeZ': sizeZ,
+      'headerSize': headerSize,
+      'skipSlices': skipSlices,
+      'rowStride': rowStride,
+      'sliceHeaderSize': sliceHeaderSize,
+      'planar': planar,
+      }
+    self.prefetchRadius = prefetchRadius
+    # Frames are cached here instead of the result cache of the reader, so that the number of frames
+    # that are kept in memory is bounded (the current frame and the prefetched frames must fit)
+    self.frameCache = ResultCache(maximumSize=sys.maxsize,
+      maximumNumberOfEntries=max(maximumNumberOfCachedFrames, 2 * prefetchRadius + 1))
+    self.condition = threading.Condition()
+    self.thread = None
+    self.stopRequested = False
+    # Frame indices to prefetch, nearest first. Replaced at each getFrame call.
+    self.prefetchQueue = []
+
+  def frameParameters(self, frameIndex):
+    """Returns keyword arguments of ImageReader.readImage for reading a frame"""
+    if frameIndex < 0 or frameIndex >= self.numberOfFrames:
+      raise IndexError("Frame index {0} is out of range (number of frames: {1})".format(frameIndex, self.numberOfFrames))
+    parameters = dict(self.imageParameters)
+    parameters['skipSlices'] += frameIndex * parameters['sizeZ']
+    return parameters
+
+  def getFrame(self, frameIndex, prefetch=True):
+    """Returns voxels of a frame as a (sizeZ, sizeY, sizeX, numberOfComponents) NumPy array.
+    If prefetch is enabled then neighbor frames are read in advance on a background thread.
+    """
+    voxels = self.readFrame(frameIndex)
+    if prefetch and self.prefetchRadius > 0:
+      self.requestPrefetch(frameIndex)
+    return voxels
+
+  def readFrame(self, frameIndex):
+    """Returns voxels of a frame, from the frame cache if available"""
+    voxels = self.frameCache.get(frameIndex)
+    if voxels is None:
+      voxels = self.reader.readImage(useResultCache=False, **self.frameParameters(frameIndex))
+      self.frameCache.add(frameIndex, voxels)
+    return voxels
+
+  def requestPrefetch(self, frameIndex):
+    """Read frames around frameIndex on a background thread (nearest first, the next frame before the previous one)"""
+    frameIndices = []
+    for distance in range(1, self.prefetchRadius + 1):
+      frameIndices.extend([frameIndex + distance, frameIndex - distance])
+    with self.condition:
+      self.prefetchQueue = [index for index in frameIndices if 0 <= index < self.numberOfFrames]
+      self.stopRequested = False
+      if not self.thread or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self._run, name="RawImageGuessFramePrefetch")
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+
+  def stop(self):
+    """Cancel prefetching and stop the background thread"""
+    with self.condition:
+      self.prefetchQueue = []
+      self.stopRequested = True
+      self.condition.notify()
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while not self.prefetchQueue and not self.stopRequested:
+          self.condition.wait()
+        if self.stopRequested:
+          return
+        frameIndex = self.prefetchQueue.pop(0)
+      if self.frameCache.contains(frameIndex):
+        continue
+      try:
+        self.readFrame(frameIndex)
+      except Exception:
+        # Errors are reported when the frame is requested by getFrame
+        pass
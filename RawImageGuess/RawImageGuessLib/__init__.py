@@ -0,0 +1 @@
+# Functions of RawImageGuess that do not require Slicer (can be used from plain Python)
@@ -0,0 +1,261 @@
+"""
+Benchmark of reading raw images and generating NRRD headers.
+
+Synthetic raw image files are generated for all pixel types (both endiannesses, both bit orders for 1bpp images)
+and the requested file sizes. In Slicer, each image is loaded by RawImageGuessLogic.updateImage (with empty caches),
+otherwise it is read by ImageReader.readImage and imported into vtkImageData (if VTK is available).
+Stages are timed by the same profile (see Instrumentation) as the updates of the module, for example:
+
+- stat: getting file size and modification time
+- map, read, decode, unpack: reading and decoding the voxels (depending on pixel type and memory mapping)
+- vtkImport: setting the voxel array as image data of the output volume
+- geometry, statistics: setting geometry and window/level of the output volume (only in Slicer)
+- total: the whole update
+
+and, after the update:
+
+- access: computing the value range of the voxels (memory-mapped data is read at this point)
+- header: writing NRRD header
+
+Each case runs in a separate process so that peak resident memory size can be reported for each case.
+Results are written as JSON lines (one line per case).
+
+Usage with plain Python:
+
+  python RawImageGuessBenchmark.py --sizes 1 64 1024 --output results.jsonl
+
+Usage with Slicer:
+
+  Slicer --no-main-window --python-script RawImageGuessBenchmark.py --sizes 1 64 1024 --output results.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Make RawImageGuessLib importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from RawImageGuessLib import ImageReader, Instrumentation, NrrdHeader, PixelTypes
+
+def benchmarkCases(sizesMB, pixelTypeNames=None):
+  """Get list of benchmark cases (dicts of image parameters) for all pixel types and file sizes"""
+  cases = []
+  for sizeMB in sizesMB:
+    for pixelTypeName in (pixelTypeNames or PixelTypes.pixelTypes.keys()):
+      (scalarType, numberOfComponents) = PixelTypes.scalarTypeAndComponentsFromName(pixelTypeName)
+      if scalarType == PixelTypes.VTK_BIT:
+        (sizeX, sizeY) = (2048, 2048)
+        sliceSize = sizeX * sizeY // 8
+        byteOrders = [(False, False), (False, True)]
+      else:
+        (sizeX, sizeY) = (512, 512)
+        sliceSize = sizeX * sizeY * PixelTypes.scalarTypeSize(scalarType) * numberOfComponents
+        byteOrders = [(False, False), (True, False)] if PixelTypes.scalarTypeSize(scalarType) > 1 else [(False, False)]
+      sizeZ = max(1, int(round(sizeMB * 1024 * 1024 / sliceSize)))
+      for (bigEndian, lsbFirst) in byteOrders:
+        cases.append({
+          'pixelType': pixelTypeName,
+          'scalarType': scalarType,
+          'numberOfComponents': numberOfComponents,
+          'bigEndian': bigEndian,
+          'lsbFirst': lsbFirst,
+          'sizeX': sizeX,
+          'sizeY': sizeY,
+          'sizeZ': sizeZ,
+          'headerSize': 1000,
+          'skipSlices': 0,
+          'fileSize': 1000 + sliceSize * sizeZ,
+          })
+  return cases
+
+def caseName(case):
+  name = "{0} {1}x{2}x{3}".format(case['pixelType'], case['sizeX'], case['sizeY'], case['sizeZ'])
+  if case['scalarType'] == PixelTypes.VTK_BIT:
+    name += " LSB-first" if case['lsbFirst'] else " MSB-first"
+  elif PixelTypes.scalarTypeSize(case['scalarType']) > 1:
+    name += " big endian" if case['bigEndian'] else " little endian"
+  return name
+
+def writeImageFile(filePath, case):
+  """Write synthetic raw image file (slice by slice, to allow generating files larger than the memory)"""
+  import numpy as np
+  (sizeX, sizeY) = (case['sizeX'], case['sizeY'])
+  (j, i) = np.mgrid[0:sizeY, 0:sizeX]
+  with open(filePath, 'wb') as imageFile:
+    imageFile.write(b'\0' * case['headerSize'])
+    for k in range(case['sizeZ']):
+      values = (i + 2 * j + 3 * k) % 251
+      if case['scalarType'] == PixelTypes.VTK_BIT:
+        sliceData = np.packbits(values > 125, axis=None, bitorder='little' if case['lsbFirst'] else 'big')
+      else:
+        dtype = PixelTypes.numpyDtypeFromScalarType(case['scalarType'], case['bigEndian'])
+        sliceData = np.repeat(values[..., np.newaxis], case['numberOfComponents'], axis=2).astype(dtype)
+      imageFile.write(sliceData.tobytes())
+
+def peakResidentMemorySizeMB():
+  """Get peak resident memory size of the current process (None if not available on this platform)"""
+  try:
+    import resource
+  except ImportError:
+    try:
+      import psutil
+    except ImportError:
+      return None
+    memoryInfo = psutil.Process().memory_info()
+    return getattr(memoryInfo, 'peak_wset', memoryInfo.rss) / (1024.0 * 1024.0)
+  peakSize = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Reported in bytes on macOS, in kilobytes on Linux
+  return peakSize / (1024.0 * 1024.0) if sys.platform == 'darwin' else peakSize / 1024.0
+
+def importIntoVtk(voxels):
+  """Create vtkImageData from voxel array (the same way as RawImageGuessLogic.setImageArray)"""
+  import vtk
+  sizeZ, sizeY, sizeX, numberOfComponents = voxels.shape
+  voxelsFlat = voxels.reshape(-1)
+  scalars = vtk.vtkDataArray.CreateDataArray(PixelTypes.scalarTypeFromNumpyDtype(voxels.dtype))
+  scalars.SetNumberOfComponents(numberOfComponents)
+  scalars.SetVoidArray(voxelsFlat, voxelsFlat.size, 1)
+  scalars._numpyReference = voxelsFlat
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(sizeX, sizeY, sizeZ)
+  imageData.GetPointData().SetScalars(scalars)
+  return imageData
+
+def runCase(case, filePath, repetitions=3, memoryMappingEnabled=True, numberOfThreads=None):
+  """Run all stages for a case. Returns dict of results. The best (shortest) time of the repetitions is reported."""
+  try:
+    import slicer
+    import RawImageGuess
+  except ImportError:
+    slicer = None
+  try:
+    import vtk
+  except ImportError:
+    vtk = None
+  imageParameters = dict((name, case[name]) for name in ['scalarType', 'numberOfComponents', 'bigEndian', 'lsbFirst',
+    'sizeX', 'sizeY', 'sizeZ', 'headerSize', 'skipSlices'])
+  stageTimes = {}
+  def recordTime(stage, elapsedTime):
+    stageTimes[stage] = min(stageTimes.get(stage, elapsedTime), elapsedTime)
+
+  for repetition in range(repetitions):
+    # New reader for each repetition: caches are empty
+    logic = RawImageGuess.RawImageGuessLogic() if slicer else None
+    reader = logic.reader if logic else ImageReader.ImageReader()
+    reader.memoryMappingEnabled = memoryMappingEnabled
+    reader.numberOfThreads = numberOfThreads
+    profile = Instrumentation.Profile("Update")
+    with Instrumentation.activeProfile(profile):
+      if logic:
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        logic.updateImage(volumeNode, filePath, spacingX=1.0, spacingY=1.0, spacingZ=1.0, **imageParameters)
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+      else:
+        voxels = reader.readImage(filePath, **imageParameters)
+        if vtk is not None:
+          with Instrumentation.stage('vtkImport'):
+            importIntoVtk(voxels)
+    profile.finish()
+    for stage in profile.stages:
+      recordTime(stage['name'], stage['time'])
+    recordTime('total', profile.totalTime)
+
+    startTime = time.perf_counter()
+    valueRange = (voxels.min().item(), voxels.max().item())
+    recordTime('access', time.perf_counter() - startTime)
+
+    if case['scalarType'] != PixelTypes.VTK_BIT:
+      startTime = time.perf_counter()
+      headerFilePath = NrrdHeader.writeNrrdHeader(filePath, spacingX=1.0, spacingY=1.0, spacingZ=1.0, **dict(
+        (name, imageParameters[name]) for name in imageParameters if name != 'lsbFirst'))
+      recordTime('header', time.perf_counter() - startTime)
+      os.remove(headerFilePath)
+
+    del voxels
+    if logic:
+      slicer.mrmlScene.RemoveNode(volumeNode)
+    del reader
+    del logic
+
+  fileSizeMB = case['fileSize'] / (1024.0 * 1024.0)
+  result = dict(case)
+  result.update({
+    'name': caseName(case),
+    'memoryMapping': memoryMappingEnabled,
+    'numberOfThreads': numberOfThreads or os.cpu_count(),
+    'repetitions': repetitions,
+    'times': stageTimes,
+    'updateThroughputMBps': fileSizeMB / max(stageTimes['total'] + stageTimes['access'], 1e-9),
+    'valueRange': valueRange,
+    'peakResidentMemoryMB': peakResidentMemorySizeMB(),
+    })
+  return result
+
+def runCaseInNewProcess(case, filePath, repetitions, memoryMappingEnabled, numberOfThreads):
+  import concurrent.futures
+  import multiprocessing
+  with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+    return executor.submit(runCase, case, filePath, repetitions, memoryMappingEnabled, numberOfThreads).result()
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark reading raw images and generating NRRD headers.")
+  parser.add_argument("--sizes", type=float, nargs='+', default=[1, 64], help="file sizes in MB (default: 1 64)")
+  parser.add_argument("--pixel-types", nargs='+', help="pixel type names (default: all), for example: \"16 bit signed\" \"1 bit\"")
+  parser.add_argument("--repetitions", type=int, default=3, help="number of repetitions of each case (shortest time is reported)")
+  parser.add_argument("--no-memory-mapping", action='store_true', help="read byte-aligned images without memory mapping")
+  parser.add_argument("--threads", type=int, help="number of threads for reading and decoding (default: number of CPUs)")
+  parser.add_argument("--no-isolation", action='store_true', help="run all cases in this process (peak memory is not reported correctly)")
+  parser.add_argument("--directory", help="directory for synthetic image files (default: temporary directory)")
+  parser.add_argument("--output", help="write results to this file (JSON lines) instead of the standard output")
+  args = parser.parse_args(argv)
+
+  directory = args.directory or tempfile.mkdtemp(prefix='RawImageGuessBenchmark')
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  outputFile = open(args.output, 'w') if args.output else sys.stdout
+  numberOfFailures = 0
+  try:
+    for caseIndex, case in enumerate(benchmarkCases(args.sizes, args.pixel_types)):
+      filePath = os.path.join(directory, "benchmark{0}.raw".format(caseIndex))
+      try:
+        writeImageFile(filePath, case)
+        if args.no_isolation:
+          result = runCase(case, filePath, args.repetitions, not args.no_memory_mapping, args.threads)
+        else:
+          result = runCaseInNewProcess(case, filePath, args.repetitions, not args.no_memory_mapping, args.threads)
+      except Exception as e:
+        numberOfFailures += 1
+        result = dict(case)
+        result.update({'name': caseName(case), 'error': "{0}: {1}".format(type(e).__name__, e)})
+      finally:
+        if os.path.exists(filePath):
+          os.remove(filePath)
+      outputFile.write(json.dumps(result) + "\n")
+      outputFile.flush()
+      if 'error' in result:
+        sys.stderr.write("{0}: FAILED {1}\n".format(result['name'], result['error']))
+      else:
+        sys.stderr.write("{0}: {1}, {2:.1f} MB/s\n".format(result['name'],
+          ", ".join("{0} {1:.4f}s".format(stage, stageTime) for stage, stageTime in result['times'].items()),
+          result['updateThroughputMBps']))
+  finally:
+    if args.output:
+      outputFile.close()
+    if not args.directory:
+      os.rmdir(directory)
+  return 1 if numberOfFailures else 0
+
+def exitApplication(status):
+  try:
+    import slicer
+  except ImportError:
+    sys.exit(status)
+  # Running in Slicer (that does not exit at the end of the script)
+  slicer.util.exit(status)
+
+if __name__ == '__main__':
+  exitApplication(main(sys.argv[1:]))